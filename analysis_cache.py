@@ -0,0 +1,268 @@
+import hashlib
+import json
+import os
+import shutil
+import uuid
+import zlib
+
+import numpy as np
+
+from instrumentation import timer
+
+# Analysis results kept between runs, so that re-rendering a video with another smooth factor or another
+# color table does not decode and analyse it again. The key is a hash of the video (and of the model for
+# segmentation) and of the analysis parameters: a video that is renamed keeps its entries and a video that
+# is edited gets new ones.
+#
+# Every entry is a directory of .npy arrays plus meta.json, written under a temporary name and renamed
+# when complete: an interrupted run never leaves a partial entry behind. Large per-frame arrays are
+# compressed frame by frame and read back one frame at a time, so neither side needs them in memory.
+DEFAULT_CACHE_DIR = os.path.join("outputs", "analysis_cache")
+
+# Least recently used entries are removed beyond this size
+DEFAULT_MAX_CACHE_BYTES = 20 * 1024 ** 3
+
+# Part of every key, changed when the content of the entries changes
+CACHE_VERSION = 2
+
+# Blocks of a file read for its hash, evenly spaced from the first to the last byte: together with the size
+# and the modification time they tell two videos apart without reading them in full
+HASH_BLOCKS = 16
+HASH_BLOCK_SIZE = 64 * 1024
+
+# zlib level of the per-frame arrays, class IDs compress 20-50x even at the fastest level
+COMPRESSION_LEVEL = 1
+
+
+# Function to get the SHA-256 of the size, modification time and HASH_BLOCKS sampled blocks of a file
+def file_hash(path):
+    stat = os.stat(path)
+    digest = hashlib.sha256(f"{stat.st_size}|{stat.st_mtime_ns}".encode())
+    last_offset = max(stat.st_size - HASH_BLOCK_SIZE, 0)
+    with open(path, "rb") as hashed_file:
+        for offset in sorted({block * last_offset // (HASH_BLOCKS - 1) for block in range(HASH_BLOCKS)}):
+            hashed_file.seek(offset)
+            digest.update(hashed_file.read(HASH_BLOCK_SIZE))
+    return digest.hexdigest()
+
+
+# Function to get the size of the files of an entry directory
+def directory_size(path):
+    return sum(os.path.getsize(os.path.join(path, file_name)) for file_name in os.listdir(path))
+
+
+# A complete entry. Arrays are opened as read-only memory maps, per-frame arrays are read frame by frame.
+class CacheEntry:
+    def __init__(self, path, meta):
+        self.path = path
+        self.meta = meta
+
+    def load(self, name, mmap=True):
+        return np.load(os.path.join(self.path, name + ".npy"), mmap_mode="r" if mmap else None)
+
+    # Number of frames of a per-frame array written by a FrameArrayWriter
+    def frame_count(self, name):
+        return self.meta["frame_arrays"][name]["count"]
+
+    # Frames of a per-frame array written by a FrameArrayWriter, decompressed one at a time. A frame stored
+    # as a repeat of the previous one is yielded as None, as segmentation.masks_from_class_maps takes it.
+    def frames(self, name):
+        info = self.meta["frame_arrays"][name]
+        dtype, shape = np.dtype(info["dtype"]), tuple(info["shape"])
+        with open(os.path.join(self.path, name + ".frames"), "rb") as frames_file:
+            for _ in range(info["count"]):
+                size = int.from_bytes(frames_file.read(8), "little")
+                if not size:
+                    yield None
+                    continue
+                with timer("cache_decompress"):
+                    frame = np.frombuffer(zlib.decompress(frames_file.read(size)), dtype=dtype).reshape(shape)
+                yield frame
+
+
+# A per-frame array written one frame at a time to a .frames file: every frame is a zlib record preceded by
+# its size, and a frame equal to the previous one (a class map held between analysed frames, see
+# frame_sampling.py) is an empty record. The shape and type of the frames are taken from the first one.
+# frame_count is the number of frames expected: an array that would not fit in max_bytes, estimated from its
+# first frame or found while writing, is not written and its entry is not kept.
+class FrameArrayWriter:
+    def __init__(self, path, frame_count, max_bytes=None):
+        self.path = path
+        self.frame_count = frame_count
+        self.max_bytes = max_bytes
+        self.file = None
+        self.previous = None
+        self.dtype = None
+        self.shape = None
+        self.count = 0
+        self.size = 0
+        self.oversized = False
+
+    def append(self, frame):
+        if self.oversized:
+            return
+        if self.previous is not None and np.array_equal(frame, self.previous):
+            record = b""
+        else:
+            with timer("cache_compress"):
+                record = zlib.compress(np.ascontiguousarray(frame).tobytes(), COMPRESSION_LEVEL)
+            self.previous = frame.copy()
+
+        if self.file is None:
+            if self.max_bytes is not None and len(record) * max(self.frame_count, 1) > self.max_bytes:
+                self._skip()
+                return
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            self.file = open(self.path, "wb")
+            self.dtype = frame.dtype.str
+            self.shape = list(frame.shape)
+
+        self.file.write(len(record).to_bytes(8, "little"))
+        self.file.write(record)
+        self.size += 8 + len(record)
+        self.count += 1
+        if self.max_bytes is not None and self.size > self.max_bytes:
+            self._skip()
+
+    def _skip(self):
+        print(f"[INFO] Not caching {os.path.basename(self.path)}, it would be larger than the cache")
+        self.oversized = True
+        self.previous = None
+        self.close()
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+    # Description of the array kept in the meta.json of the entry
+    def info(self):
+        return {"dtype": self.dtype, "shape": self.shape, "count": self.count}
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+
+# An entry being written. Nothing is visible to get() before commit(), and an entry that is not committed
+# (failed or cancelled run) is removed when the writer is closed. The temporary directory is only created
+# by the first write.
+class CacheWriter:
+    def __init__(self, cache, key, meta=None):
+        self.cache = cache
+        self.key = key
+        self.meta = dict(meta or {})
+        self.path = os.path.join(cache.cache_dir, f"{key}.{uuid.uuid4().hex}.tmp")
+        self.frame_arrays = {}
+        self.committed = False
+
+    def save(self, name, array):
+        os.makedirs(self.path, exist_ok=True)
+        np.save(os.path.join(self.path, name + ".npy"), np.asarray(array))
+
+    def frame_array(self, name, frame_count):
+        writer = FrameArrayWriter(os.path.join(self.path, name + ".frames"), frame_count, self.cache.max_bytes)
+        self.frame_arrays[name] = writer
+        return writer
+
+    # Makes the entry visible, returns whether it was kept
+    def commit(self):
+        for writer in self.frame_arrays.values():
+            writer.close()
+        if any(writer.oversized or writer.count == 0 for writer in self.frame_arrays.values()):
+            return False
+        # An entry larger than the whole cache would only evict everything else
+        if os.path.isdir(self.path) and directory_size(self.path) > self.cache.max_bytes:
+            return False
+
+        self.meta["frame_arrays"] = {name: writer.info() for name, writer in self.frame_arrays.items()}
+        os.makedirs(self.path, exist_ok=True)
+        with open(os.path.join(self.path, "meta.json"), 'w') as meta_file:
+            json.dump(self.meta, meta_file, indent=4)
+
+        entry_path = self.cache.entry_path(self.key)
+        if os.path.exists(entry_path):
+            # Another run stored the same analysis meanwhile
+            return False
+        try:
+            os.rename(self.path, entry_path)
+        except OSError:
+            return False
+        self.committed = True
+        self.cache.prune(keep=entry_path)
+        return True
+
+    def close(self):
+        for writer in self.frame_arrays.values():
+            writer.close()
+        if not self.committed:
+            shutil.rmtree(self.path, ignore_errors=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+class AnalysisCache:
+    def __init__(self, cache_dir=DEFAULT_CACHE_DIR, max_bytes=DEFAULT_MAX_CACHE_BYTES):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+
+    # Key of the analysis of kind ("cromaticon", "segmentation"...) of a video with the given parameters.
+    # Files whose content matters (e.g. a model) are passed in files and hashed like the video.
+    def key(self, kind, video_path, files=(), **params):
+        description = {
+            "version": CACHE_VERSION,
+            "kind": kind,
+            "video": file_hash(video_path),
+            "files": [file_hash(path) for path in files],
+            "params": params,
+        }
+        encoded = json.dumps(description, sort_keys=True).encode()
+        return f"{kind}-{hashlib.sha256(encoded).hexdigest()[:40]}"
+
+    def entry_path(self, key):
+        return os.path.join(self.cache_dir, key)
+
+    # Complete entry of a key, None when there is none
+    def get(self, key):
+        entry_path = self.entry_path(key)
+        meta_path = os.path.join(entry_path, "meta.json")
+        if not os.path.exists(meta_path):
+            return None
+        with open(meta_path, 'r') as meta_file:
+            meta = json.load(meta_file)
+        # The modification time of the directory records the last use, see prune()
+        os.utime(entry_path)
+        return CacheEntry(entry_path, meta)
+
+    def writer(self, key, meta=None):
+        return CacheWriter(self, key, meta)
+
+    # Function to remove the least recently used entries until the cache fits in max_bytes. The entry at keep
+    # (the one just committed) is never removed, even when it is older than the others.
+    def prune(self, keep=None):
+        entries = []
+        for name in os.listdir(self.cache_dir):
+            path = os.path.join(self.cache_dir, name)
+            if not os.path.isdir(path) or name.endswith(".tmp"):
+                continue
+            entries.append((os.path.getmtime(path), directory_size(path), path))
+
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            if path == keep:
+                continue
+            shutil.rmtree(path, ignore_errors=True)
+            total -= size
+
+    # Function to remove every entry, and the temporary directories of runs that were killed
+    def clear(self):
+        if not os.path.isdir(self.cache_dir):
+            return
+        for name in os.listdir(self.cache_dir):
+            path = os.path.join(self.cache_dir, name)
+            if os.path.isdir(path):
+                shutil.rmtree(path, ignore_errors=True)
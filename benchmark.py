@@ -0,0 +1,391 @@
+import argparse
+import datetime
+import json
+import os
+import platform
+import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import get_context
+
+import cv2
+import gpxpy.gpx
+import numpy as np
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+from jobs import MODEL_PATH, CLASSES_PATH, CLASS_COLORS
+import instrumentation
+
+# Benchmarks of the processing modes on deterministic synthetic clips or on the bundled inputs:
+#   python -m benchmark
+#   python -m benchmark --mode pixelate --fixture 1080p --repeat 3 --output results.json
+#   python -m benchmark --save-baseline baseline.json
+#   python -m benchmark --baseline baseline.json
+# Every case runs in a fresh process, so its peak RSS is its own, with instrumentation.py recording where
+# the time goes (decode, resize, fit, assign, render, encode...). The results are written as JSON and
+# compared with a baseline from an earlier run: cases slower (or larger) than the tolerance are reported
+# as regressions and the exit code is 1.
+
+# Synthetic clips: (width, height, frames), all at SYNTHETIC_FPS with a GPX track of the same length
+FIXTURES = {
+    "360p": (640, 360, 120),
+    "720p": (1280, 720, 120),
+    "1080p": (1920, 1080, 60),
+    "360p-long": (640, 360, 900),
+}
+SYNTHETIC_FPS = 30
+
+# The bundled video and track, usable as a fixture like the synthetic ones
+BUNDLED_FIXTURE = "terreno"
+BUNDLED_VIDEO = "inputs/video/terreno.mp4"
+BUNDLED_GPX = "inputs/gpx/traccia.gpx"
+
+DEFAULT_FIXTURES = ("360p", "720p")
+BENCHMARK_MODES = ("cromaticon", "cromaticon-frame", "pixelate", "segmentation", "geotag")
+
+# Frames of the clip processed by the single frame benchmark (the GUI preview)
+PREVIEW_REPEATS = 5
+
+# Relative slowdown (or memory growth) over the baseline reported as a regression
+DEFAULT_TOLERANCE = 0.15
+
+DEFAULT_FIXTURES_DIR = os.path.join(tempfile.gettempdir(), "upc-benchmark")
+
+# Start of the synthetic tracks, the GPX times are relative to the first point anyway
+TRACK_START = datetime.datetime(2024, 6, 1, 8, 0, 0, tzinfo=datetime.timezone.utc)
+
+
+# Function to write a synthetic clip: a slowly moving color gradient with moving blocks, and a hard cut to
+# a second palette halfway through. The content only depends on the arguments, so every run gets the same
+# frames.
+def write_synthetic_video(path, width, height, frames, fps=SYNTHETIC_FPS, seed=0):
+    rng = np.random.default_rng(seed)
+    palettes = rng.integers(0, 256, size=(2, 6, 3), dtype=np.uint8)
+    block_sizes = rng.integers(min(width, height) // 10, min(width, height) // 4, size=6)
+    block_speeds = rng.uniform(-4, 4, size=(6, 2))
+    block_starts = rng.uniform(0, 1, size=(6, 2)) * (width, height)
+
+    x = np.linspace(0, 1, width, dtype=np.float32)
+    y = np.linspace(0, 1, height, dtype=np.float32)[:, np.newaxis]
+
+    fourcc = cv2.VideoWriter_fourcc(*'mp4v')
+    out = cv2.VideoWriter(path, fourcc, fps, (width, height))
+    frame = np.empty((height, width, 3), dtype=np.uint8)
+    try:
+        for frame_number in range(frames):
+            palette = palettes[0 if frame_number < frames // 2 else 1].astype(np.float32)
+            phase = frame_number / max(frames, 1)
+            mix = (x + y + phase) % 1.0
+            for channel in range(3):
+                frame[..., channel] = palette[0, channel] * (1 - mix) + palette[1, channel] * mix
+
+            for i, size in enumerate(block_sizes):
+                left, top = ((block_starts[i] + block_speeds[i] * frame_number) % (width, height)).astype(int)
+                frame[top:top + size, left:left + size] = palette[2 + i % 4]
+            out.write(frame)
+    finally:
+        out.release()
+
+
+# Function to write a synthetic GPX track covering duration seconds, one point per second along a gentle
+# curve with a changing elevation
+def write_synthetic_gpx(path, duration, seed=0):
+    rng = np.random.default_rng(seed)
+    heading = rng.uniform(0, 2 * np.pi)
+
+    gpx = gpxpy.gpx.GPX()
+    track = gpxpy.gpx.GPXTrack()
+    segment = gpxpy.gpx.GPXTrackSegment()
+    gpx.tracks.append(track)
+    track.segments.append(segment)
+
+    latitude, longitude = 45.4642, 9.19
+    for second in range(int(np.ceil(duration)) + 1):
+        heading += 0.02
+        latitude += 0.00005 * np.cos(heading)
+        longitude += 0.00005 * np.sin(heading)
+        segment.points.append(gpxpy.gpx.GPXTrackPoint(
+            latitude, longitude, elevation=120 + 10 * np.sin(second / 30),
+            time=TRACK_START + datetime.timedelta(seconds=second)))
+
+    with open(path, "w") as gpx_file:
+        gpx_file.write(gpx.to_xml())
+
+
+# Function to get the (video_path, gpx_path) of a fixture, generating synthetic ones in fixtures_dir the
+# first time they are needed
+def prepare_fixture(name, fixtures_dir=DEFAULT_FIXTURES_DIR):
+    if name == BUNDLED_FIXTURE:
+        return os.path.abspath(BUNDLED_VIDEO), os.path.abspath(BUNDLED_GPX)
+    if name not in FIXTURES:
+        raise ValueError(f"Unknown fixture: {name}")
+
+    width, height, frames = FIXTURES[name]
+    os.makedirs(fixtures_dir, exist_ok=True)
+    video_path = os.path.abspath(os.path.join(fixtures_dir, f"synthetic-{name}.mp4"))
+    gpx_path = os.path.abspath(os.path.join(fixtures_dir, f"synthetic-{name}.gpx"))
+    if not os.path.exists(video_path):
+        print(f"Generating {video_path}")
+        write_synthetic_video(video_path + ".tmp.mp4", width, height, frames)
+        os.replace(video_path + ".tmp.mp4", video_path)
+    if not os.path.exists(gpx_path):
+        write_synthetic_gpx(gpx_path, frames / SYNTHETIC_FPS)
+    return video_path, gpx_path
+
+
+# Progress callback recording when every stage of a run starts (see progress.ProgressTracker), from which
+# the time spent in each stage is derived
+class StageClock:
+    def __init__(self):
+        self.starts = []
+
+    def __call__(self, report):
+        if not self.starts or self.starts[-1][0] != report["stage"]:
+            self.starts.append((report["stage"], time.perf_counter()))
+
+    # Seconds per stage between start_time and end_time, "setup" being the time before the first stage
+    # (opening the video, loading the model...). A stage run twice is summed.
+    def durations(self, start_time, end_time):
+        stages = {}
+        times = [start_time] + [start for _, start in self.starts] + [end_time]
+        names = ["setup"] + [stage for stage, _ in self.starts]
+        for name, start, end in zip(names, times, times[1:]):
+            stages[name] = stages.get(name, 0.0) + end - start
+        return stages
+
+
+# Peak resident memory of this process and of its finished children, in MB (None where unavailable)
+def peak_rss_mb():
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss + resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    # Linux reports kilobytes, macOS bytes
+    return peak / (1024 * 1024) if sys.platform == "darwin" else peak / 1024
+
+
+# Function to run one mode on one fixture, in the current working directory. Returns the number of frames
+# processed and the StageClock of the run.
+def run_mode(mode, video_path, gpx_path, options):
+    clock = StageClock()
+    cap = cv2.VideoCapture(video_path)
+    frame_count = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
+    cap.release()
+    output_path = os.path.abspath(f"{mode}.mp4")
+
+    if mode == "cromaticon":
+        from processing import process_video
+        process_video(video_path, output_path, options["num_colors"], options["resize_factor"],
+                      options["smooth_factor"], fit_method=options["fit_method"], use_lut=options["use_lut"],
+                      workers=options["workers"], analysis_stride=options["analysis_stride"],
+                      change_threshold=options["change_threshold"], progress=clock)
+    elif mode == "cromaticon-frame":
+        from processing import process_frame
+        cap = cv2.VideoCapture(video_path)
+        cap.set(cv2.CAP_PROP_POS_FRAMES, frame_count // 2)
+        ret, frame = cap.read()
+        cap.release()
+        if not ret:
+            raise RuntimeError(f"Cannot read a frame of {video_path}")
+        clock({"stage": "preview"})
+        for _ in range(PREVIEW_REPEATS):
+            process_frame(frame, options["num_colors"], options["resize_factor"], options["smooth_factor"])
+        frame_count = PREVIEW_REPEATS
+    elif mode == "pixelate":
+        from pixelate_processing import pixelate_video
+        pixelate_video(video_path, output_path, options["num_sectors"], options["resize_factor"],
+                       workers=options["workers"], progress=clock)
+    elif mode == "segmentation":
+        from segmentation import run_segmentation
+        run_segmentation(os.path.join(options["root"], MODEL_PATH), os.path.join(options["root"], CLASSES_PATH),
+                         os.path.join(options["root"], CLASS_COLORS[options["target_class"]]), video_path,
+                         output_path, resize_factor=options["resize_factor"], workers=options["workers"],
+                         batch_size=options["batch_size"], backend=options["backend"],
+                         analysis_stride=options["analysis_stride"], change_threshold=options["change_threshold"],
+                         progress=clock)
+    elif mode == "geotag":
+        from gpx_handler import process_gpx
+        process_gpx(gpx_path, video_path, "benchmark", "benchmark", "benchmark", "benchmark", progress=clock)
+        video_name = os.path.splitext(os.path.basename(video_path))[0]
+        frame_count = len(os.listdir(os.path.join("outputs", video_name, "frames")))
+    else:
+        raise ValueError(f"Unknown benchmark mode: {mode}")
+    return frame_count, clock
+
+
+# Function to run a benchmark case in a fresh process, with a temporary working directory for its outputs.
+# With profile_path the case also runs under cProfile.
+def run_case(mode, fixture, video_path, gpx_path, options, profile_path=None):
+    with tempfile.TemporaryDirectory(prefix="upc-benchmark-") as workdir:
+        os.chdir(workdir)
+        try:
+            with instrumentation.recording(profile_path) as recorder:
+                start_time = time.perf_counter()
+                frames, clock = run_mode(mode, video_path, gpx_path, options)
+                end_time = time.perf_counter()
+        finally:
+            # The directory cannot be removed while it is the working directory on Windows
+            os.chdir(options["root"])
+
+    seconds = end_time - start_time
+    return {
+        "case": f"{mode}/{fixture}",
+        "mode": mode,
+        "fixture": fixture,
+        "frames": frames,
+        "seconds": seconds,
+        "fps": frames / seconds if seconds > 0 else None,
+        "peak_rss_mb": peak_rss_mb(),
+        "stages": clock.durations(start_time, end_time),
+        "instrumentation": recorder.summary(),
+    }
+
+
+# Function to run every case repeat times and keep the fastest run of each (the peak RSS is the largest
+# of all runs). With profile_dir the cProfile statistics of every case are saved there as {mode}-{fixture}.prof.
+def run_benchmarks(modes, fixtures, options, repeat=1, fixtures_dir=DEFAULT_FIXTURES_DIR, profile_dir=None):
+    results = []
+    context = get_context("spawn")
+    for fixture in fixtures:
+        video_path, gpx_path = prepare_fixture(fixture, fixtures_dir)
+        for mode in modes:
+            if mode == "segmentation" and not os.path.exists(os.path.join(options["root"], MODEL_PATH)):
+                print(f"Skipping {mode}/{fixture}: {MODEL_PATH} not found")
+                continue
+
+            profile_path = None
+            if profile_dir:
+                os.makedirs(profile_dir, exist_ok=True)
+                profile_path = os.path.abspath(os.path.join(profile_dir, f"{mode}-{fixture}.prof"))
+
+            best = None
+            for _ in range(repeat):
+                with ProcessPoolExecutor(max_workers=1, mp_context=context) as executor:
+                    result = executor.submit(run_case, mode, fixture, video_path, gpx_path, options,
+                                             profile_path).result()
+                if best is None or result["seconds"] < best["seconds"]:
+                    if best is not None and best["peak_rss_mb"] is not None:
+                        result["peak_rss_mb"] = max(result["peak_rss_mb"], best["peak_rss_mb"])
+                    best = result
+                elif result["peak_rss_mb"] is not None:
+                    best["peak_rss_mb"] = max(best["peak_rss_mb"], result["peak_rss_mb"])
+            print(format_result(best), flush=True)
+            results.append(best)
+    return results
+
+
+def environment():
+    return {
+        "platform": platform.platform(),
+        "machine": platform.machine(),
+        "cpus": os.cpu_count(),
+        "python": platform.python_version(),
+        "opencv": cv2.__version__,
+        "numpy": np.__version__,
+    }
+
+
+# Number of timers shown per case in the printed results, the JSON has all of them
+PRINTED_TIMERS = 5
+
+
+def format_result(result):
+    rss = "n/a" if result["peak_rss_mb"] is None else f"{result['peak_rss_mb']:.0f} MB"
+    timers = sorted(result["instrumentation"]["timers"].items(), key=lambda item: -item[1]["total"])
+    timings = ", ".join(f"{name} {stats['total']:.2f}s" for name, stats in timers[:PRINTED_TIMERS])
+    return f"{result['case']:<28} {result['seconds']:8.2f}s {result['fps'] or 0:8.1f} fps {rss:>8}  ({timings})"
+
+
+# Function to compare results with a baseline, returning one line per case and the cases that regressed
+def compare_results(results, baseline, tolerance=DEFAULT_TOLERANCE):
+    baseline_cases = {result["case"]: result for result in baseline["results"]}
+    lines = []
+    regressions = []
+    for result in results:
+        reference = baseline_cases.get(result["case"])
+        if reference is None:
+            lines.append(f"{result['case']:<28} not in the baseline")
+            continue
+
+        time_change = result["seconds"] / reference["seconds"] - 1
+        line = f"{result['case']:<28} time {time_change:+7.1%}"
+        regressed = time_change > tolerance
+        if result["peak_rss_mb"] is not None and reference.get("peak_rss_mb"):
+            memory_change = result["peak_rss_mb"] / reference["peak_rss_mb"] - 1
+            line += f"  peak RSS {memory_change:+7.1%}"
+            regressed = regressed or memory_change > tolerance
+        if regressed:
+            line += "  REGRESSION"
+            regressions.append(result["case"])
+        lines.append(line)
+    return lines, regressions
+
+
+def write_json(path, data):
+    with open(path + ".tmp", "w") as json_file:
+        json.dump(data, json_file, indent=4)
+    os.replace(path + ".tmp", path)
+
+
+def create_parser():
+    parser = argparse.ArgumentParser(prog="benchmark", description="Benchmarks of the processing modes")
+    parser.add_argument("--mode", dest="modes", action="append", choices=BENCHMARK_MODES,
+                        help="mode to benchmark, repeatable (default: all)")
+    parser.add_argument("--fixture", dest="fixtures", action="append", choices=list(FIXTURES) + [BUNDLED_FIXTURE],
+                        help=f"clip to process, repeatable (default: {', '.join(DEFAULT_FIXTURES)})")
+    parser.add_argument("--repeat", type=int, default=1, help="runs per case, the fastest is kept")
+    parser.add_argument("--fixtures-dir", default=DEFAULT_FIXTURES_DIR, help="where synthetic clips are generated")
+    parser.add_argument("--output", help="write the results to this JSON file")
+    parser.add_argument("--baseline", help="compare with the results in this JSON file")
+    parser.add_argument("--save-baseline", help="write the results as a baseline to this JSON file")
+    parser.add_argument("--profile-dir", help="run every case under cProfile and save the statistics here")
+    parser.add_argument("--tolerance", type=float, default=DEFAULT_TOLERANCE,
+                        help="relative slowdown reported as a regression (default 0.15)")
+    parser.add_argument("--resize", dest="resize_factor", type=int, default=5)
+    parser.add_argument("--colors", dest="num_colors", type=int, default=10)
+    parser.add_argument("--smooth", dest="smooth_factor", type=int, default=10)
+    parser.add_argument("--fit-method", dest="fit_method", default="reservoir")
+    parser.add_argument("--lut", dest="use_lut", action="store_true")
+    parser.add_argument("--sectors", dest="num_sectors", type=int, default=8)
+    parser.add_argument("--class", dest="target_class", choices=sorted(CLASS_COLORS), default="vegetation")
+    parser.add_argument("--batch-size", dest="batch_size", type=int, default=1)
+    parser.add_argument("--backend", default="default")
+    parser.add_argument("--workers", type=int, default=1)
+    parser.add_argument("--stride", dest="analysis_stride", type=int, default=1)
+    parser.add_argument("--change-threshold", dest="change_threshold", type=float, default=0.0)
+    return parser
+
+
+def main(argv=None):
+    args = create_parser().parse_args(argv)
+    options = {name: getattr(args, name) for name in ("resize_factor", "num_colors", "smooth_factor", "fit_method",
+                                                      "use_lut", "num_sectors", "target_class", "batch_size",
+                                                      "backend", "workers", "analysis_stride",
+                                                      "change_threshold")}
+    options["root"] = os.path.abspath(os.getcwd())
+
+    results = run_benchmarks(args.modes or BENCHMARK_MODES, args.fixtures or DEFAULT_FIXTURES, options,
+                             max(args.repeat, 1), args.fixtures_dir, args.profile_dir)
+    report = {"environment": environment(), "options": options, "results": results}
+    for path in (args.output, args.save_baseline):
+        if path:
+            write_json(path, report)
+
+    if args.baseline:
+        with open(args.baseline) as baseline_file:
+            baseline = json.load(baseline_file)
+        lines, regressions = compare_results(results, baseline, args.tolerance)
+        print(f"Compared with {args.baseline}:")
+        for line in lines:
+            print(line)
+        if regressions:
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,44 @@
+import threading
+
+import numpy as np
+
+
+# Reusable arrays for the per-frame loops. Every buffer has a name and is only allocated again when the
+# requested shape or dtype changes, so in steady state a loop allocates no full-size frame per iteration.
+# An array from the pool is overwritten by the next request of the same name: anything that has to outlive
+# the iteration must be copied.
+class BufferPool:
+    def __init__(self):
+        self.buffers = {}
+
+    def get(self, name, shape, dtype=np.uint8):
+        shape = tuple(shape)
+        buffer = self.buffers.get(name)
+        if buffer is None or buffer.shape != shape or buffer.dtype != dtype:
+            buffer = np.empty(shape, dtype=dtype)
+            self.buffers[name] = buffer
+        return buffer
+
+    # cap.read() into the buffer of that name, the capture allocates it on the first frame (or when the
+    # frame size changes) and the same array is reused afterwards
+    def read(self, cap, name="frame"):
+        buffer = self.buffers.get(name)
+        ret, frame = cap.read(image=buffer) if buffer is not None else cap.read()
+        if ret:
+            self.buffers[name] = frame
+        return ret, frame
+
+    def clear(self):
+        self.buffers.clear()
+
+
+_local = threading.local()
+
+
+# Function to get the BufferPool of the calling thread. Worker processes, pipeline stage threads and the
+# main loop each reuse their own buffers, so pooled functions are safe to call from several threads.
+def local_pool():
+    pool = getattr(_local, "pool", None)
+    if pool is None:
+        pool = _local.pool = BufferPool()
+    return pool
@@ -0,0 +1,71 @@
+import cv2
+import numpy as np
+
+# Temporal subsampling of the expensive per-frame steps (color assignment, segmentation network). At 60 fps
+# neighbouring frames are nearly identical, so only some frames are analysed: every analysis_stride-th frame,
+# and with a change_threshold also any frame that differs more than that from the last analysed one, so a
+# cut or a fast pan is not missed. analysis_stride is then the longest gap between two analysed frames.
+# The results of the frames in between are interpolated (color percentages) or held (class maps).
+DEFAULT_ANALYSIS_STRIDE = 1
+
+# Mean absolute difference between the grayscale thumbnails of two frames (0 for the same frame, 1 for
+# black against white), 0 disables the adaptive mode
+DEFAULT_CHANGE_THRESHOLD = 0.0
+
+# Size of the thumbnails compared by the adaptive mode, enough to see a cut but not the sensor noise
+THUMBNAIL_SIZE = (32, 18)
+
+
+def frame_thumbnail(frame):
+    gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
+    return cv2.resize(gray, THUMBNAIL_SIZE, interpolation=cv2.INTER_AREA).astype(np.float32) / 255
+
+
+def frame_difference(thumbnail, other):
+    return float(np.abs(thumbnail - other).mean())
+
+
+# Decides which frames of a stream are analysed, see above. Frames are passed one at a time in order, the
+# first frame is always analysed.
+class FrameSampler:
+    def __init__(self, analysis_stride=DEFAULT_ANALYSIS_STRIDE, change_threshold=DEFAULT_CHANGE_THRESHOLD):
+        self.analysis_stride = max(analysis_stride, 1)
+        self.change_threshold = change_threshold
+        self.frame_count = 0
+        self.frame_numbers = []  # Numbers of the analysed frames
+        self.reference = None  # Thumbnail of the last analysed frame
+
+    # Whether every frame is analysed, the callers then keep their usual per-frame path
+    @property
+    def every_frame(self):
+        return self.analysis_stride == 1
+
+    def add(self, frame):
+        frame_number = self.frame_count
+        self.frame_count += 1
+        analyse = (self.every_frame or not self.frame_numbers or
+                   frame_number - self.frame_numbers[-1] >= self.analysis_stride)
+
+        # Thumbnails are only needed when a frame may be analysed early, never when every frame is analysed
+        if self.change_threshold > 0 and not self.every_frame:
+            thumbnail = frame_thumbnail(frame)
+            if not analyse:
+                analyse = frame_difference(self.reference, thumbnail) > self.change_threshold
+            if analyse:
+                self.reference = thumbnail
+
+        if analyse:
+            self.frame_numbers.append(frame_number)
+        return analyse
+
+
+# Function to fill in the values of every frame (frame_count x ...) from the values of the analysed frames,
+# linearly interpolated in between and held before the first and after the last
+def interpolate_frames(frame_numbers, values, frame_count):
+    values = np.asarray(values, dtype=np.float64)
+    if len(frame_numbers) == frame_count:
+        return values
+    flat = values.reshape(len(values), -1)
+    frames = np.arange(frame_count)
+    interpolated = np.column_stack([np.interp(frames, frame_numbers, column) for column in flat.T])
+    return interpolated.reshape((frame_count,) + values.shape[1:])
@@ -2,18 +2,21 @@ import gpxpy
 from datetime import timedelta
 import os
 import cv2
-import json
+import numpy as np
+from contextlib import ExitStack
+from image_writer import ImageWriterPool, DEFAULT_QUALITY, DEFAULT_WRITER_THREADS
+from manifest import ManifestWriter
+from progress import ProgressTracker
+from video_probe import probe_video, read_frames
+from instrumentation import timer
 
-def process_gpx(gpx_path, video_path, author, device, category, process_mode):
-    video_name = os.path.splitext(os.path.basename(video_path))[0]
-    output_folder = os.path.join("outputs", video_name)
+# Seconds between two extracted frames
+DEFAULT_FRAME_INTERVAL = 2.0
 
-    os.makedirs(output_folder, exist_ok=True)
-
-    # Frames and JSON are saved inside the output folder
-    frames_folder = os.path.join(output_folder, "frames")
-    os.makedirs(frames_folder, exist_ok=True)
 
+# Function to load the track points of a GPX file as arrays. Times are seconds since the first point,
+# elevations are NaN where the GPX has none, and points without a time are skipped.
+def load_track(gpx_path):
     # Load the GPX file
     with open(gpx_path, 'r') as gpx_file:
         gpx = gpxpy.parse(gpx_file)
@@ -22,75 +25,193 @@ def process_gpx(gpx_path, video_path, author, device, category, process_mode):
     for track in gpx.tracks:
         for segment in track.segments:
             for point in segment.points:
-                points.append({
-                    "lat": point.latitude,
-                    "lon": point.longitude,
-                    "elevation": point.elevation,
-                    "time": point.time
-                })
+                if point.time is not None:
+                    points.append(point)
 
     if not points:
         raise ValueError("GPX file does not contain any points.")
 
-    video_capture = cv2.VideoCapture(video_path)
-    frame_rate = video_capture.get(cv2.CAP_PROP_FPS)
-    total_frames = int(video_capture.get(cv2.CAP_PROP_FRAME_COUNT))
-    video_start_time = points[0]["time"]
-    time_per_frame = timedelta(seconds=1 / frame_rate)
-    frame_times = [video_start_time + i * time_per_frame for i in range(total_frames)]
-
-    point_idx = 0
-    point_count = len(points)
-    extracted_frames = []
-    last_saved_time = video_start_time
-
-    for frame_number, frame_time in enumerate(frame_times):
-        success, frame = video_capture.read()
-        if not success:
+    start_time = points[0].time
+    times = np.array([(point.time - start_time).total_seconds() for point in points])
+    order = np.argsort(times, kind="stable")
+
+    track = {
+        "time": times[order],
+        "lat": np.array([point.latitude for point in points])[order],
+        "lon": np.array([point.longitude for point in points])[order],
+        "elevation": np.array([np.nan if point.elevation is None else point.elevation for point in points])[order],
+    }
+    return start_time, track
+
+
+# Function to compute the position at every requested time (seconds since the first point) in one pass.
+# Positions are interpolated linearly between the surrounding points and held at the ends of the track.
+# Gaps longer than max_gap seconds are not interpolated across: the position is held at the last point
+# before the gap. Elevations are interpolated between the points that have one.
+def interpolate_track(track, times, max_gap=None):
+    times = np.asarray(times, dtype=np.float64)
+    point_times = track["time"]
+
+    # Last point at or before every time, and the point after it
+    point_idx = np.clip(np.searchsorted(point_times, times, side="right") - 1, 0, len(point_times) - 1)
+    next_idx = np.minimum(point_idx + 1, len(point_times) - 1)
+
+    time_diff = point_times[next_idx] - point_times[point_idx]
+    interpolate = (time_diff > 0) & (times > point_times[point_idx])
+    if max_gap is not None:
+        interpolate &= time_diff <= max_gap
+    ratio = np.where(interpolate, (times - point_times[point_idx]) / np.where(time_diff > 0, time_diff, 1), 0)
+
+    lat = track["lat"][point_idx] + ratio * (track["lat"][next_idx] - track["lat"][point_idx])
+    lon = track["lon"][point_idx] + ratio * (track["lon"][next_idx] - track["lon"][point_idx])
+
+    known = ~np.isnan(track["elevation"])
+    if known.any():
+        # Held positions keep the elevation at the time of their point
+        elevation_times = np.where(interpolate, times, point_times[point_idx])
+        elevation = np.interp(elevation_times, point_times[known], track["elevation"][known])
+    else:
+        elevation = np.full(len(times), np.nan)
+
+    return lat, lon, elevation
+
+
+# Function to pick the frames to extract: the first frame at least interval seconds after the previous one
+def select_frames(frame_seconds, interval=DEFAULT_FRAME_INTERVAL):
+    targets = []
+    last_saved_seconds = 0.0
+    frame_number = 0
+
+    while frame_number < len(frame_seconds):
+        first_candidate = frame_number
+        frame_number = max(int(np.searchsorted(frame_seconds, last_saved_seconds + interval, side="left")),
+                           first_candidate)
+        # Settle float rounding on the same comparison as the previous frame-by-frame check
+        while frame_number > first_candidate and frame_seconds[frame_number - 1] - last_saved_seconds >= interval:
+            frame_number -= 1
+        while frame_number < len(frame_seconds) and frame_seconds[frame_number] - last_saved_seconds < interval:
+            frame_number += 1
+        if frame_number >= len(frame_seconds):
             break
 
-        if point_idx >= point_count:
-            break
+        targets.append(frame_number)
+        last_saved_seconds = frame_seconds[frame_number]
+        frame_number += 1
+
+    return np.array(targets, dtype=int)
+
+
+# Extracts the geotagged frames of one video: picks the frames to extract from its frame rate and length,
+# then writes the image and the manifest record of every frame handed to add() that is one of them.
+# Frames are encoded and written by a background ImageWriterPool (see image_writer.py) in image_format
+# ("jpg" or "webp") at the given quality, downscaled to thumbnail_width when set.
+# Records are journaled to {video_name}.ndjson as soon as they are produced and the final manifest is
+# written from the journal in manifest_format (see manifest.py) when the geotagger is closed. With
+# resume=True the frames whose image and record already exist from a previous run are not extracted again,
+# which also picks up a cancelled run.
+class FrameGeotagger:
+    def __init__(self, gpx_path, video_path, frame_rate, total_frames, author, device, category, process_mode,
+                 max_gap=None, interval=DEFAULT_FRAME_INTERVAL, image_format="jpg", quality=DEFAULT_QUALITY,
+                 thumbnail_width=None, writer_threads=DEFAULT_WRITER_THREADS, manifest_format="json", resume=False):
+        self.video_name = os.path.splitext(os.path.basename(video_path))[0]
+        output_folder = os.path.join("outputs", self.video_name)
+
+        os.makedirs(output_folder, exist_ok=True)
+
+        # Frames and JSON are saved inside the output folder
+        self.frames_folder = os.path.join(output_folder, "frames")
+        os.makedirs(self.frames_folder, exist_ok=True)
+
+        with timer("track"):
+            self.video_start_time, track = load_track(gpx_path)
+        self.metadata = {"author": author, "device": device, "category": category, "process": process_mode}
+
+        # Frames to extract and their position, the video starts at the first point of the track
+        self.frame_seconds = np.arange(total_frames) / frame_rate
+        frame_numbers = select_frames(self.frame_seconds, interval)
+        with timer("track"):
+            self.latitudes, self.longitudes, self.elevations = interpolate_track(
+                track, self.frame_seconds[frame_numbers], max_gap)
+        self.frame_index = {int(frame_number): i for i, frame_number in enumerate(frame_numbers)}
+
+        # The manifest is closed after the image writer, like two nested with statements
+        with ExitStack() as stack:
+            self.manifest = stack.enter_context(ManifestWriter(output_folder, self.video_name, manifest_format, resume))
+            self.image_writer = stack.enter_context(ImageWriterPool(image_format, quality, thumbnail_width,
+                                                                   writer_threads))
+            self.stack = stack.pop_all()
+
+        # Frames still to extract, in order
+        self.pending = [int(frame_number) for frame_number in frame_numbers]
+        if resume:
+            self.pending = [frame_number for frame_number in self.pending
+                            if not (self.manifest.has(frame_number) and
+                                    os.path.exists(os.path.join(self.frames_folder, self.frame_filename(frame_number))))]
+            print(f"Resuming: {len(self.frame_index) - len(self.pending)} frames already extracted")
+        self.targets = set(self.pending)
+
+    def frame_filename(self, frame_number):
+        return f"frame_{frame_number:04d}.{self.image_writer.extension}"
+
+    # Saves the frame if it is one of the frames to extract, returns whether it was
+    def add(self, frame_number, frame):
+        frame_number = int(frame_number)
+        if frame_number not in self.targets:
+            return False
+
+        i = self.frame_index[frame_number]
+        frame_time = self.video_start_time + timedelta(seconds=self.frame_seconds[frame_number])
+        filename = self.frame_filename(frame_number)
+        self.image_writer.put(os.path.join(self.frames_folder, filename), frame)
+
+        elevation = self.elevations[i]
+        self.manifest.write({
+            "frame_number": frame_number,
+            "image_url": f"/map/{self.video_name}/frames/{filename}",
+            "latitude": float(self.latitudes[i]),
+            "longitude": float(self.longitudes[i]),
+            "timestamp": frame_time.isoformat() + 'Z',
+            "elevation": None if np.isnan(elevation) else float(elevation),
+            **self.metadata
+        })
+        return True
+
+    # Waits for the images and writes the final manifest
+    def close(self):
+        self.stack.close()
+
+    # Waits for the images but keeps only the journal, for a failed or cancelled run
+    def abort(self):
+        self.stack.pop_all()
+        self.image_writer.abort()
+        self.manifest.abort()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return self.stack.__exit__(exc_type, exc_value, traceback)
+
+
+# Function to extract the geotagged frames of a video, decoding only the frames it needs (see
+# video_probe.EXTRACTION_MODES and FrameGeotagger for the options). progress and cancel are the optional progress callback
+# and cancellation token of progress.ProgressTracker.
+def process_gpx(gpx_path, video_path, author, device, category, process_mode, max_gap=None,
+                interval=DEFAULT_FRAME_INTERVAL, extraction="grab", image_format="jpg", quality=DEFAULT_QUALITY,
+                thumbnail_width=None, writer_threads=DEFAULT_WRITER_THREADS, manifest_format="json",
+                resume=False, progress=None, cancel=None):
+    tracker = ProgressTracker(progress, cancel)
 
-        while point_idx < point_count - 1 and points[point_idx + 1]["time"] <= frame_time:
-            point_idx += 1
-
-        point = points[point_idx]
-        if point_idx < point_count - 1:
-            next_point = points[point_idx + 1]
-            time_diff = (next_point["time"] - point["time"]).total_seconds()
-            if time_diff > 0:
-                ratio = (frame_time - point["time"]).total_seconds() / time_diff
-                lat = point["lat"] + ratio * (next_point["lat"] - point["lat"])
-                lon = point["lon"] + ratio * (next_point["lon"] - point["lon"])
-                elevation = point["elevation"] + ratio * (next_point["elevation"] - point["elevation"])
-            else:
-                lat, lon, elevation = point["lat"], point["lon"], point["elevation"]
-        else:
-            lat, lon, elevation = point["lat"], point["lon"], point["elevation"]
-
-        if (frame_time - last_saved_time).total_seconds() >= 2:
-            frame_filename = f"frame_{frame_number:04d}.jpg"
-            frame_path = os.path.join(frames_folder, frame_filename)
-            cv2.imwrite(frame_path, frame)
-
-            extracted_frames.append({
-                "frame_number": frame_number,
-                "image_url": f"/map/{video_name}/frames/{frame_filename}",
-                "latitude": lat,
-                "longitude": lon,
-                "timestamp": frame_time.isoformat() + 'Z',
-                "elevation": elevation,
-                "author": author,
-                "device": device,
-                "category": category,
-                "process": process_mode
-            })
-
-            last_saved_time = frame_time
-
-    json_output_path = os.path.join(output_folder, f"{video_name}.json")
-    with open(json_output_path, 'w') as json_file:
-        json.dump(extracted_frames, json_file, indent=4)
-
-    video_capture.release()
+    video_capture = cv2.VideoCapture(video_path)
+    video_info = probe_video(video_path, video_capture)
+
+    try:
+        with FrameGeotagger(gpx_path, video_path, video_info.fps, video_info.frame_count, author, device, category,
+                            process_mode, max_gap, interval, image_format, quality, thumbnail_width, writer_threads,
+                            manifest_format, resume) as geotagger:
+            tracker.start("extracting", len(geotagger.pending))
+            for frame_number, frame in read_frames(video_capture, geotagger.pending, extraction):
+                geotagger.add(frame_number, frame)
+                tracker.update()
+    finally:
+        video_capture.release()
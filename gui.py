@@ -1,10 +1,14 @@
 import cv2
 import os
+import threading
 import PySimpleGUI as sg
-from processing import process_video, process_frame
-from pixelate_processing import pixelate_video, pixelate_frame
-from gpx_handler import process_gpx
-from segmentation import run_segmentation
+from processing import process_frame
+from palette import PaletteState
+from pixelate_processing import pixelate_frame
+from segmentation import segment_frame
+from jobs import MODES, CLASS_COLORS, Job, run_job
+from progress import Cancelled, format_progress
+from video_probe import probe_video, DEFAULT_PREVIEW_POSITIONS
 
 # Set the GUI color theme and custom font
 sg.theme_background_color('#266850')
@@ -18,7 +22,7 @@ custom_font = ('assets/font/Trattatello.woff2', 12)
 custom_icon = 'assets/favicon.ico'
 
 # Function to create the layout
-def create_layout(process_mode='Cromaticon 3000', class_selection='Vegetation'):
+def create_layout(process_mode='Cromaticon 3000', class_selection='Vegetation', preview_position=DEFAULT_PREVIEW_POSITIONS // 2):
     layout = [
         [sg.Text("4KHD Ultra Paesaggio Continuo", font=custom_font, background_color='#266850')],
         [sg.Text("Select Processing Mode", font=custom_font, background_color='#266850'),
@@ -47,11 +51,17 @@ def create_layout(process_mode='Cromaticon 3000', class_selection='Vegetation'):
          sg.Combo(['Vegetation', 'Building', 'Sky'], default_value=class_selection, key="-CLASS_SELECTION-", enable_events=True, font=custom_font)],
 
         [sg.Image(key="-ORIGINAL_FRAME-"), sg.Image(key="-PROCESSED_FRAME-")],
+        [sg.Text("Preview Position", font=custom_font, background_color='#266850'),
+         sg.Slider(range=(0, DEFAULT_PREVIEW_POSITIONS - 1), default_value=preview_position, orientation='h',
+                   key="-SCRUB-", enable_events=True, background_color='#266850')],
         [sg.Radio("Use GPX", "RADIO1", key="-USE_GPX-", default=False, font=custom_font, background_color='#266850')],
         [sg.Text("Author:", font=custom_font, background_color='#266850'), sg.Input(key="-AUTHOR-", font=custom_font)],
         [sg.Text("Device:", font=custom_font, background_color='#266850'), sg.Input(key="-DEVICE-", font=custom_font)],
         [sg.Text("Category:", font=custom_font, background_color='#266850'), sg.Input(key="-CATEGORY-", font=custom_font)],
-        [sg.Button("Preview", font=custom_font), sg.Button("Process", font=custom_font), sg.Button("Exit", font=custom_font)]
+        [sg.ProgressBar(1000, orientation='h', size=(30, 15), key="-PROGRESS-"),
+         sg.Text("", size=(50, 1), key="-STATUS-", font=custom_font, background_color='#266850')],
+        [sg.Button("Preview", font=custom_font), sg.Button("Process", font=custom_font),
+         sg.Button("Cancel", font=custom_font), sg.Button("Exit", font=custom_font)]
     ]
 
     # Modify layout based on process mode
@@ -74,8 +84,29 @@ layout = create_layout()
 window = sg.Window("4KHD Ultra Paesaggio Continuo", layout, icon=custom_icon)
 
 video_path, gpx_path = None, None
+video_info = None  # Probed metadata and cached preview frames of the selected video, see video_probe.py
+preview_position = DEFAULT_PREVIEW_POSITIONS // 2  # Scrubber position, the middle of the video by default
+worker, cancel_event = None, None  # Background run started by "Process" and its cancellation token
+palette_state = PaletteState()  # Warm-starts and caches the Cromaticon previews
 colors_path = "enet-cityscapes/enet-colors-vegetation.txt"  # Default to Vegetation
 
+# Function to show a frame in one of the two preview images
+def show_frame(key, frame):
+    window[key].update(data=cv2.imencode('.png', cv2.resize(frame, (320, 240)))[1].tobytes())
+
+# Function to run a job on the worker thread, progress and the outcome come back to the event loop as events.
+# window is looked up when the events are sent, as switching mode replaces it.
+def run_in_background(job, cancel):
+    try:
+        run_job(job, force=True, progress=lambda report: window.write_event_value("-PROGRESS_EVENT-", report),
+                cancel=cancel)
+        outcome = "done"
+    except Cancelled:
+        outcome = "cancelled"
+    except Exception as error:
+        outcome = f"failed: {error}"
+    window.write_event_value("-JOB_DONE-", outcome)
+
 # Event loop
 while True:
     event, values = window.read()
@@ -85,15 +116,21 @@ while True:
 
     if event == "-VIDEO-":
         video_path = values["-VIDEO-"]
-        # Automatically preview the video upon upload
-        cap = cv2.VideoCapture(video_path)
-        total_frames = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
-        cap.set(cv2.CAP_PROP_POS_FRAMES, total_frames // 2)
-        ret, frame = cap.read()
-        if ret:
-            original_frame = cv2.resize(frame, (320, 240))
-            window["-ORIGINAL_FRAME-"].update(data=cv2.imencode('.png', original_frame)[1].tobytes())
-        cap.release()
+        video_info = probe_video(video_path) if os.path.isfile(video_path) else None
+        if video_info is not None:
+            # Automatically preview the video upon upload, the other scrubber positions are decoded in the background
+            frame = video_info.preview_frame(preview_position)
+            if frame is not None:
+                show_frame("-ORIGINAL_FRAME-", frame)
+            threading.Thread(target=video_info.preload_previews, daemon=True).start()
+
+    # Move the preview to another position of the video, the frames are decoded once per video
+    if event == "-SCRUB-":
+        preview_position = int(values["-SCRUB-"])
+        if video_info is not None:
+            frame = video_info.preview_frame(preview_position)
+            if frame is not None:
+                show_frame("-ORIGINAL_FRAME-", frame)
 
     if event == "-GPX-":
         gpx_path = values["-GPX-"]
@@ -110,20 +147,15 @@ while True:
 
     # Handle the mode switch between Dominant Colors, Pixelation, Segmentation, and Original
     if event == "-PROCESS_MODE-":
-        new_layout = create_layout(values["-PROCESS_MODE-"], values.get("-CLASS_SELECTION-", 'Vegetation'))
+        new_layout = create_layout(values["-PROCESS_MODE-"], values.get("-CLASS_SELECTION-", 'Vegetation'), preview_position)
         window.close()  # Close the current window
         window = sg.Window("4KHD Ultra Paesaggio Continuo", new_layout, icon=custom_icon)  # Create a new window with the new layout
 
-    if event == "Preview" and video_path and values["-PROCESS_MODE-"] != ".geopeg":
-        cap = cv2.VideoCapture(video_path)
-        total_frames = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
-        cap.set(cv2.CAP_PROP_POS_FRAMES, total_frames // 2)
-        ret, frame = cap.read()
-        if ret:
-            original_frame = cv2.resize(frame, (320, 240))  # Resize for displaying in the GUI
-
+    if event == "Preview" and video_info is not None and values["-PROCESS_MODE-"] != ".geopeg":
+        frame = video_info.preview_frame(preview_position)
+        if frame is not None:
             # Ensure only the original frame is displayed on the left
-            window["-ORIGINAL_FRAME-"].update(data=cv2.imencode('.png', original_frame)[1].tobytes())
+            show_frame("-ORIGINAL_FRAME-", frame)
 
             # Process frame based on selected mode and display in the processed frame window
             if values["-PROCESS_MODE-"] != ".geopeg":
@@ -132,7 +164,8 @@ while True:
             if values["-PROCESS_MODE-"] == "Cromaticon 3000":
                 num_colors = int(values["-NUM_COLORS-"])
                 smooth_factor = int(values["-SMOOTH-"])  # Use the Smooth Factor for Cromaticon 3000
-                processed_frame = process_frame(frame, num_colors, resize_factor, smooth_factor)
+                processed_frame = process_frame(frame, num_colors, resize_factor, smooth_factor, palette_state,
+                                                frame_key=(video_path, video_info.preview_frame_number(preview_position)))
 
             elif values["-PROCESS_MODE-"] == "Piastrellificio.px":
                 num_sectors = int(values["-NUM_SECTORS-"])
@@ -141,69 +174,68 @@ while True:
             elif values["-PROCESS_MODE-"] == "Segmentatore Bugiardo Semantico":
                 model_path = "enet-cityscapes/enet-model.net"
                 classes_path = "enet-cityscapes/enet-classes.txt"
-                processed_frame = run_segmentation(model_path, classes_path, colors_path, video_path, "", resize_factor,
-                                                   preview=True)
+                processed_frame = segment_frame(frame, model_path, classes_path, colors_path, resize_factor)
 
             # If a processed frame was generated, display it in the processed frame window
             if processed_frame is not None:
-                processed_frame_resized = cv2.resize(processed_frame, (320, 240))
-                window["-PROCESSED_FRAME-"].update(data=cv2.imencode('.png', processed_frame_resized)[1].tobytes())
-
-        cap.release()
+                show_frame("-PROCESSED_FRAME-", processed_frame)
 
     if event == "Process" and video_path:
-        video_name = os.path.splitext(os.path.basename(video_path))[0]
-
-        # Determine the output folder based on the processing mode
-        process_mode_name = values["-PROCESS_MODE-"].replace("<", "").replace(">",
-                                                                              "")  # Remove invalid characters for folder names
-
-        if values["-PROCESS_MODE-"] == ".geopeg":
-            # Special case for .geopeg: no '_processed' suffix, just the video name as the folder
-            output_video_folder = os.path.join("outputs", video_name)
-            output_video_path = os.path.join(output_video_folder, f"{video_name}.mp4")
-        else:
-            # For other modes, use the normal naming convention
-            output_video_folder = os.path.join("outputs", f"{video_name}_{process_mode_name}")
-            output_video_path = os.path.join(output_video_folder, f"{video_name}_{process_mode_name}.mp4")
-
-        # Ensure the output folder exists
-        os.makedirs(output_video_folder, exist_ok=True)
-
-        use_gpx = values["-USE_GPX-"]
+        if worker is not None and worker.is_alive():
+            sg.popup_no_buttons("A video is already being processed", auto_close=True, no_titlebar=True,
+                                background_color='#283b5b')
+            continue
+
+        # The job writes to the same outputs/ folders as before, see jobs.Job
+        mode = {name: key for key, name in MODES.items()}[values["-PROCESS_MODE-"]]
+        options = dict(author=values["-AUTHOR-"], device=values["-DEVICE-"], category=values["-CATEGORY-"],
+                       target_class={path: name for name, path in CLASS_COLORS.items()}[colors_path])
+        if values["-USE_GPX-"] and gpx_path:
+            options["gpx_path"] = gpx_path
 
         if values["-PROCESS_MODE-"] != ".geopeg":
-            resize_factor = int(values["-RESIZE-"])  # Unified Resize Factor
-
-        # Process the video based on the selected mode
+            options["resize_factor"] = int(values["-RESIZE-"])  # Unified Resize Factor
         if values["-PROCESS_MODE-"] == "Cromaticon 3000":
-            num_colors = int(values["-NUM_COLORS-"])
-            smooth_factor = int(values["-SMOOTH-"])  # Use the Smooth Factor for Cromaticon 3000
-            process_video(video_path, output_video_path, num_colors, resize_factor, smooth_factor)
-            if use_gpx and gpx_path:
-                gpx_data = process_gpx(gpx_path, output_video_path, values["-AUTHOR-"], values["-DEVICE-"],
-                                       values["-CATEGORY-"], values["-PROCESS_MODE-"])
-
+            options["num_colors"] = int(values["-NUM_COLORS-"])
+            options["smooth_factor"] = int(values["-SMOOTH-"])  # Use the Smooth Factor for Cromaticon 3000
         elif values["-PROCESS_MODE-"] == "Piastrellificio.px":
-            num_sectors = int(values["-NUM_SECTORS-"])
-            pixelate_video(video_path, output_video_path, num_sectors, resize_factor)
-            if use_gpx and gpx_path:
-                gpx_data = process_gpx(gpx_path, output_video_path, values["-AUTHOR-"], values["-DEVICE-"],
-                                       values["-CATEGORY-"], values["-PROCESS_MODE-"])
-
-        elif values["-PROCESS_MODE-"] == "Segmentatore Bugiardo Semantico":
-            model_path = "enet-cityscapes/enet-model.net"
-            classes_path = "enet-cityscapes/enet-classes.txt"
-            run_segmentation(model_path, classes_path, colors_path, video_path, output_video_path=output_video_path,
-                             resize_factor=resize_factor)
-            if use_gpx and gpx_path:
-                gpx_data = process_gpx(gpx_path, output_video_path, values["-AUTHOR-"], values["-DEVICE-"],
-                                       values["-CATEGORY-"], values["-PROCESS_MODE-"])
-
-        elif values["-PROCESS_MODE-"] == ".geopeg":
-            if use_gpx and gpx_path:
-                gpx_data = process_gpx(gpx_path, video_path, values["-AUTHOR-"], values["-DEVICE-"],
-                                       values["-CATEGORY-"], values["-PROCESS_MODE-"])
-
-        sg.popup_no_buttons(f"Video processing ended! Siu siu siu :)", auto_close=True, no_titlebar=True,
-                            background_color='#283b5b')
+            options["num_sectors"] = int(values["-NUM_SECTORS-"])
+        # Moving the smooth slider re-renders from the analysis of the previous run. The Cromaticon entries are a
+        # few color percentages per frame, the segmentation ones hold a full class map per frame and stay opt-in
+        if values["-PROCESS_MODE-"] == "Cromaticon 3000":
+            options["cache"] = True
+
+        # Run on a worker thread so the window stays responsive, progress arrives as -PROGRESS_EVENT-
+        cancel_event = threading.Event()
+        worker = threading.Thread(target=run_in_background, args=(Job(video_path, mode, **options), cancel_event))
+        worker.start()
+        window["-STATUS-"].update("Starting...")
+
+    if event == "Cancel" and worker is not None and worker.is_alive():
+        cancel_event.set()
+        window["-STATUS-"].update("Cancelling...")
+
+    if event == "-PROGRESS_EVENT-":
+        report = values[event]
+        if report["total"]:
+            window["-PROGRESS-"].update(current_count=int(1000 * report["done"] / report["total"]))
+        window["-STATUS-"].update(format_progress(report))
+
+    if event == "-JOB_DONE-":
+        outcome = values[event]
+        window["-PROGRESS-"].update(current_count=0)
+        window["-STATUS-"].update("")
+        if outcome == "done":
+            sg.popup_no_buttons(f"Video processing ended! Siu siu siu :)", auto_close=True, no_titlebar=True,
+                                background_color='#283b5b')
+        elif outcome == "cancelled":
+            sg.popup_no_buttons("Video processing cancelled", auto_close=True, no_titlebar=True,
+                                background_color='#283b5b')
+        else:
+            sg.popup_error(f"Video processing {outcome}")
+
+# Stop a run still in progress before leaving, so its files are closed properly
+if worker is not None and worker.is_alive():
+    cancel_event.set()
+    worker.join()
+window.close()
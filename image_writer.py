@@ -0,0 +1,88 @@
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import cv2
+
+from instrumentation import timed
+
+# Image formats the writer can encode, with the OpenCV quality flag of each
+IMAGE_FORMATS = {
+    "jpg": cv2.IMWRITE_JPEG_QUALITY,
+    "webp": cv2.IMWRITE_WEBP_QUALITY,
+}
+
+# Same quality as cv2.imwrite uses for JPEG by default
+DEFAULT_QUALITY = 95
+
+DEFAULT_WRITER_THREADS = 4
+
+# Images encoded or waiting to be encoded at the same time, put() blocks beyond that
+DEFAULT_MAX_PENDING = 16
+
+
+# Encodes images with cv2.imencode and writes them to disk on a pool of threads, so that the decode loop
+# does not wait for the encoder or the disk. OpenCV releases the GIL while encoding.
+# thumbnail_width downscales wider images before encoding. close() waits for every write and raises the
+# first error.
+class ImageWriterPool:
+    def __init__(self, image_format="jpg", quality=DEFAULT_QUALITY, thumbnail_width=None,
+                 threads=DEFAULT_WRITER_THREADS, max_pending=DEFAULT_MAX_PENDING):
+        if image_format not in IMAGE_FORMATS:
+            raise ValueError(f"Unknown image format: {image_format}")
+
+        self.image_format = image_format
+        self.params = [IMAGE_FORMATS[image_format], int(quality)]
+        self.thumbnail_width = thumbnail_width
+
+        self.executor = ThreadPoolExecutor(max_workers=threads, thread_name_prefix="image-writer")
+        self.pending = threading.BoundedSemaphore(max_pending)
+        self.errors = []
+
+    @property
+    def extension(self):
+        return self.image_format
+
+    # The image is copied, so the caller can reuse its buffer right away
+    def put(self, path, image):
+        self.pending.acquire()
+        future = self.executor.submit(self._write, path, image.copy())
+        future.add_done_callback(self._done)
+
+    @timed("image_write")
+    def _write(self, path, image):
+        if self.thumbnail_width and image.shape[1] > self.thumbnail_width:
+            height = round(image.shape[0] * self.thumbnail_width / image.shape[1])
+            image = cv2.resize(image, (self.thumbnail_width, height), interpolation=cv2.INTER_AREA)
+
+        success, data = cv2.imencode("." + self.image_format, image, self.params)
+        if not success:
+            raise IOError(f"Could not encode {path}")
+        # Written under a temporary name and renamed, so an existing image is always complete
+        with open(path + ".tmp", "wb") as image_file:
+            image_file.write(data.tobytes())
+        os.replace(path + ".tmp", path)
+
+    def _done(self, future):
+        self.pending.release()
+        if future.exception() is not None:
+            self.errors.append(future.exception())
+
+    def close(self):
+        self.executor.shutdown(wait=True)
+        if self.errors:
+            raise self.errors[0]
+
+    def __enter__(self):
+        return self
+
+    # Waits for the writes without raising their errors, for a run that already failed
+    def abort(self):
+        self.executor.shutdown(wait=True)
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            # Keep the original error, the writes still finish
+            self.abort()
@@ -0,0 +1,251 @@
+import cProfile
+import functools
+import json
+import math
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+# Timers, counters and histograms of the processing loops, off by default. The loops always call timer(),
+# count() and observe(): while nothing is recording they return at once, so the cost is one function call.
+#
+#   with instrumentation.recording() as recorder:
+#       pixelate_video(...)
+#   print(instrumentation.format_summary(recorder.summary()))
+#
+# Timer names used by the processing modules:
+#   decode, seek:    reading frames from the source, skipping frames without decoding them (geotag)
+#   resize:          downscaling frames with cv2.resize
+#   palette_sample:  adding frames to the palette fit (palette.PaletteFitter.add)
+#   fit:             fitting the palette with KMeans
+#   assign:          assigning pixels to the palette colors (palette.calculate_color_percentages)
+#   render:          drawing output frames (color bars, pixelated frames, segmentation masks)
+#   blob, forward:   building the network input, running the network (net.forward)
+#   encode:          writing output frames with cv2.VideoWriter.write
+#   image_write:     encoding and writing a geotagged frame (on the image writer threads)
+#   wait_workers:    waiting for worker processes in parallel runs (map_frames with workers > 1)
+# Only the process that records is measured: with workers > 1 the per-frame work of the worker processes
+# shows up as wait_workers.
+
+# Histogram buckets per doubling of the value, about 19% apart
+BUCKETS_PER_OCTAVE = 4
+
+_recorder = None
+
+
+# Count, total, extremes and log-spaced buckets of a series of values, in constant memory whatever the
+# number of values. Percentiles are estimated from the buckets.
+class Histogram:
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.min = math.inf
+        self.max = -math.inf
+        self.buckets = {}
+
+    def add(self, value):
+        self.count += 1
+        self.total += value
+        self.min = min(self.min, value)
+        self.max = max(self.max, value)
+        bucket = math.floor(math.log2(value) * BUCKETS_PER_OCTAVE) if value > 0 else None
+        self.buckets[bucket] = self.buckets.get(bucket, 0) + 1
+
+    def percentile(self, fraction):
+        if not self.count:
+            return None
+        rank = fraction * self.count
+        seen = 0
+        # Zero and negative values (bucket None) come first
+        for bucket in sorted(self.buckets, key=lambda bucket: -math.inf if bucket is None else bucket):
+            seen += self.buckets[bucket]
+            if seen >= rank:
+                upper = 0.0 if bucket is None else 2 ** ((bucket + 1) / BUCKETS_PER_OCTAVE)
+                return min(max(upper, self.min), self.max)
+        return self.max
+
+    def summary(self):
+        if not self.count:
+            return {"count": 0}
+        return {
+            "count": self.count,
+            "total": self.total,
+            "mean": self.total / self.count,
+            "min": self.min,
+            "p50": self.percentile(0.5),
+            "p95": self.percentile(0.95),
+            "max": self.max,
+        }
+
+
+# Everything recorded during one run. The loops of a pipeline run on several threads, so every update
+# takes the lock.
+class Recorder:
+    def __init__(self):
+        self.timers = {}
+        self.counters = {}
+        self.histograms = {}
+        self.lock = threading.Lock()
+        self.start_time = time.perf_counter()
+        self.end_time = None
+
+    def add_time(self, name, seconds):
+        with self.lock:
+            histogram = self.timers.get(name)
+            if histogram is None:
+                histogram = self.timers[name] = Histogram()
+            histogram.add(seconds)
+
+    def count(self, name, amount=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + amount
+
+    def observe(self, name, value):
+        with self.lock:
+            histogram = self.histograms.get(name)
+            if histogram is None:
+                histogram = self.histograms[name] = Histogram()
+            histogram.add(value)
+
+    # Plain dict of the run, for JSON: times are in seconds
+    def summary(self):
+        end_time = self.end_time if self.end_time is not None else time.perf_counter()
+        with self.lock:
+            return {
+                "wall_time": end_time - self.start_time,
+                "timers": {name: histogram.summary() for name, histogram in sorted(self.timers.items())},
+                "counters": dict(sorted(self.counters.items())),
+                "histograms": {name: histogram.summary() for name, histogram in sorted(self.histograms.items())},
+            }
+
+
+class _Timer:
+    __slots__ = ("name", "start")
+
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        recorder = _recorder
+        if recorder is not None:
+            recorder.add_time(self.name, time.perf_counter() - self.start)
+
+
+class _NullTimer:
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return None
+
+
+_NULL_TIMER = _NullTimer()
+
+
+def enabled():
+    return _recorder is not None
+
+
+# Context manager timing its block under name
+def timer(name):
+    if _recorder is None:
+        return _NULL_TIMER
+    return _Timer(name)
+
+
+# Decorator timing every call of a function under name (the function name by default). The wrapper is a
+# regular frame named after the function, so profilers and py-spy show the same names.
+def timed(name=None):
+    def decorator(func):
+        timer_name = name or func.__name__
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if _recorder is None:
+                return func(*args, **kwargs)
+            with _Timer(timer_name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def count(name, amount=1):
+    recorder = _recorder
+    if recorder is not None:
+        recorder.count(name, amount)
+
+
+def observe(name, value):
+    recorder = _recorder
+    if recorder is not None:
+        recorder.observe(name, value)
+
+
+# Function to start recording in this process, returns the new Recorder
+def enable():
+    global _recorder
+    _recorder = Recorder()
+    return _recorder
+
+
+# Function to stop recording, returns the Recorder that was recording (None if none was)
+def disable():
+    global _recorder
+    recorder, _recorder = _recorder, None
+    if recorder is not None:
+        recorder.end_time = time.perf_counter()
+    return recorder
+
+
+# Records everything inside the block. With profile_path the block also runs under cProfile and the
+# statistics are written there (readable with pstats, snakeviz...).
+@contextmanager
+def recording(profile_path=None):
+    recorder = enable()
+    profiler = None
+    if profile_path:
+        profiler = cProfile.Profile()
+        profiler.enable()
+    try:
+        yield recorder
+    finally:
+        if profiler is not None:
+            profiler.disable()
+            profiler.dump_stats(profile_path)
+        disable()
+
+
+# Function to format a summary as a table, timers sorted by total time
+def format_summary(summary):
+    lines = [f"Wall time {summary['wall_time']:.2f}s"]
+    timers = sorted(summary["timers"].items(), key=lambda item: -item[1]["total"])
+    if timers:
+        lines.append(f"{'timer':<20} {'calls':>8} {'total s':>9} {'share':>6} {'mean ms':>9} {'p95 ms':>9} "
+                     f"{'max ms':>9}")
+        for name, stats in timers:
+            share = stats["total"] / summary["wall_time"] if summary["wall_time"] > 0 else 0
+            lines.append(f"{name:<20} {stats['count']:>8} {stats['total']:>9.3f} {share:>6.0%} "
+                         f"{1000 * stats['mean']:>9.3f} {1000 * stats['p95']:>9.3f} {1000 * stats['max']:>9.3f}")
+    if summary["counters"]:
+        lines.append(f"{'counter':<20} {'value':>8}")
+        for name, value in summary["counters"].items():
+            lines.append(f"{name:<20} {value:>8}")
+    if summary["histograms"]:
+        lines.append(f"{'histogram':<20} {'count':>8} {'mean':>9} {'p50':>9} {'p95':>9} {'max':>9}")
+        for name, stats in summary["histograms"].items():
+            lines.append(f"{name:<20} {stats['count']:>8} {stats['mean']:>9.2f} {stats['p50']:>9.2f} "
+                         f"{stats['p95']:>9.2f} {stats['max']:>9.2f}")
+    return "\n".join(lines)
+
+
+def write_summary(path, summary):
+    with open(path + ".tmp", "w") as json_file:
+        json.dump(summary, json_file, indent=4)
+    os.replace(path + ".tmp", path)
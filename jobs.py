@@ -0,0 +1,347 @@
+import json
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from functools import partial
+
+from processing import process_video
+from palette import DEFAULT_MAX_SAMPLES
+from pixelate_processing import pixelate_video
+from gpx_handler import process_gpx, FrameGeotagger, DEFAULT_FRAME_INTERVAL
+from segmentation import run_segmentation
+from image_writer import DEFAULT_QUALITY
+from progress import ProgressPrinter
+from analysis_cache import AnalysisCache
+from pipeline import run_pipeline, CromaticonStage, PixelateStage, SegmentationStage, GeotagStage
+
+# Command line names of the processing modes and the names used by the GUI (and in the output folders)
+MODES = {
+    "cromaticon": "Cromaticon 3000",
+    "pixelate": "Piastrellificio.px",
+    "geotag": ".geopeg",
+    "segmentation": "Segmentatore Bugiardo Semantico",
+}
+
+MODEL_PATH = "enet-cityscapes/enet-model.net"
+CLASSES_PATH = "enet-cityscapes/enet-classes.txt"
+CLASS_COLORS = {
+    "vegetation": "enet-cityscapes/enet-colors-vegetation.txt",
+    "building": "enet-cityscapes/enet-colors-building.txt",
+    "sky": "enet-cityscapes/enet-colors-sky.txt",
+}
+
+VIDEO_EXTENSIONS = (".mp4", ".mov", ".avi", ".mkv", ".m4v")
+
+# Job options and their defaults, the same as the GUI sliders
+DEFAULT_OPTIONS = {
+    "resize_factor": 5,
+    "num_colors": 10,
+    "smooth_factor": 10,
+    "num_sectors": 8,
+    "target_class": "vegetation",
+    "fit_method": "reservoir",
+    "max_samples": DEFAULT_MAX_SAMPLES,
+    "streaming": False,
+    "use_lut": False,
+    "scenes": False,
+    "analysis_stride": 1,
+    "change_threshold": 0.0,
+    "batch_size": 1,  # No effect on models with segmentation.UNBATCHED_LAYER_TYPES, such as the bundled ENet
+    "backend": "default",
+    "num_threads": None,
+    "gpx_path": None,
+    "author": "",
+    "device": "",
+    "category": "",
+    "interval": DEFAULT_FRAME_INTERVAL,
+    "max_gap": None,  # None interpolates across every gap of the track, see gpx_handler.interpolate_track
+    "image_format": "jpg",
+    "quality": DEFAULT_QUALITY,
+    "thumbnail_width": None,
+    "manifest_format": "json",
+    "workers": 1,
+    "resume": False,
+    "cache": False,
+}
+
+# Options that change how a job runs but not what it writes, ignored by the up-to-date check
+EXECUTION_OPTIONS = ("workers", "resume", "cache", "num_threads")
+
+# Manifest written by process_gpx for each manifest format
+MANIFEST_EXTENSIONS = {"json": ".json", "ndjson": ".ndjson", "columnar": ".columns.json"}
+
+
+# One video processed in one mode. Output paths follow the GUI: outputs/{video}_{mode}/{video}_{mode}.mp4,
+# and outputs/{video}/{video}.json for .geopeg.
+class Job:
+    def __init__(self, video_path, mode, **options):
+        if mode not in MODES:
+            raise ValueError(f"Unknown mode: {mode}")
+        unknown = set(options) - set(DEFAULT_OPTIONS)
+        if unknown:
+            raise ValueError(f"Unknown job options: {', '.join(sorted(unknown))}")
+        if options.get("target_class", "vegetation") not in CLASS_COLORS:
+            raise ValueError(f"Unknown class: {options['target_class']}")
+
+        self.video_path = video_path
+        self.mode = mode
+        self.options = dict(DEFAULT_OPTIONS, **options)
+        self.video_name = os.path.splitext(os.path.basename(video_path))[0]
+
+    @property
+    def mode_name(self):
+        return MODES[self.mode]
+
+    @property
+    def output_path(self):
+        if self.mode == "geotag":
+            return self.manifest_path(self.video_path)
+        output_name = f"{self.video_name}_{self.mode_name}"
+        return os.path.join("outputs", output_name, f"{output_name}.mp4")
+
+    # Manifest process_gpx writes for the frames of video_path
+    def manifest_path(self, video_path):
+        name = os.path.splitext(os.path.basename(video_path))[0]
+        return os.path.join("outputs", name, name + MANIFEST_EXTENSIONS[self.options["manifest_format"]])
+
+    @property
+    def stamp_path(self):
+        return self.output_path + ".job.json"
+
+    def describe(self):
+        return f"{self.video_name} ({self.mode})"
+
+    def targets(self):
+        targets = [self.output_path]
+        if self.mode != "geotag" and self.options["gpx_path"]:
+            targets.append(self.manifest_path(self.output_path))
+        return targets
+
+    def inputs(self):
+        return [path for path in (self.video_path, self.options["gpx_path"]) if path]
+
+    # Everything that decides the content of the outputs
+    def signature(self):
+        options = {key: value for key, value in self.options.items() if key not in EXECUTION_OPTIONS}
+        return {"video_path": os.path.abspath(self.video_path), "mode": self.mode, "options": options}
+
+    # The outputs exist, are newer than the inputs and were written with the same settings
+    def is_up_to_date(self):
+        if not all(os.path.exists(path) for path in self.targets() + [self.stamp_path]):
+            return False
+        with open(self.stamp_path, 'r') as stamp_file:
+            try:
+                if json.load(stamp_file) != self.signature():
+                    return False
+            except ValueError:
+                return False
+        oldest_output = min(os.path.getmtime(path) for path in self.targets())
+        newest_input = max(os.path.getmtime(path) for path in self.inputs())
+        return oldest_output >= newest_input
+
+    def check(self):
+        if self.mode == "geotag" and not self.options["gpx_path"]:
+            raise ValueError(".geopeg needs a GPX file")
+
+    def write_stamp(self):
+        with open(self.stamp_path, 'w') as stamp_file:
+            json.dump(self.signature(), stamp_file, indent=4)
+
+
+# Function to run one job, returns "skipped" when its outputs are already up to date.
+# progress and cancel are passed to the processing functions, see progress.ProgressTracker.
+def run_job(job, force=False, progress=None, cancel=None):
+    options = job.options
+    job.check()
+
+    if not force and job.is_up_to_date():
+        return "skipped"
+
+    geotagger = job_geotagger(job)
+
+    if job.mode != "geotag":
+        os.makedirs(os.path.dirname(job.output_path), exist_ok=True)
+    cache = AnalysisCache() if options["cache"] else None
+
+    if job.mode == "cromaticon":
+        process_video(job.video_path, job.output_path, options["num_colors"], options["resize_factor"],
+                      options["smooth_factor"], streaming=options["streaming"], fit_method=options["fit_method"],
+                      max_samples=options["max_samples"], use_lut=options["use_lut"], workers=options["workers"],
+                      scenes=options["scenes"],
+                      analysis_stride=options["analysis_stride"], change_threshold=options["change_threshold"],
+                      cache=cache, geotagger=geotagger, progress=progress, cancel=cancel)
+    elif job.mode == "pixelate":
+        pixelate_video(job.video_path, job.output_path, options["num_sectors"], options["resize_factor"],
+                       workers=options["workers"], geotagger=geotagger, progress=progress, cancel=cancel)
+    elif job.mode == "segmentation":
+        run_segmentation(MODEL_PATH, CLASSES_PATH, CLASS_COLORS[options["target_class"]], job.video_path,
+                         output_video_path=job.output_path, resize_factor=options["resize_factor"],
+                         workers=options["workers"], batch_size=options["batch_size"], backend=options["backend"],
+                         num_threads=options["num_threads"], analysis_stride=options["analysis_stride"], change_threshold=options["change_threshold"],
+                         cache=cache, geotagger=geotagger, progress=progress, cancel=cancel)
+    else:
+        process_gpx(options["gpx_path"], job.video_path, options["author"], options["device"], options["category"],
+                    job.mode_name, max_gap=options["max_gap"], interval=options["interval"],
+                    image_format=options["image_format"], quality=options["quality"],
+                    thumbnail_width=options["thumbnail_width"], manifest_format=options["manifest_format"],
+                    resume=options["resume"], progress=progress, cancel=cancel)
+
+    job.write_stamp()
+    return "done"
+
+
+# Function to build the gpx_handler.FrameGeotagger factory of a job (see pipeline.VideoStage), None without a
+# GPX track. run_job and job_stage both take the geotagged frames from the frames they write, before encoding,
+# so the same job produces the same images whichever way it runs.
+def job_geotagger(job):
+    options = job.options
+    if not options["gpx_path"]:
+        return None
+    return partial(FrameGeotagger, options["gpx_path"], author=options["author"], device=options["device"],
+                   category=options["category"], process_mode=job.mode_name, max_gap=options["max_gap"],
+                   interval=options["interval"], image_format=options["image_format"], quality=options["quality"],
+                   thumbnail_width=options["thumbnail_width"], manifest_format=options["manifest_format"],
+                   resume=options["resume"])
+
+
+# Function to build the pipeline stage producing the outputs of a job, see pipeline.py.
+# The geotagged frames are taken from the frames the stage writes, or from the source for .geopeg.
+def job_stage(job):
+    options = job.options
+    geotagger = job_geotagger(job)
+    cache = AnalysisCache() if options["cache"] else None
+
+    if job.mode == "cromaticon":
+        return CromaticonStage(job.output_path, options["num_colors"], options["resize_factor"], options["smooth_factor"],
+                               fit_method=options["fit_method"], max_samples=options["max_samples"],
+                               use_lut=options["use_lut"], scenes=options["scenes"],
+                               analysis_stride=options["analysis_stride"], change_threshold=options["change_threshold"],
+                               streaming=options["streaming"], cache=cache, geotagger=geotagger)
+    if job.mode == "pixelate":
+        return PixelateStage(job.output_path, options["num_sectors"], options["resize_factor"], geotagger=geotagger)
+    if job.mode == "segmentation":
+        return SegmentationStage(job.output_path, MODEL_PATH, CLASSES_PATH, CLASS_COLORS[options["target_class"]],
+                                 options["resize_factor"], options["batch_size"], options["backend"],
+                                 num_threads=options["num_threads"], analysis_stride=options["analysis_stride"],
+                                 change_threshold=options["change_threshold"], cache=cache, geotagger=geotagger)
+    return GeotagStage(geotagger)
+
+
+# Function to run several jobs on the same video decoding it only once, returns the status of every job.
+# The stages run on threads of this process, the workers option of the jobs is not used.
+def run_shared_jobs(jobs, force=False, progress=None, cancel=None):
+    for job in jobs:
+        job.check()
+    pending = [job for job in jobs if force or not job.is_up_to_date()]
+
+    if pending:
+        for job in pending:
+            os.makedirs(os.path.dirname(job.output_path), exist_ok=True)
+        run_pipeline(pending[0].video_path, [job_stage(job) for job in pending], progress=progress, cancel=cancel)
+        for job in pending:
+            job.write_stamp()
+
+    return ["done" if job in pending else "skipped" for job in jobs]
+
+
+def _describe_group(group):
+    if len(group) == 1:
+        return group[0].describe()
+    return f"{group[0].video_name} ({'+'.join(job.mode for job in group)})"
+
+
+def _timed_run_group(group, force):
+    description = _describe_group(group)
+    print(f"{description}: started", flush=True)
+    progress = ProgressPrinter(f"{description}: ")
+    start = time.perf_counter()
+    if len(group) == 1:
+        statuses = [run_job(group[0], force, progress=progress)]
+    else:
+        statuses = run_shared_jobs(group, force, progress=progress)
+    return statuses, time.perf_counter() - start
+
+
+# Function to split jobs into groups run as one unit: every job alone, or with shared_decode all the jobs
+# on the same video together, in a single pass over it
+def group_jobs(jobs, shared_decode=False):
+    if not shared_decode:
+        return [[job] for job in jobs]
+    groups = {}
+    for job in jobs:
+        groups.setdefault(os.path.abspath(job.video_path), []).append(job)
+    return list(groups.values())
+
+
+# Function to run a list of jobs, max_jobs at a time in worker processes, printing the progress of each one.
+# With shared_decode the jobs on the same video run together in a single pipeline (see group_jobs).
+# A failed job does not stop the others, the failures are returned as (job, error) pairs.
+def run_jobs(jobs, max_jobs=1, force=False, shared_decode=False):
+    failures = []
+    total = len(jobs)
+    done = 0
+
+    def report(group, outcome):
+        nonlocal done
+        if isinstance(outcome, Exception):
+            for job in group:
+                done += 1
+                failures.append((job, outcome))
+                print(f"[{done}/{total}] {job.describe()}: failed ({outcome})", flush=True)
+            return
+        statuses, elapsed = outcome
+        for job, status in zip(group, statuses):
+            done += 1
+            timing = f" in {elapsed:.1f}s" if status == "done" else ""
+            print(f"[{done}/{total}] {job.describe()}: {status}{timing}", flush=True)
+
+    groups = group_jobs(jobs, shared_decode)
+
+    if max_jobs <= 1:
+        for group in groups:
+            try:
+                outcome = _timed_run_group(group, force)
+            except Exception as error:
+                outcome = error
+            report(group, outcome)
+        return failures
+
+    with ProcessPoolExecutor(max_workers=max_jobs) as executor:
+        futures = {executor.submit(_timed_run_group, group, force): group for group in groups}
+        for future in as_completed(futures):
+            try:
+                outcome = future.result()
+            except Exception as error:
+                outcome = error
+            report(futures[future], outcome)
+    return failures
+
+
+# Function to list the videos of a directory, sorted by name
+def find_videos(directory):
+    return [os.path.join(directory, name) for name in sorted(os.listdir(directory))
+            if name.lower().endswith(VIDEO_EXTENSIONS)]
+
+
+# Function to read the jobs of a batch manifest: a JSON list of objects with an "input" video, a "mode" or a
+# list of "modes" and any of the job options. Relative paths are relative to the manifest, modes and
+# defaults fill what an entry leaves out.
+def load_batch_manifest(manifest_path, modes=(), defaults=None):
+    with open(manifest_path, 'r') as manifest_file:
+        entries = json.load(manifest_file)
+
+    base_dir = os.path.dirname(os.path.abspath(manifest_path))
+    jobs = []
+    for entry in entries:
+        options = dict(defaults or {})
+        options.update(entry)
+        video_path = os.path.join(base_dir, options.pop("input"))
+        if entry.get("gpx_path"):
+            options["gpx_path"] = os.path.join(base_dir, options["gpx_path"])
+
+        entry_modes = options.pop("modes", None) or modes
+        if "mode" in options:
+            entry_modes = [options.pop("mode")]
+        for mode in entry_modes:
+            jobs.append(Job(video_path, mode, **options))
+    return jobs
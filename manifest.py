@@ -0,0 +1,109 @@
+import json
+import os
+
+# Final manifest written next to the journal when the run ends:
+#   json:     {video_name}.json, the array of records read by the /map/ frontend
+#   ndjson:   nothing more, the {video_name}.ndjson journal already has one record per line
+#   columnar: {video_name}.columns.json, one array per field (frame_number, latitude, longitude, timestamp...)
+MANIFEST_FORMATS = ("json", "ndjson", "columnar")
+
+
+# Writes the frame records of a video as they are produced. Every record is appended and flushed to an
+# NDJSON journal right away, so a crash loses at most the record being written and a rerun with
+# resume=True can skip the frames already done. Records are never all held in memory: the journal keeps
+# the offset of the last record of every frame, and close() streams them in frame order into the final
+# manifest.
+class ManifestWriter:
+    def __init__(self, output_folder, video_name, manifest_format="json", resume=False):
+        if manifest_format not in MANIFEST_FORMATS:
+            raise ValueError(f"Unknown manifest format: {manifest_format}")
+
+        self.output_folder = output_folder
+        self.video_name = video_name
+        self.manifest_format = manifest_format
+        self.journal_path = os.path.join(output_folder, f"{video_name}.ndjson")
+
+        # frame_number -> offset of its record in the journal
+        self.offsets = {}
+        if resume and os.path.exists(self.journal_path):
+            self._load_journal()
+        else:
+            open(self.journal_path, "w").close()
+
+        self.journal = open(self.journal_path, "a", encoding="utf-8")
+
+    def _load_journal(self):
+        valid_size = 0
+        with open(self.journal_path, "rb") as journal:
+            for line in journal:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    # Record cut by a crash, everything after it is rewritten
+                    break
+                self.offsets[record["frame_number"]] = valid_size
+                valid_size += len(line)
+
+        with open(self.journal_path, "r+b") as journal:
+            journal.truncate(valid_size)
+
+    def has(self, frame_number):
+        return frame_number in self.offsets
+
+    def write(self, record):
+        self.journal.seek(0, os.SEEK_END)
+        self.offsets[record["frame_number"]] = self.journal.tell()
+        self.journal.write(json.dumps(record) + "\n")
+        self.journal.flush()
+
+    # Records in frame order, read back from the journal one at a time
+    def records(self):
+        with open(self.journal_path, "rb") as journal:
+            for frame_number in sorted(self.offsets):
+                journal.seek(self.offsets[frame_number])
+                yield json.loads(journal.readline())
+
+    def close(self):
+        self.journal.close()
+
+        if self.manifest_format == "json":
+            self._write_atomically(f"{self.video_name}.json", self._write_array)
+        elif self.manifest_format == "columnar":
+            self._write_atomically(f"{self.video_name}.columns.json", self._write_columns)
+
+    def _write_atomically(self, filename, write):
+        path = os.path.join(self.output_folder, filename)
+        with open(path + ".tmp", "w", encoding="utf-8") as manifest_file:
+            write(manifest_file)
+        os.replace(path + ".tmp", path)
+
+    # Same layout as json.dump(records, indent=4), one record at a time
+    def _write_array(self, manifest_file):
+        manifest_file.write("[")
+        for i, record in enumerate(self.records()):
+            manifest_file.write(",\n    " if i else "\n    ")
+            manifest_file.write(json.dumps(record, indent=4).replace("\n", "\n    "))
+        manifest_file.write("\n]" if self.offsets else "]")
+
+    def _write_columns(self, manifest_file):
+        columns = {}
+        for i, record in enumerate(self.records()):
+            for key, value in record.items():
+                columns.setdefault(key, [None] * i).append(value)
+            for key, column in columns.items():
+                if len(column) == i:
+                    column.append(None)
+        json.dump(columns, manifest_file, separators=(",", ":"))
+
+    def __enter__(self):
+        return self
+
+    # Keep the journal for a resumed run, the final manifest is only written on success
+    def abort(self):
+        self.journal.close()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
@@ -0,0 +1,230 @@
+import numpy as np
+from collections import OrderedDict
+from sklearn.cluster import KMeans, MiniBatchKMeans
+from instrumentation import timed
+
+# Maximum number of pixels kept in memory to fit the palette of a whole video
+DEFAULT_MAX_SAMPLES = 200000
+
+# Number of pixels per MiniBatchKMeans.partial_fit call
+DEFAULT_BATCH_SIZE = 4096
+
+FIT_METHODS = ("full", "reservoir", "minibatch")
+
+# Number of previews kept by a PaletteState
+DEFAULT_PREVIEW_CACHE_SIZE = 64
+
+# Number of pixels assigned at once, bounds the temporary distance matrix to chunk_size x num_colors
+DEFAULT_CHUNK_SIZE = 65536
+
+# Bits per channel of the quantized RGB lookup table (64^3 cells)
+DEFAULT_LUT_BITS = 6
+
+
+# Uniform random sample of at most max_samples pixels out of a stream of any length.
+# Once the reservoir is full it follows Algorithm L: rather than drawing for every pixel, the number of pixels
+# skipped before the next replacement is drawn from its geometric distribution, so a frame costs as much as
+# the pixels it replaces, which become rare as the stream grows, rather than as its pixel count.
+class PixelReservoir:
+    def __init__(self, max_samples=DEFAULT_MAX_SAMPLES, seed=None):
+        self.max_samples = max_samples
+        self.samples = np.empty((max_samples, 3), dtype=np.uint8)
+        self.size = 0
+        self.seen = 0
+        self.rng = np.random.default_rng(seed)
+        self.log_w = None  # Logarithm of the W of Algorithm L
+        self.next_index = None  # Position in the stream of the next pixel that replaces a sample
+
+    def add(self, pixels):
+        pixels = pixels.reshape(-1, 3)
+
+        # Fill the reservoir first
+        free = self.max_samples - self.size
+        if free > 0:
+            taken = pixels[:free]
+            self.samples[self.size:self.size + len(taken)] = taken
+            self.size += len(taken)
+            self.seen += len(taken)
+            pixels = pixels[free:]
+
+        if len(pixels) == 0:
+            return
+
+        if self.next_index is None:
+            # -standard_exponential() is the logarithm of a uniform draw in (0, 1]
+            self.log_w = -self.rng.standard_exponential() / self.max_samples
+            self.next_index = self.seen + self._gaps(np.array([self.log_w]))[0] - 1
+
+        end = self.seen + len(pixels)
+        while self.next_index < end:
+            # Draw the replacements expected in the rest of the frame in one go, more rounds if they fall short
+            draws = max(int(self.max_samples * (end - self.next_index) / self.next_index) + 1, 16)
+            log_w = self.log_w - np.cumsum(self.rng.standard_exponential(draws)) / self.max_samples
+            positions = self.next_index + np.concatenate(([0], np.cumsum(self._gaps(log_w))))
+            replaced = min(int(np.searchsorted(positions, end)), draws)
+            slots = self.rng.integers(self.max_samples, size=replaced)
+            self.samples[slots] = pixels[positions[:replaced] - self.seen]
+            self.next_index = int(positions[replaced])
+            self.log_w = log_w[replaced - 1]
+        self.seen = end
+
+    # Function to draw the number of pixels from one replacement to the next for the given values of log W
+    def _gaps(self, log_w):
+        skipped = -self.rng.standard_exponential(len(log_w)) / np.log1p(-np.exp(log_w))
+        return np.floor(skipped).astype(np.int64) + 1
+
+    def pixels(self):
+        return self.samples[:self.size]
+
+
+# Fits the dominant colors of a stream of frames with a fixed memory budget
+#   full:      keep every pixel and run KMeans on all of them (unbounded memory)
+#   reservoir: keep a uniform sample of max_samples pixels and run KMeans on it
+#   minibatch: update a MiniBatchKMeans incrementally with partial_fit, nothing is kept
+class PaletteFitter:
+    def __init__(self, num_colors, method="reservoir", max_samples=DEFAULT_MAX_SAMPLES,
+                 batch_size=DEFAULT_BATCH_SIZE, seed=None):
+        if method not in FIT_METHODS:
+            raise ValueError(f"Unknown palette fit method: {method}")
+
+        self.num_colors = num_colors
+        self.method = method
+        self.seed = seed
+        self.rng = np.random.default_rng(seed)
+
+        if method == "full":
+            self.all_pixels = []
+        elif method == "reservoir":
+            self.reservoir = PixelReservoir(max_samples, seed)
+        else:
+            # The first partial_fit call needs at least num_colors samples to initialize the centers
+            self.batch_size = max(batch_size, 3 * num_colors)
+            self.max_pixels_per_frame = min(max_samples, self.batch_size)
+            self.kmeans = MiniBatchKMeans(n_clusters=num_colors, random_state=seed)
+            self.pending = []
+            self.pending_size = 0
+            self.fitted = False
+
+    @timed("palette_sample")
+    def add(self, pixels):
+        pixels = pixels.reshape(-1, 3)
+
+        if self.method == "full":
+            self.all_pixels.append(pixels.copy())
+        elif self.method == "reservoir":
+            self.reservoir.add(pixels)
+        else:
+            # Subsample each frame so a single frame never exceeds one batch
+            if len(pixels) > self.max_pixels_per_frame:
+                pixels = pixels[self.rng.choice(len(pixels), self.max_pixels_per_frame, replace=False)]
+            self.pending.append(pixels)
+            self.pending_size += len(pixels)
+            if self.pending_size >= self.batch_size:
+                self._partial_fit()
+
+    def _partial_fit(self):
+        batch = np.vstack(self.pending).astype(np.float64)
+        self.pending = []
+        self.pending_size = 0
+        self.kmeans.partial_fit(batch)
+        self.fitted = True
+
+    @timed("fit")
+    def fit(self):
+        if self.method == "full":
+            pixels = np.vstack(self.all_pixels)
+            self.all_pixels = []
+        elif self.method == "reservoir":
+            pixels = self.reservoir.pixels()
+        else:
+            if self.pending_size >= self.num_colors or (self.pending_size and self.fitted):
+                self._partial_fit()
+            if not self.fitted:
+                raise ValueError("Not enough pixels to fit the palette.")
+            return self.kmeans.cluster_centers_.astype(int)
+
+        kmeans = KMeans(n_clusters=self.num_colors, random_state=self.seed)
+        kmeans.fit(pixels)
+        return kmeans.cluster_centers_.astype(int)
+
+
+# Palette fitting state of the single-frame preview: every fit is warm-started from the centers of the
+# previous one (a single KMeans run instead of k-means++ restarts), and the palette and percentages of
+# previous previews are cached so that repeating a preview with the same settings returns immediately.
+class PaletteState:
+    def __init__(self, max_cached=DEFAULT_PREVIEW_CACHE_SIZE, seed=None):
+        self.centers = None
+        self.seed = seed
+        self.max_cached = max_cached
+        self.cache = OrderedDict()
+
+    @timed("fit")
+    def fit(self, pixels, num_colors):
+        if self.centers is not None and len(self.centers) == num_colors:
+            kmeans = KMeans(n_clusters=num_colors, init=self.centers, n_init=1, random_state=self.seed)
+        else:
+            kmeans = KMeans(n_clusters=num_colors, random_state=self.seed)
+        kmeans.fit(pixels.reshape(-1, 3))
+        self.centers = kmeans.cluster_centers_
+        return kmeans.cluster_centers_.astype(int)
+
+    def get(self, key):
+        if key not in self.cache:
+            return None
+        self.cache.move_to_end(key)
+        return self.cache[key]
+
+    def put(self, key, value):
+        self.cache[key] = value
+        self.cache.move_to_end(key)
+        while len(self.cache) > self.max_cached:
+            self.cache.popitem(last=False)
+
+
+# Index of the nearest palette color for every pixel
+def assign_palette(pixels, dominant_colors, chunk_size=DEFAULT_CHUNK_SIZE):
+    pixels = pixels.reshape(-1, 3)
+    colors = np.asarray(dominant_colors, dtype=np.float32)
+    # ||x - c||^2 = ||x||^2 - 2x.c + ||c||^2, ||x||^2 is the same for every color so it does not change the argmin.
+    # All the terms are integers well below 2^24, so float32 gives the same result as the exact distance.
+    colors_sq = (colors ** 2).sum(axis=1)
+    colors_t = -2 * colors.T
+
+    labels = np.empty(len(pixels), dtype=np.intp)
+    for start in range(0, len(pixels), chunk_size):
+        chunk = pixels[start:start + chunk_size].astype(np.float32)
+        labels[start:start + chunk_size] = np.argmin(chunk @ colors_t + colors_sq, axis=1)
+    return labels
+
+
+# Lookup table mapping every quantized RGB color to the index of its nearest palette color
+def build_palette_lut(dominant_colors, bits=DEFAULT_LUT_BITS):
+    shift = 8 - bits
+    levels = (np.arange(1 << bits) << shift) + ((1 << shift) >> 1)
+    grid = np.stack(np.meshgrid(levels, levels, levels, indexing="ij"), axis=-1).astype(np.uint8)
+    lut = assign_palette(grid, dominant_colors).astype(np.uint8)
+    return lut, bits
+
+
+def lookup_palette(pixels, lut):
+    table, bits = lut
+    shift = 8 - bits
+    pixels = pixels.reshape(-1, 3) >> shift
+    index = (pixels[:, 0].astype(np.intp) << (2 * bits)) | (pixels[:, 1].astype(np.intp) << bits) | pixels[:, 2]
+    return table[index]
+
+
+# Fraction of the frame assigned to each palette color.
+# With a lut (see build_palette_lut) the colors are looked up instead of compared with the whole palette.
+@timed("assign")
+def calculate_color_percentages(frame, dominant_colors, lut=None, chunk_size=DEFAULT_CHUNK_SIZE):
+    pixels = frame.reshape(-1, 3)
+    counts = np.zeros(len(dominant_colors), dtype=np.int64)
+    for start in range(0, len(pixels), chunk_size):
+        chunk = pixels[start:start + chunk_size]
+        if lut is not None:
+            labels = lookup_palette(chunk, lut)
+        else:
+            labels = assign_palette(chunk, dominant_colors, chunk_size)
+        counts += np.bincount(labels, minlength=len(dominant_colors))
+    return counts / len(pixels)
@@ -0,0 +1,211 @@
+import os
+import queue
+import threading
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
+
+import cv2
+import numpy as np
+
+from buffers import local_pool
+from instrumentation import timer, count, observe
+
+# Number of frames in flight per worker (decoded, being transformed or waiting in the reorder buffer)
+DEFAULT_QUEUE_DEPTH = 2
+
+# Shared memory blocks are files of this filesystem on Linux, Docker mounts only 64 MB there by default
+SHARED_MEMORY_DIR = "/dev/shm"
+
+# Shared frame slots as seen from a worker process
+_input_slots = None
+_output_slots = None
+_shared_blocks = []
+
+
+def resolve_workers(workers):
+    if workers is None or workers <= 0:
+        return os.cpu_count() or 1
+    return workers
+
+
+def _init_worker(input_name=None, input_shape=None, output_name=None, output_shape=None):
+    global _input_slots, _output_slots
+
+    # Every worker transforms one frame at a time, OpenCV threads would only compete with the other workers
+    cv2.setNumThreads(1)
+
+    if input_name:
+        block = shared_memory.SharedMemory(name=input_name)
+        _shared_blocks.append(block)
+        _input_slots = np.ndarray(input_shape, dtype=np.uint8, buffer=block.buf)
+    if output_name:
+        block = shared_memory.SharedMemory(name=output_name)
+        _shared_blocks.append(block)
+        _output_slots = np.ndarray(output_shape, dtype=np.uint8, buffer=block.buf)
+
+
+# Submitted once before the decoder thread starts: with the fork start method the first submit forks every
+# worker, so none is forked while the decoder thread holds the capture or the queue locks
+def _start_workers():
+    return None
+
+
+def _transform_slot(func, slot):
+    result = func(_input_slots[slot])
+    if _output_slots is None:
+        return result
+    _output_slots[slot] = result
+    return None
+
+
+# Decoder thread: fills free slots with decoded frames, None marks the end of the video
+def _decode_frames(cap, input_slots, free_slots, decoded, stop):
+    try:
+        while not stop.is_set():
+            slot = free_slots.get()
+            if slot is None or stop.is_set():
+                break
+            with timer("decode"):
+                ret, frame = cap.read(image=input_slots[slot])
+            if not ret:
+                break
+            if not np.shares_memory(frame, input_slots[slot]):
+                input_slots[slot] = frame
+            count("frames_decoded")
+            decoded.put(slot)
+    except Exception as error:
+        decoded.put(error)
+        return
+    decoded.put(None)
+
+
+# Function to get the number of frame slots (slot_bytes each) that fit in the free shared memory, at most
+# num_slots. Where shared memory is not a filesystem (macOS, Windows) every slot is assumed to fit.
+def _fit_slots(num_slots, slot_bytes):
+    if not os.path.isdir(SHARED_MEMORY_DIR):
+        return num_slots
+    stat = os.statvfs(SHARED_MEMORY_DIR)
+    return min(num_slots, stat.f_bavail * stat.f_frsize // max(slot_bytes, 1))
+
+
+def _create_slots(num_slots, shape):
+    shape = (num_slots,) + tuple(shape)
+    block = shared_memory.SharedMemory(create=True, size=int(np.prod(shape)))
+    return block, np.ndarray(shape, dtype=np.uint8, buffer=block.buf)
+
+
+# Function to apply func to every frame of an open capture, yielding the results in decode order.
+# With more than one worker the frames are decoded by a background thread into shared memory slots,
+# transformed by a pool of worker processes and put back in order by a reorder buffer.
+# func must be picklable (a module-level function or a functools.partial of one), and must not keep the frame
+# it is given: frames are decoded into reused buffers.
+# When output_shape is given, func must return a uint8 frame of that shape: it is written to shared
+# memory instead of being pickled back, and the yielded array is reused by the next iteration.
+# When the free shared memory holds fewer slots than workers * queue_depth, fewer slots (and workers) are
+# used, and with less than two slots the frames are transformed in this process.
+def map_frames(cap, func, workers=1, queue_depth=DEFAULT_QUEUE_DEPTH, output_shape=None):
+    workers = resolve_workers(workers)
+
+    if workers > 1:
+        input_shape = (int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT)), int(cap.get(cv2.CAP_PROP_FRAME_WIDTH)), 3)
+        slot_bytes = int(np.prod(input_shape)) + (int(np.prod(output_shape)) if output_shape is not None else 0)
+        wanted_slots = workers * max(queue_depth, 1)
+        num_slots = _fit_slots(wanted_slots, slot_bytes)
+        if num_slots < 2:
+            print(f"[INFO] Not enough shared memory in {SHARED_MEMORY_DIR} for parallel frames, "
+                  f"transforming them in this process")
+            workers = 1
+        elif num_slots < wanted_slots:
+            print(f"[INFO] Shared memory only holds {num_slots} of {wanted_slots} frame slots")
+            workers = min(workers, num_slots)
+
+    if workers == 1:
+        pool = local_pool()
+        while True:
+            with timer("decode"):
+                ret, frame = pool.read(cap, "map_frames")
+            if not ret:
+                break
+            count("frames_decoded")
+            yield func(frame)
+        return
+
+    input_block, input_slots = _create_slots(num_slots, input_shape)
+    output_block, output_slots, output_frame = None, None, None
+    if output_shape is not None:
+        output_block, output_slots = _create_slots(num_slots, output_shape)
+        output_frame = np.empty(output_shape, dtype=np.uint8)
+
+    free_slots = queue.Queue()
+    for slot in range(num_slots):
+        free_slots.put(slot)
+    decoded = queue.Queue()
+    stop = threading.Event()
+
+    decoder = threading.Thread(target=_decode_frames, args=(cap, input_slots, free_slots, decoded, stop),
+                               name="frame-decoder", daemon=True)
+    executor = ProcessPoolExecutor(
+        max_workers=workers, initializer=_init_worker,
+        initargs=(input_block.name, input_slots.shape,
+                  output_block.name if output_block else None, output_slots.shape if output_block else None))
+
+    try:
+        executor.submit(_start_workers)
+        decoder.start()
+        pending = deque()
+        decoding = True
+
+        while True:
+            # Keep every slot busy before waiting for the oldest frame
+            while decoding and len(pending) < num_slots:
+                slot = decoded.get()
+                if isinstance(slot, Exception):
+                    raise slot
+                if slot is None:
+                    decoding = False
+                    break
+                pending.append((slot, executor.submit(_transform_slot, func, slot)))
+
+            if not pending:
+                break
+
+            # Reorder buffer: results are always consumed in submission order
+            observe("frames_in_flight", len(pending))
+            slot, future = pending.popleft()
+            with timer("wait_workers"):
+                result = future.result()
+            if output_slots is not None:
+                # The slot goes back to the decoder, so the frame is handed out from a private buffer
+                np.copyto(output_frame, output_slots[slot])
+                result = output_frame
+            free_slots.put(slot)
+            yield result
+    finally:
+        stop.set()
+        free_slots.put(None)
+        executor.shutdown(wait=True, cancel_futures=True)
+        decoder.join()
+        del input_slots, output_slots
+        input_block.close()
+        input_block.unlink()
+        if output_block is not None:
+            output_block.close()
+            output_block.unlink()
+
+
+# Function to apply func to a sequence of small items (e.g. downscaled frames) on a pool of worker processes,
+# yielding the results in order
+def map_items(func, items, workers=1, chunksize=16):
+    workers = resolve_workers(workers)
+
+    if workers == 1:
+        for item in items:
+            yield func(item)
+        return
+
+    executor = ProcessPoolExecutor(max_workers=workers, initializer=_init_worker)
+    try:
+        yield from executor.map(func, items, chunksize=chunksize)
+    finally:
+        executor.shutdown(wait=True, cancel_futures=True)
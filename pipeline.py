@@ -0,0 +1,424 @@
+import queue
+import threading
+
+import cv2
+
+from palette import PaletteFitter, DEFAULT_MAX_SAMPLES, build_palette_lut
+from processing import (resize_frame, analysis_thumbnail, measure_color_percentages, measure_video_color_percentages,
+                        write_color_bar_video, color_analysis_key, store_color_analysis, load_color_analysis)
+from scenes import ScenePalettes, measure_scene_color_percentages
+from pixelate_processing import pixelate_video_frame
+from segmentation import get_session, mask_from_class_map, masks_from_class_maps
+from progress import ProgressTracker
+from video_probe import probe_video
+from buffers import BufferPool, local_pool
+from frame_sampling import FrameSampler, interpolate_frames, DEFAULT_ANALYSIS_STRIDE, DEFAULT_CHANGE_THRESHOLD
+from instrumentation import timer, count, observe
+
+# Decoded frames waiting in front of every stage, the decoder blocks when a stage falls that far behind
+DEFAULT_STAGE_QUEUE_DEPTH = 8
+
+
+# A consumer of the decoded frames of a pipeline. start() is called with the VideoInfo of the source before
+# the first frame, process() with every frame in order, and finish() once the video has been decoded
+# (abort() instead when the run fails or is cancelled). The frames are shared by all the stages and must not
+# be modified. They are decoded into a ring of reused buffers: a stage that keeps frames after process()
+# returns must declare how many in frames_held. A stage that finds its results in the analysis cache sets
+# needs_frames to False in start(), it then gets no frames and only finish() is called.
+class Stage:
+    name = "stage"
+    frames_held = 0
+    needs_frames = True
+
+    def start(self, video_info):
+        pass
+
+    def process(self, frame_number, frame):
+        pass
+
+    def finish(self, tracker):
+        pass
+
+    def abort(self):
+        pass
+
+
+# A stage writing one output frame per source frame to its own video file. geotagger, when given, is a
+# gpx_handler.FrameGeotagger factory (e.g. a functools.partial) called with the output video_path, frame_rate
+# and total_frames: the geotagged frames are taken from the output frames as they are written, without
+# decoding the output video again.
+class VideoStage(Stage):
+    def __init__(self, output_video_path, geotagger=None):
+        self.output_video_path = output_video_path
+        self.geotagger_factory = geotagger
+        self.geotagger = None
+        self.out = None
+
+    # Frame rate of the output video, written as an integer like process_video and pixelate_video do
+    def output_fps(self, video_info):
+        return int(video_info.fps)
+
+    def start(self, video_info):
+        fps = self.output_fps(video_info)
+        self.frame_size = (video_info.width, video_info.height)
+        fourcc = cv2.VideoWriter_fourcc(*'mp4v')
+        self.out = cv2.VideoWriter(self.output_video_path, fourcc, fps, self.frame_size)
+        if self.geotagger_factory is not None:
+            self.geotagger = self.geotagger_factory(video_path=self.output_video_path, frame_rate=fps,
+                                                    total_frames=video_info.frame_count)
+
+    def write(self, frame_number, output_frame):
+        with timer("encode"):
+            self.out.write(output_frame)
+        count("frames_encoded")
+        if self.geotagger is not None:
+            self.geotagger.add(frame_number, output_frame)
+
+    def finish(self, tracker):
+        self.out.release()
+        if self.geotagger is not None:
+            self.geotagger.close()
+        print(f"Video saved as {self.output_video_path}")
+
+    def abort(self):
+        if self.out is not None:
+            self.out.release()
+        if self.geotagger is not None:
+            self.geotagger.abort()
+
+
+# Cromaticon 3000, like process_video: the palette is fitted and the bars are written once the whole video has
+# been seen. With streaming=True a fixed-size subsample of every frame is kept for the percentages, otherwise
+# they are measured in finish() by decoding the source again. cache is an optional
+# analysis_cache.AnalysisCache, as for process_video.
+class CromaticonStage(VideoStage):
+    name = "cromaticon"
+
+    def __init__(self, output_video_path, num_dominant_colors, resize_factor, smooth_factor, fit_method="reservoir",
+                 max_samples=DEFAULT_MAX_SAMPLES, use_lut=False, scenes=False, analysis_stride=DEFAULT_ANALYSIS_STRIDE,
+                 change_threshold=DEFAULT_CHANGE_THRESHOLD, streaming=False, cache=None, geotagger=None):
+        super().__init__(output_video_path, geotagger)
+        self.num_dominant_colors = num_dominant_colors
+        self.resize_factor = resize_factor
+        self.smooth_factor = smooth_factor
+        self.fit_method = fit_method
+        self.max_samples = max_samples
+        self.use_lut = use_lut
+        self.scenes = scenes
+        self.streaming = streaming
+        self.sampler = FrameSampler(analysis_stride, change_threshold)
+        self.cache = cache
+        self.cache_key = None
+        self.cached = None
+        if scenes:
+            self.palette_fitter = ScenePalettes(num_dominant_colors)
+        else:
+            self.palette_fitter = PaletteFitter(num_dominant_colors, method=fit_method, max_samples=max_samples)
+        self.resized_frames = []
+
+    def start(self, video_info):
+        # The writer is only opened once the bars are known
+        self.video_info = video_info
+        self.analysis_size = (video_info.width // self.resize_factor, video_info.height // self.resize_factor)
+        if self.cache is not None:
+            self.cache_key = color_analysis_key(self.cache, video_info.path, self.num_dominant_colors,
+                                                self.resize_factor, self.fit_method, self.max_samples, self.use_lut,
+                                                self.scenes, self.sampler.analysis_stride,
+                                                self.sampler.change_threshold, self.streaming)
+            self.cached = self.cache.get(self.cache_key)
+            if self.cached is not None:
+                print(f"Using the cached analysis of {video_info.path}")
+                self.needs_frames = False
+
+    def process(self, frame_number, frame):
+        resized_frame = resize_frame(frame, self.analysis_size)
+        self.palette_fitter.add(resized_frame)
+        if self.sampler.add(resized_frame) and self.streaming:
+            self.resized_frames.append(analysis_thumbnail(resized_frame))
+
+    def finish(self, tracker):
+        frame_palettes = None
+        if self.cached is not None:
+            dominant_colors, color_percentages_list, frame_palettes = load_color_analysis(self.cached)
+        else:
+            if self.scenes:
+                palettes = self.palette_fitter.fit()
+                frame_palettes = self.palette_fitter.frame_palettes()
+                scene_starts = self.palette_fitter.scene_starts
+            else:
+                palettes = [self.palette_fitter.fit()]
+                scene_starts = [0]
+            luts = [build_palette_lut(palette) for palette in palettes] if self.use_lut else None
+            dominant_colors = palettes[0]
+            color_percentages_list = self._interpolate(self._measure(palettes, luts, tracker))
+            if self.cache_key is not None:
+                store_color_analysis(self.cache, self.cache_key, palettes, scene_starts, color_percentages_list)
+
+        fps = self.output_fps(self.video_info)
+        if self.geotagger_factory is not None:
+            self.geotagger = self.geotagger_factory(video_path=self.output_video_path, frame_rate=fps,
+                                                    total_frames=self.video_info.frame_count)
+        on_frame = self.geotagger.add if self.geotagger is not None else None
+        write_color_bar_video(self.output_video_path, dominant_colors, color_percentages_list, self.smooth_factor, fps,
+                              (self.video_info.width, self.video_info.height), tracker, on_frame, frame_palettes)
+        if self.geotagger is not None:
+            self.geotagger.close()
+
+    def _measure(self, palettes, luts, tracker):
+        frame_numbers = None if self.sampler.every_frame else self.sampler.frame_numbers
+        if not self.streaming:
+            return measure_video_color_percentages(self.video_info.path, self.analysis_size, palettes, luts,
+                                                   self.palette_fitter.scene_indices() if self.scenes else None,
+                                                   frame_numbers, tracker=tracker)
+
+        resized_frames, self.resized_frames = self.resized_frames, []
+        if self.scenes:
+            return measure_scene_color_percentages(resized_frames, self.palette_fitter, luts, tracker=tracker,
+                                                   frame_numbers=frame_numbers)
+        return measure_color_percentages(resized_frames, palettes[0], None if luts is None else luts[0],
+                                         tracker=tracker)
+
+    def _interpolate(self, color_percentages_list):
+        if self.sampler.every_frame:
+            return color_percentages_list
+        return interpolate_frames(self.sampler.frame_numbers, color_percentages_list, self.sampler.frame_count)
+
+
+# Piastrellificio.px, like pixelate_video
+class PixelateStage(VideoStage):
+    name = "pixelate"
+
+    def __init__(self, output_video_path, num_sectors, resize_factor, geotagger=None):
+        super().__init__(output_video_path, geotagger)
+        self.num_sectors = num_sectors
+        self.resize_factor = resize_factor
+
+    def process(self, frame_number, frame):
+        width, height = self.frame_size
+        self.write(frame_number, pixelate_video_frame(frame, self.num_sectors, self.resize_factor,
+                                                      (width // self.resize_factor, height // self.resize_factor),
+                                                      self.frame_size))
+
+
+# Segmentatore Bugiardo Semantico, like run_segmentation: batch_size frames go through the network together.
+# With analysis_stride or change_threshold the frames in between analysed ones hold the last class map, one
+# frame at a time. num_threads sets the OpenCV threads of the process (so of every stage) when the stage starts.
+# cache is an optional analysis_cache.AnalysisCache, as for run_segmentation.
+class SegmentationStage(VideoStage):
+    name = "segmentation"
+
+    def __init__(self, output_video_path, model_path, classes_path, colors_path, resize_factor=1, batch_size=1,
+                 backend="default", num_threads=None, analysis_stride=DEFAULT_ANALYSIS_STRIDE,
+                 change_threshold=DEFAULT_CHANGE_THRESHOLD, cache=None, geotagger=None):
+        super().__init__(output_video_path, geotagger)
+        self.session = get_session(model_path, classes_path, backend)
+        self.COLORS = self.session.colors(colors_path)
+        self.model_path = model_path
+        self.resize_factor = resize_factor
+        self.backend = backend
+        self.num_threads = num_threads
+        self.sampler = FrameSampler(analysis_stride, change_threshold)
+        self.batch_size = max(batch_size, 1) if self.session.batched and self.sampler.every_frame else 1
+        self.frames_held = self.batch_size - 1
+        self.batch = []
+        self.class_map = None
+        self.mask = None
+        self.cache = cache
+        self.cached = None
+        self.cache_writer = None
+        self.class_maps_store = None
+
+    # run_segmentation keeps the exact frame rate of the source
+    def output_fps(self, video_info):
+        return video_info.fps
+
+    def start(self, video_info):
+        super().start(video_info)
+        if self.num_threads is not None:
+            cv2.setNumThreads(self.num_threads)
+        if self.cache is None:
+            return
+        cache_key = self.cache.key("segmentation", video_info.path, files=(self.model_path,),
+                                   resize_factor=self.resize_factor, backend=self.backend,
+                                   analysis_stride=self.sampler.analysis_stride,
+                                   change_threshold=self.sampler.change_threshold)
+        self.cached = self.cache.get(cache_key)
+        if self.cached is not None:
+            print(f"[INFO] Using the cached class maps of {video_info.path}")
+            self.needs_frames = False
+        else:
+            self.cache_writer = self.cache.writer(cache_key, {"video_path": video_info.path})
+            self.class_maps_store = self.cache_writer.frame_array("class_maps", video_info.frame_count)
+
+    def process(self, frame_number, frame):
+        if not self.sampler.every_frame:
+            if self.sampler.add(frame):
+                self.class_map = self.session.class_maps([frame], self.resize_factor, local_pool())[0]
+                self.mask = None
+            if self.class_maps_store is not None:
+                self.class_maps_store.append(self.class_map)
+            if self.mask is None:
+                with timer("render"):
+                    self.mask = mask_from_class_map(self.class_map, self.COLORS, self.frame_size, local_pool())
+            self.write(frame_number, self.mask)
+            return
+
+        self.batch.append((frame_number, frame))
+        if len(self.batch) >= self.batch_size:
+            self._flush()
+
+    def _flush(self):
+        if not self.batch:
+            return
+        frame_numbers, frames = zip(*self.batch)
+        self.batch = []
+        if self.class_maps_store is None:
+            masks = self.session.segment_frames(list(frames), self.resize_factor, self.frame_size, self.COLORS,
+                                                local_pool())
+            for frame_number, mask in zip(frame_numbers, masks):
+                self.write(frame_number, mask)
+            return
+
+        # Full class maps, so that any color table can be drawn from the cache
+        for frame_number, class_map in zip(frame_numbers, self.session.class_maps(list(frames), self.resize_factor,
+                                                                                  local_pool())):
+            self.class_maps_store.append(class_map)
+            self._write_class_map(frame_number, class_map)
+
+    def _write_class_map(self, frame_number, class_map):
+        with timer("render"):
+            mask = mask_from_class_map(class_map, self.COLORS, self.frame_size, local_pool())
+        self.write(frame_number, mask)
+
+    def finish(self, tracker):
+        if self.cached is not None:
+            tracker.start("segmenting", self.cached.frame_count("class_maps"))
+            masks = masks_from_class_maps(self.cached.frames("class_maps"), self.COLORS, self.frame_size)
+            for frame_number, mask in enumerate(masks):
+                self.write(frame_number, mask)
+                tracker.update()
+        self._flush()
+        if self.cache_writer is not None:
+            self.cache_writer.commit()
+            self.cache_writer.close()
+        super().finish(tracker)
+
+    def abort(self):
+        if self.cache_writer is not None:
+            self.cache_writer.close()
+        super().abort()
+
+
+# .geopeg: geotagged frames of the source video. geotagger is the same factory as for VideoStage, called with
+# the source video_path, frame_rate and total_frames.
+class GeotagStage(Stage):
+    name = "geotag"
+
+    def __init__(self, geotagger):
+        self.geotagger_factory = geotagger
+        self.geotagger = None
+
+    def start(self, video_info):
+        self.geotagger = self.geotagger_factory(video_path=video_info.path, frame_rate=video_info.fps,
+                                                total_frames=video_info.frame_count)
+
+    def process(self, frame_number, frame):
+        self.geotagger.add(frame_number, frame)
+
+    def finish(self, tracker):
+        self.geotagger.close()
+
+    def abort(self):
+        if self.geotagger is not None:
+            self.geotagger.abort()
+
+
+# Runs one stage on its own thread, fed through a bounded queue. OpenCV and NumPy release the GIL, so the
+# stages of a pipeline work on the same frame at the same time.
+class _StageRunner(threading.Thread):
+    def __init__(self, stage, queue_depth):
+        # Named after the stage, so that profilers and py-spy tell the stage threads apart
+        super().__init__(name=f"stage-{stage.name}", daemon=True)
+        self.stage = stage
+        self.frames = queue.Queue(maxsize=queue_depth)
+        self.error = None
+
+    def run(self):
+        while True:
+            item = self.frames.get()
+            if item is None:
+                break
+            if self.error is not None:
+                # Keep draining so the decoder never blocks on a failed stage
+                continue
+            try:
+                self.stage.process(*item)
+            except BaseException as error:
+                self.error = error
+
+
+# Function to decode a video once and hand every frame to all the stages, each producing its own output.
+# progress and cancel are the optional progress callback and cancellation token of progress.ProgressTracker.
+def run_pipeline(video_path, stages, queue_depth=DEFAULT_STAGE_QUEUE_DEPTH, progress=None, cancel=None):
+    tracker = ProgressTracker(progress, cancel)
+    cap = cv2.VideoCapture(video_path)
+    video_info = probe_video(video_path, cap)
+
+    started = []
+    runners = []
+    try:
+        for stage in stages:
+            stage.start(video_info)
+            started.append(stage)
+
+        # Stages served from the analysis cache get no frames, the video is not decoded at all when none needs them
+        runners = [_StageRunner(stage, queue_depth) for stage in stages if stage.needs_frames]
+        for runner in runners:
+            runner.start()
+
+        # A frame can be waiting in a full queue, being processed or held by a stage while the next one is
+        # decoded, so the ring is one frame longer than that
+        ring_size = queue_depth + max((runner.stage.frames_held for runner in runners), default=0) + 2
+        ring = BufferPool()
+
+        if runners:
+            tracker.start("decoding", video_info.frame_count)
+        frame_number = 0
+        while runners:
+            with timer("decode"):
+                ret, frame = ring.read(cap, frame_number % ring_size)
+            if not ret:
+                break
+            count("frames_decoded")
+            for runner in runners:
+                if runner.error is not None:
+                    raise runner.error
+                # Frames waiting in front of the stage, a stage that is often full is the bottleneck
+                observe(f"queue_{runner.stage.name}", runner.frames.qsize())
+                runner.frames.put((frame_number, frame))
+            frame_number += 1
+            tracker.update()
+
+        for runner in runners:
+            runner.frames.put(None)
+        for runner in runners:
+            runner.join()
+            if runner.error is not None:
+                raise runner.error
+        runners = []
+
+        for stage in stages:
+            tracker.check()
+            stage.finish(tracker)
+            started.remove(stage)
+    except BaseException:
+        for runner in runners:
+            runner.error = runner.error or RuntimeError("Pipeline aborted")
+            runner.frames.put(None)
+        for runner in runners:
+            runner.join()
+        for stage in started:
+            stage.abort()
+        raise
+    finally:
+        cap.release()
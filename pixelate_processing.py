@@ -1,50 +1,81 @@
 import cv2
 import numpy as np
-
-# Function to pixelate the image based on the number of sectors
-def pixelate_frame(frame, num_sectors, resize_factor):
+from functools import partial
+from contextlib import closing
+from parallel import map_frames, DEFAULT_QUEUE_DEPTH
+from progress import ProgressTracker
+from video_probe import probe_video
+from buffers import local_pool
+from instrumentation import timer, count
+
+# Start of every sector along one axis, plus the end of the last one.
+# The last sector always reaches the edge, float rounding could otherwise leave the last line unfilled.
+def sector_bounds(length, num_sectors):
+    sector_size = length / num_sectors
+    bounds = np.minimum((np.arange(num_sectors + 1) * sector_size).astype(int), length)
+    bounds[-1] = length
+    return bounds
+
+
+# Function to pixelate the image based on the number of sectors.
+# The mean color of every sector is computed for the whole frame at once, then each mean is repeated over
+# its sector of the output, which is output_size (width, height) or the size of the frame, written to out
+# when given.
+def pixelate_frame(frame, num_sectors, resize_factor, output_size=None, out=None):
     height, width, _ = frame.shape
 
     # Calculate the number of rows and columns for sectors
     num_rows = int(np.ceil(np.sqrt(num_sectors)))  # Rows
     num_cols = int(np.ceil(num_sectors / num_rows))  # Columns
 
-    # Calculate sector dimensions
-    sector_height = height / num_rows
-    sector_width = width / num_cols
-
-    # Create a pixelated version of the frame
-    pixelated_frame = np.zeros_like(frame)
-
-    for i in range(num_rows):
-        for j in range(num_cols):
-            # Calculate the region of interest
-            start_y = int(i * sector_height)
-            start_x = int(j * sector_width)
-            end_y = int((i + 1) * sector_height)
-            end_x = int((j + 1) * sector_width)
-
-            # Ensure that the sector dimensions do not exceed the frame dimensions
-            end_y = min(end_y, height)
-            end_x = min(end_x, width)
-
-            # Get the current sector
-            sector = frame[start_y:end_y, start_x:end_x]
-
-            # Calculate the mean color of the sector
-            mean_color = np.mean(sector, axis=(0, 1)).astype(int)
-
-            # Fill the pixelated frame with the mean color
-            pixelated_frame[start_y:end_y, start_x:end_x] = mean_color
-
-    return pixelated_frame
-
-# Function to pixelate the video
-def pixelate_video(video_path, output_video_path, num_sectors, resize_factor):
+    # Sum every sector with two reductions, sectors are exact even when the size is not divisible. 64-bit sums,
+    # a 32-bit sum overflows beyond 16.8M pixels per sector (a full-resolution 8K preview with one sector).
+    row_bounds = sector_bounds(height, num_rows)
+    col_bounds = sector_bounds(width, num_cols)
+    row_sums = np.add.reduceat(frame, np.minimum(row_bounds[:-1], height - 1), axis=0, dtype=np.uint64)
+    sector_sums = np.add.reduceat(row_sums, np.minimum(col_bounds[:-1], width - 1), axis=1, dtype=np.uint64)
+
+    # Calculate the mean color of each sector, empty sectors are never drawn
+    sector_areas = np.outer(np.diff(row_bounds), np.diff(col_bounds))
+    mean_colors = (sector_sums / np.maximum(sector_areas, 1)[:, :, np.newaxis]).astype(np.uint8)
+
+    # Fill the pixelated frame with the mean colors (nearest neighbour, no blurred tile edges)
+    if output_size is not None:
+        width, height = output_size
+        row_bounds = sector_bounds(height, num_rows)
+        col_bounds = sector_bounds(width, num_cols)
+    # Every output line is a copy of one of the num_rows sector lines
+    sector_lines = np.repeat(mean_colors, np.diff(col_bounds), axis=1)
+    return np.take(sector_lines, np.repeat(np.arange(num_rows), np.diff(row_bounds)), axis=0, out=out)
+
+# Function to turn a decoded frame into an output frame: resize, then pixelate straight to the original size.
+# The resized and output frames are buffers of the calling thread (see buffers.local_pool), the result is only
+# valid until the next call.
+def pixelate_video_frame(frame, num_sectors, resize_factor, frame_size, output_size):
+    pool = local_pool()
+
+    # Resize frame for faster processing
+    with timer("resize"):
+        resized_frame = cv2.resize(frame, frame_size,
+                                   dst=pool.get("pixelate_resized", (frame_size[1], frame_size[0], 3)))
+
+    # Pixelate the resized frame, the sectors are drawn directly at the original size
+    output_frame = pool.get("pixelate_output", (output_size[1], output_size[0], 3))
+    with timer("render"):
+        return pixelate_frame(resized_frame, num_sectors, resize_factor, output_size, output_frame)
+
+# Function to pixelate the video, workers > 1 transforms frames in parallel worker processes.
+# geotagger, when given, is a gpx_handler.FrameGeotagger factory like for pipeline.VideoStage: the geotagged
+# frames are taken from the pixelated frames as they are written.
+# progress and cancel are the optional progress callback and cancellation token of progress.ProgressTracker.
+def pixelate_video(video_path, output_video_path, num_sectors, resize_factor, workers=1, queue_depth=DEFAULT_QUEUE_DEPTH,
+                   geotagger=None, progress=None, cancel=None):
+    tracker = ProgressTracker(progress, cancel)
     cap = cv2.VideoCapture(video_path)
-    original_frame_width = int(cap.get(cv2.CAP_PROP_FRAME_WIDTH))
-    original_frame_height = int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT))
-    fps = int(cap.get(cv2.CAP_PROP_FPS))
+    video_info = probe_video(video_path, cap)
+    original_frame_width = video_info.width
+    original_frame_height = video_info.height
+    fps = int(video_info.fps)
 
     # Calculate the new frame dimensions based on resize factor
     frame_width = original_frame_width // resize_factor
@@ -53,23 +84,32 @@ def pixelate_video(video_path, output_video_path, num_sectors, resize_factor):
     # Create VideoWriter object with native resolution for output
     fourcc = cv2.VideoWriter_fourcc(*'mp4v')
     out = cv2.VideoWriter(output_video_path, fourcc, fps, (original_frame_width, original_frame_height))
-
-    while cap.isOpened():
-        ret, frame = cap.read()
-        if not ret:
-            break
-
-        # Resize frame for faster processing
-        resized_frame = cv2.resize(frame, (frame_width, frame_height))
-
-        # Pixelate the resized frame
-        pixelated_frame = pixelate_frame(resized_frame, num_sectors, resize_factor)
-
-        # Upscale the pixelated frame back to original size
-        pixelated_frame_upscaled = cv2.resize(pixelated_frame, (original_frame_width, original_frame_height))
-        out.write(pixelated_frame_upscaled)
-
-    cap.release()
-    out.release()
+    frame_geotagger = None
+    if geotagger is not None:
+        frame_geotagger = geotagger(video_path=output_video_path, frame_rate=fps, total_frames=video_info.frame_count)
+
+    transform = partial(pixelate_video_frame, num_sectors=num_sectors, resize_factor=resize_factor,
+                        frame_size=(frame_width, frame_height),
+                        output_size=(original_frame_width, original_frame_height))
+
+    try:
+        tracker.start("pixelating", video_info.frame_count)
+        with closing(map_frames(cap, transform, workers, queue_depth,
+                                output_shape=(original_frame_height, original_frame_width, 3))) as frames:
+            for frame_number, pixelated_frame_upscaled in enumerate(frames):
+                with timer("encode"):
+                    out.write(pixelated_frame_upscaled)
+                count("frames_encoded")
+                if frame_geotagger is not None:
+                    frame_geotagger.add(frame_number, pixelated_frame_upscaled)
+                tracker.update()
+    except BaseException:
+        if frame_geotagger is not None:
+            frame_geotagger.abort()
+        raise
+    finally:
+        cap.release()
+        out.release()
+    if frame_geotagger is not None:
+        frame_geotagger.close()
     print(f"Pixelated video saved as {output_video_path}")
-
@@ -1,179 +1,403 @@
+import math
+
 import cv2
 import numpy as np
 from sklearn.cluster import KMeans
 from scipy.ndimage import uniform_filter1d
+from functools import partial
+from contextlib import closing
+from palette import PaletteFitter, DEFAULT_MAX_SAMPLES, build_palette_lut, calculate_color_percentages
+from parallel import map_frames, map_items, DEFAULT_QUEUE_DEPTH
+from progress import ProgressTracker
+from video_probe import probe_video, read_frames
+from buffers import local_pool
+from instrumentation import timer, count
+from scenes import ScenePalettes, measure_scene_color_percentages, blend_scene_palettes, scene_color_percentages
+from frame_sampling import FrameSampler, interpolate_frames, DEFAULT_ANALYSIS_STRIDE, DEFAULT_CHANGE_THRESHOLD
 
-# Function to process a single frame
-def process_frame(frame, num_dominant_colors, resize_factor, smooth_factor):
-    def rgb_to_hsv(rgb):
-        return cv2.cvtColor(np.uint8([[rgb]]), cv2.COLOR_RGB2HSV)[0][0]
+# Pixels kept per frame by the streaming mode (85x48 for 16:9, about 12 KB): the percentages of the frame are
+# measured on that subsample, so the memory of a streaming run grows by that much per frame whatever the
+# resolution of the source and the resize factor
+STREAMING_FRAME_PIXELS = 4096
 
-    def get_overall_dominant_colors(pixels, num_colors):
-        kmeans = KMeans(n_clusters=num_colors)
-        kmeans.fit(pixels)
-        dominant_colors = kmeans.cluster_centers_.astype(int)
-        return dominant_colors
 
-    def calculate_color_percentages(frame, dominant_colors):
-        pixels = frame.reshape((-1, 3))
-        distances = np.sqrt(((pixels[:, np.newaxis] - dominant_colors) ** 2).sum(axis=2))
-        closest_color_indices = np.argmin(distances, axis=1)
-        unique, counts = np.unique(closest_color_indices, return_counts=True)
-        percentages = np.zeros(len(dominant_colors))
-        percentages[unique] = counts / len(pixels)
-        return percentages
+def rgb_to_hsv(rgb):
+    return cv2.cvtColor(np.uint8([[rgb]]), cv2.COLOR_RGB2HSV)[0][0]
 
-    def create_color_bar_fixed_position(dominant_colors, percentages, frame_height, frame_width):
-        dominant_colors_hsv = [rgb_to_hsv(color) for color in dominant_colors]
-        dominant_colors_sorted = [color for _, color in
-                                  sorted(zip(dominant_colors_hsv, dominant_colors), key=lambda x: x[0][0])]
-        percentages_sorted = [x for _, x in sorted(zip(dominant_colors_hsv, percentages), key=lambda x: x[0][0])]
 
-        color_bar = np.zeros((frame_height, frame_width, 3), dtype=np.uint8)
-        current_x = 0
+# Order in which the palette colors are laid out in the bar (by hue), it only depends on the palette
+def hue_order(dominant_colors):
+    hues = [rgb_to_hsv(color)[0] for color in dominant_colors]
+    return sorted(range(len(dominant_colors)), key=lambda i: hues[i])
 
-        for i, color in enumerate(dominant_colors_sorted):
-            if percentages_sorted[i] > 0:
-                bar_width = int(percentages_sorted[i] * frame_width)
-                next_x = current_x + bar_width
 
-                next_color = dominant_colors_sorted[i + 1] if i < len(dominant_colors_sorted) - 1 else color
+# Function to create a single row of the color bar: each color takes a width proportional to its
+# percentage and blends linearly into the next color of the hue order
+def create_color_bar_row(dominant_colors, percentages, frame_width, order=None):
+    if order is None:
+        order = hue_order(dominant_colors)
+    colors_sorted = np.asarray(dominant_colors, dtype=np.float64)[order]
+    percentages_sorted = np.asarray(percentages)[order]
 
-                # Smooth transition
-                for x in range(current_x, next_x):
-                    if next_x > current_x:  # Ensure there is a range to blend
-                        blend_factor = (x - current_x) / (next_x - current_x)
-                        blended_color = (1 - blend_factor) * color + blend_factor * next_color
-                    else:
-                        blended_color = color  # No blending if no range
+    row = np.empty((frame_width, 3), dtype=np.float64)
+    current_x = 0
 
-                    color_bar[:, x] = blended_color
+    for i, color in enumerate(colors_sorted):
+        if percentages_sorted[i] > 0:
+            next_x = min(current_x + int(percentages_sorted[i] * frame_width), frame_width)
 
-                current_x = next_x
+            # Smooth transition
+            if next_x > current_x:
+                next_color = colors_sorted[i + 1] if i < len(colors_sorted) - 1 else color
+                blend_factor = ((np.arange(current_x, next_x) - current_x) / (next_x - current_x))[:, np.newaxis]
+                row[current_x:next_x] = (1 - blend_factor) * color + blend_factor * next_color
 
-        # Fill remaining width with last color if needed
-        if current_x < frame_width:
-            color_bar[:, current_x:] = dominant_colors_sorted[-1]
+            current_x = next_x
 
-        return color_bar
+    # Fill remaining width with last color if needed
+    row[current_x:] = colors_sorted[-1]
 
-    # Resize frame for faster processing
-    frame_height, frame_width = frame.shape[:2]
-    resized_frame = cv2.resize(frame, (frame_width // resize_factor, frame_height // resize_factor))
+    return row.astype(np.uint8)
 
-    # Flatten pixels and find dominant colors
-    pixels = resized_frame.reshape(-1, 3)
-    dominant_colors = get_overall_dominant_colors(pixels, num_dominant_colors)
 
-    # Calculate percentages and create a color bar
-    percentages = calculate_color_percentages(resized_frame, dominant_colors)
-    smoothed_percentages = uniform_filter1d(np.array([percentages]), size=smooth_factor, axis=0)[0]
-    color_bar = create_color_bar_fixed_position(dominant_colors, smoothed_percentages, frame_height, frame_width)
-
-    return color_bar
+# The bar is the same on every line, so one row is rendered and repeated to the frame height (into out
+# when given)
+def create_color_bar_fixed_position(dominant_colors, percentages, frame_height, frame_width, order=None, out=None):
+    row = create_color_bar_row(dominant_colors, percentages, frame_width, order)
+    if out is None:
+        return np.repeat(row[np.newaxis], frame_height, axis=0)
+    out[:] = row
+    return out
 
 
-def process_video(video_path, output_video_path, num_dominant_colors, resize_factor, smooth_factor):
-    def rgb_to_hsv(rgb):
-        return cv2.cvtColor(np.uint8([[rgb]]), cv2.COLOR_RGB2HSV)[0][0]
-
-    def get_overall_dominant_colors(all_pixels, num_colors):
+# Function to process a single frame.
+# With a palette_state (see palette.PaletteState) the palette fit is warm-started from the previous call,
+# and when frame_key identifies the frame, e.g. (video_path, frame_index), the result is cached per
+# (frame_key, resize_factor, num_dominant_colors).
+def process_frame(frame, num_dominant_colors, resize_factor, smooth_factor, palette_state=None, frame_key=None):
+    def get_overall_dominant_colors(pixels, num_colors):
         kmeans = KMeans(n_clusters=num_colors)
-        kmeans.fit(all_pixels)
+        kmeans.fit(pixels)
         dominant_colors = kmeans.cluster_centers_.astype(int)
         return dominant_colors
 
-    def calculate_color_percentages(frame, dominant_colors):
-        pixels = frame.reshape((-1, 3))
-        distances = np.sqrt(((pixels[:, np.newaxis] - dominant_colors) ** 2).sum(axis=2))
-        closest_color_indices = np.argmin(distances, axis=1)
-        unique, counts = np.unique(closest_color_indices, return_counts=True)
-        percentages = np.zeros(len(dominant_colors))
-        percentages[unique] = counts / len(pixels)
-        return percentages
-
-    def create_color_bar_fixed_position(dominant_colors, percentages, frame_height, frame_width):
-        dominant_colors_hsv = [rgb_to_hsv(color) for color in dominant_colors]
-        dominant_colors_sorted = [color for _, color in
-                                  sorted(zip(dominant_colors_hsv, dominant_colors), key=lambda x: x[0][0])]
-        percentages_sorted = [x for _, x in sorted(zip(dominant_colors_hsv, percentages), key=lambda x: x[0][0])]
-
-        color_bar = np.zeros((frame_height, frame_width, 3), dtype=np.uint8)
-        current_x = 0
-
-        for i, color in enumerate(dominant_colors_sorted):
-            if percentages_sorted[i] > 0:
-                bar_width = int(percentages_sorted[i] * frame_width)
-                next_x = current_x + bar_width
-
-                next_color = dominant_colors_sorted[i + 1] if i < len(dominant_colors_sorted) - 1 else color
+    frame_height, frame_width = frame.shape[:2]
 
-                # Smooth transition
-                for x in range(current_x, next_x):
-                    if next_x > current_x:  # Ensure there is a range to blend
-                        blend_factor = (x - current_x) / (next_x - current_x)
-                        blended_color = (1 - blend_factor) * color + blend_factor * next_color
-                    else:
-                        blended_color = color  # No blending if no range
+    cache_key = None
+    cached = None
+    if palette_state is not None and frame_key is not None:
+        cache_key = (frame_key, resize_factor, num_dominant_colors)
+        cached = palette_state.get(cache_key)
+
+    if cached is not None:
+        dominant_colors, percentages = cached
+    else:
+        # Resize frame for faster processing
+        with timer("resize"):
+            resized_frame = cv2.resize(frame, (frame_width // resize_factor, frame_height // resize_factor))
+
+        # Flatten pixels and find dominant colors
+        pixels = resized_frame.reshape(-1, 3)
+        if palette_state is not None:
+            dominant_colors = palette_state.fit(pixels, num_dominant_colors)
+        else:
+            with timer("fit"):
+                dominant_colors = get_overall_dominant_colors(pixels, num_dominant_colors)
 
-                    color_bar[:, x] = blended_color
+        percentages = calculate_color_percentages(resized_frame, dominant_colors)
+        if cache_key is not None:
+            palette_state.put(cache_key, (dominant_colors, percentages))
 
-                current_x = next_x
+    # Create a color bar from the percentages
+    smoothed_percentages = uniform_filter1d(np.array([percentages]), size=smooth_factor, axis=0)[0]
+    with timer("render"):
+        color_bar = create_color_bar_fixed_position(dominant_colors, smoothed_percentages, frame_height, frame_width)
 
-        # Fill remaining width with last color if needed
-        if current_x < frame_width:
-            color_bar[:, current_x:] = dominant_colors_sorted[-1]
+    return color_bar
 
-        return color_bar
 
+# Per-frame steps of process_video, module-level so that worker processes can run them.
+# resize_frame returns a new array since the streaming mode keeps it.
+def resize_frame(frame, frame_size):
+    with timer("resize"):
+        return cv2.resize(frame, frame_size)
+
+
+# Function to subsample an analysis frame to at most max_pixels pixels for the streaming mode. Nearest
+# neighbour keeps actual pixel colors, so the percentages of the subsample estimate those of the frame.
+def analysis_thumbnail(resized_frame, max_pixels=STREAMING_FRAME_PIXELS):
+    height, width = resized_frame.shape[:2]
+    scale = math.sqrt(max_pixels / (width * height))
+    if scale >= 1:
+        return resized_frame
+    with timer("resize"):
+        return cv2.resize(resized_frame, (max(int(width * scale), 1), max(int(height * scale), 1)),
+                          interpolation=cv2.INTER_NEAREST)
+
+
+def frame_color_percentages(frame, frame_size, dominant_colors, lut=None):
+    with timer("resize"):
+        resized_frame = cv2.resize(frame, frame_size,
+                                   dst=local_pool().get("analysis_frame", (frame_size[1], frame_size[0], 3)))
+    return calculate_color_percentages(resized_frame, dominant_colors, lut)
+
+
+# streaming=True decodes the source once and keeps a subsample of every frame (see STREAMING_FRAME_PIXELS) to
+# measure the percentages on, streaming=False decodes it twice and measures them on the whole analysis frames
+# with a memory footprint that does not grow with the video length.
+# fit_method and max_samples select how the palette is fitted (see palette.PaletteFitter).
+# use_lut assigns pixels through a quantized RGB lookup table instead of the exact nearest color.
+# scenes=True fits one palette per scene instead of one for the whole video (see scenes.ScenePalettes),
+# fit_method and max_samples are then not used.
+# analysis_stride and change_threshold measure the percentages on some frames only and interpolate the others
+# (see frame_sampling.py), the palette is still fitted from every frame.
+# cache is an optional analysis_cache.AnalysisCache.
+# workers > 1 resizes frames and computes the percentages in parallel worker processes.
+# geotagger, when given, is a gpx_handler.FrameGeotagger factory like for pipeline.VideoStage: the geotagged
+# frames are taken from the bars as they are written.
+# progress and cancel are the optional progress callback and cancellation token of progress.ProgressTracker.
+def process_video(video_path, output_video_path, num_dominant_colors, resize_factor, smooth_factor, streaming=False,
+                  fit_method="reservoir", max_samples=DEFAULT_MAX_SAMPLES, use_lut=False, workers=1,
+                  queue_depth=DEFAULT_QUEUE_DEPTH, scenes=False, analysis_stride=DEFAULT_ANALYSIS_STRIDE,
+                  change_threshold=DEFAULT_CHANGE_THRESHOLD, cache=None, geotagger=None, progress=None, cancel=None):
+    tracker = ProgressTracker(progress, cancel)
     cap = cv2.VideoCapture(video_path)
-    original_frame_width = int(cap.get(cv2.CAP_PROP_FRAME_WIDTH))
-    original_frame_height = int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT))
-    fps = int(cap.get(cv2.CAP_PROP_FPS))
+    video_info = probe_video(video_path, cap)
+    original_frame_width = video_info.width
+    original_frame_height = video_info.height
+    fps = int(video_info.fps)
+    total_frames = video_info.frame_count
+
+    # With an analysis_cache.AnalysisCache, a video analysed before with the same settings is only rendered
+    cache_key = None
+    if cache is not None:
+        cache_key = color_analysis_key(cache, video_path, num_dominant_colors, resize_factor, fit_method, max_samples,
+                                       use_lut, scenes, analysis_stride, change_threshold, streaming)
+        cached = cache.get(cache_key)
+        if cached is not None:
+            cap.release()
+            print(f"Using the cached analysis of {video_path}")
+            dominant_colors, color_percentages_list, frame_palettes = load_color_analysis(cached)
+            write_geotagged_color_bar_video(geotagger, total_frames, output_video_path, dominant_colors,
+                                            color_percentages_list, smooth_factor, fps,
+                                            (original_frame_width, original_frame_height), tracker, frame_palettes)
+            return
     frame_width = original_frame_width // resize_factor
     frame_height = original_frame_height // resize_factor
 
-    all_pixels = []
-    while cap.isOpened():
-        ret, frame = cap.read()
-        if not ret:
-            break
-        resized_frame = cv2.resize(frame, (frame_width, frame_height))
-        all_pixels.append(resized_frame.reshape(-1, 3))
-    all_pixels = np.vstack(all_pixels)
-    dominant_colors = get_overall_dominant_colors(all_pixels, num_dominant_colors)
-    cap.release()
-
+    if scenes:
+        palette_fitter = ScenePalettes(num_dominant_colors)
+    else:
+        palette_fitter = PaletteFitter(num_dominant_colors, method=fit_method, max_samples=max_samples)
+    resize = partial(resize_frame, frame_size=(frame_width, frame_height))
+    frame_palettes = None
+    # The palette is fitted from every frame, the percentages are only measured on the frames of the sampler
+    sampler = FrameSampler(analysis_stride, change_threshold)
+
+    try:
+        tracker.start("analysing", total_frames)
+        if streaming:
+            # Decode every frame once: the palette is fitted from the analysis frames as they come, and only a
+            # fixed-size subsample of each is kept for the percentages
+            resized_frames = []
+            with closing(map_frames(cap, resize, workers, queue_depth)) as frames:
+                for resized_frame in frames:
+                    palette_fitter.add(resized_frame)
+                    if sampler.add(resized_frame):
+                        resized_frames.append(analysis_thumbnail(resized_frame))
+                    tracker.update()
+            cap.release()
+
+            if scenes:
+                palettes = palette_fitter.fit()
+                luts = [build_palette_lut(palette) for palette in palettes] if use_lut else None
+                color_percentages_list = measure_scene_color_percentages(resized_frames, palette_fitter, luts, workers,
+                                                                         tracker, sampler.frame_numbers)
+                dominant_colors = palettes[0]
+                frame_palettes = palette_fitter.frame_palettes()
+            else:
+                dominant_colors = palette_fitter.fit()
+                lut = build_palette_lut(dominant_colors) if use_lut else None
+                color_percentages_list = measure_color_percentages(resized_frames, dominant_colors, lut, workers,
+                                                                   tracker)
+            del resized_frames
+        else:
+            with closing(map_frames(cap, resize, workers, queue_depth)) as frames:
+                for resized_frame in frames:
+                    palette_fitter.add(resized_frame)
+                    sampler.add(resized_frame)
+                    tracker.update()
+            cap.release()
+
+            if scenes:
+                palettes = palette_fitter.fit()
+                frame_palettes = palette_fitter.frame_palettes()
+            else:
+                palettes = [palette_fitter.fit()]
+            luts = [build_palette_lut(palette) for palette in palettes] if use_lut else None
+            dominant_colors = palettes[0]
+
+            color_percentages_list = measure_video_color_percentages(
+                video_path, (frame_width, frame_height), palettes, luts,
+                palette_fitter.scene_indices() if scenes else None,
+                None if sampler.every_frame else sampler.frame_numbers, workers, queue_depth, tracker)
+    finally:
+        cap.release()
+
+    if not sampler.every_frame:
+        color_percentages_list = interpolate_frames(sampler.frame_numbers, color_percentages_list, sampler.frame_count)
+
+    if cache_key is not None:
+        if scenes:
+            store_color_analysis(cache, cache_key, palettes, palette_fitter.scene_starts, color_percentages_list)
+        else:
+            store_color_analysis(cache, cache_key, [dominant_colors], [0], color_percentages_list)
+
+    # The bars only depend on the percentages, so the output is written without decoding the source again
+    write_geotagged_color_bar_video(geotagger, total_frames, output_video_path, dominant_colors, color_percentages_list,
+                                    smooth_factor, fps, (original_frame_width, original_frame_height), tracker,
+                                    frame_palettes)
+
+
+# Function to write the bars with write_color_bar_video, handing them to the FrameGeotagger made by geotagger (a
+# factory called like in pipeline.VideoStage) when given
+def write_geotagged_color_bar_video(geotagger, total_frames, output_video_path, dominant_colors, color_percentages_list,
+                                    smooth_factor, fps, frame_size, tracker=None, frame_palettes=None):
+    if geotagger is None:
+        write_color_bar_video(output_video_path, dominant_colors, color_percentages_list, smooth_factor, fps, frame_size,
+                              tracker, frame_palettes=frame_palettes)
+        return
+
+    frame_geotagger = geotagger(video_path=output_video_path, frame_rate=fps, total_frames=total_frames)
+    try:
+        write_color_bar_video(output_video_path, dominant_colors, color_percentages_list, smooth_factor, fps, frame_size,
+                              tracker, frame_geotagger.add, frame_palettes)
+    except BaseException:
+        frame_geotagger.abort()
+        raise
+    frame_geotagger.close()
+
+
+# Cache key of the Cromaticon analysis of a video, everything before the smoothing
+def color_analysis_key(cache, video_path, num_dominant_colors, resize_factor, fit_method, max_samples, use_lut, scenes,
+                       analysis_stride=DEFAULT_ANALYSIS_STRIDE, change_threshold=DEFAULT_CHANGE_THRESHOLD,
+                       streaming=False):
+    # The streaming mode measures the percentages on subsampled frames
+    return cache.key("cromaticon", video_path, num_dominant_colors=num_dominant_colors, resize_factor=resize_factor,
+                     fit_method=fit_method, max_samples=max_samples, use_lut=use_lut, scenes=scenes,
+                     analysis_stride=analysis_stride, change_threshold=change_threshold,
+                     streaming_frame_pixels=STREAMING_FRAME_PIXELS if streaming else None)
+
+
+# Function to store the palettes (one per scene, a single one without scenes), the first frame of every
+# scene and the color percentages of every frame
+def store_color_analysis(cache, key, palettes, scene_starts, color_percentages_list):
+    with cache.writer(key, {"kind": "cromaticon"}) as cache_writer:
+        cache_writer.save("palettes", np.asarray(palettes))
+        cache_writer.save("scene_starts", np.asarray(scene_starts, dtype=np.int64))
+        cache_writer.save("percentages", np.asarray(color_percentages_list, dtype=np.float64))
+        cache_writer.commit()
+
+
+# Function to read a stored analysis back, returns dominant_colors, the color percentages and the palette of
+# every frame (None with a single palette) as write_color_bar_video takes them
+def load_color_analysis(entry):
+    palettes = entry.load("palettes", mmap=False)
+    scene_starts = entry.load("scene_starts", mmap=False)
+    color_percentages_list = entry.load("percentages")
+    frame_palettes = None
+    if len(palettes) > 1:
+        frame_palettes = blend_scene_palettes(palettes, scene_starts.tolist(), len(color_percentages_list))
+    return palettes[0], color_percentages_list, frame_palettes
+
+
+# Function to decode a video again once its palettes are known and measure the color percentages of its frames
+# at frame_size, in parallel when workers > 1. scene_indices holds the index into palettes (and luts) of
+# every frame, a single palette is used when None. frame_numbers, when given, are the only frames measured,
+# the others are skipped with grab(). Memory does not grow with the length of the video.
+def measure_video_color_percentages(video_path, frame_size, palettes, luts=None, scene_indices=None,
+                                    frame_numbers=None, workers=1, queue_depth=DEFAULT_QUEUE_DEPTH, tracker=None):
+    tracker = tracker or ProgressTracker()
+    resize = partial(resize_frame, frame_size=frame_size)
     cap = cv2.VideoCapture(video_path)
-    fourcc = cv2.VideoWriter_fourcc(*'mp4v')
-    out = cv2.VideoWriter(output_video_path, fourcc, fps, (original_frame_width, original_frame_height))
-
-    frame_index = 0
+    total_frames = probe_video(video_path, cap).frame_count
     color_percentages_list = []
 
-    while cap.isOpened():
-        ret, frame = cap.read()
-        if not ret:
-            break
-        resized_frame = cv2.resize(frame, (frame_width, frame_height))
-        percentages = calculate_color_percentages(resized_frame, dominant_colors)
-        color_percentages_list.append(percentages)
-        frame_index += 1
-
+    try:
+        if frame_numbers is not None:
+            resized_frames = (resize(frame) for _, frame in read_frames(cap, frame_numbers))
+            if scene_indices is None:
+                scene_indices = np.zeros(len(frame_numbers), dtype=int)
+            else:
+                scene_indices = scene_indices[frame_numbers]
+            tracker.start("measuring colors", len(frame_numbers))
+            with closing(map_items(partial(scene_color_percentages, palettes=palettes, luts=luts),
+                                   zip(resized_frames, scene_indices), workers)) as percentages:
+                for color_percentages in percentages:
+                    color_percentages_list.append(color_percentages)
+                    tracker.update()
+        elif scene_indices is not None:
+            # The palette depends on the frame, so the frames are only resized by the workers
+            tracker.start("measuring colors", total_frames)
+            with closing(map_frames(cap, resize, workers, queue_depth)) as frames:
+                for resized_frame, scene in zip(frames, scene_indices):
+                    color_percentages_list.append(calculate_color_percentages(
+                        resized_frame, palettes[scene], None if luts is None else luts[scene]))
+                    tracker.update()
+        else:
+            percentages = partial(frame_color_percentages, frame_size=frame_size, dominant_colors=palettes[0],
+                                  lut=None if luts is None else luts[0])
+            tracker.start("measuring colors", total_frames)
+            with closing(map_frames(cap, percentages, workers, queue_depth)) as frames:
+                for color_percentages in frames:
+                    color_percentages_list.append(color_percentages)
+                    tracker.update()
+    finally:
+        cap.release()
+    return color_percentages_list
+
+
+# Function to compute the color percentages of already downscaled frames, in parallel when workers > 1
+def measure_color_percentages(resized_frames, dominant_colors, lut=None, workers=1, tracker=None):
+    tracker = tracker or ProgressTracker()
+    color_percentages_list = []
+    tracker.start("measuring colors", len(resized_frames))
+    with closing(map_items(partial(calculate_color_percentages, dominant_colors=dominant_colors, lut=lut),
+                           resized_frames, workers)) as percentages:
+        for color_percentages in percentages:
+            color_percentages_list.append(color_percentages)
+            tracker.update()
+    return color_percentages_list
+
+
+# Function to write the Cromaticon video from the color percentages of every frame.
+# on_frame(frame_number, color_bar), when given, sees every bar as it is written.
+# frame_palettes, when given, holds the palette of every frame (see scenes.ScenePalettes.frame_palettes), the
+# colors are then laid out in the hue order of dominant_colors.
+def write_color_bar_video(output_video_path, dominant_colors, color_percentages_list, smooth_factor, fps, frame_size,
+                          tracker=None, on_frame=None, frame_palettes=None):
+    tracker = tracker or ProgressTracker()
+    frame_width, frame_height = frame_size
     smoothed_percentages = uniform_filter1d(np.array(color_percentages_list), size=smooth_factor, axis=0)
-    cap.release()
-    cap = cv2.VideoCapture(video_path)
-    frame_index = 0
-
-    while cap.isOpened():
-        ret, frame = cap.read()
-        if not ret:
-            break
-        color_percentages = smoothed_percentages[frame_index]
-        color_bar = create_color_bar_fixed_position(dominant_colors, color_percentages, original_frame_height, original_frame_width)
-        out.write(color_bar)
-        frame_index += 1
-
-    cap.release()
-    out.release()
+    order = hue_order(dominant_colors)
+
+    fourcc = cv2.VideoWriter_fourcc(*'mp4v')
+    out = cv2.VideoWriter(output_video_path, fourcc, fps, (frame_width, frame_height))
+    color_bar_buffer = local_pool().get("color_bar", (frame_height, frame_width, 3))
+
+    try:
+        tracker.start("writing", len(smoothed_percentages))
+        for frame_number, color_percentages in enumerate(smoothed_percentages):
+            colors = dominant_colors if frame_palettes is None else frame_palettes[frame_number]
+            with timer("render"):
+                color_bar = create_color_bar_fixed_position(colors, color_percentages, frame_height, frame_width,
+                                                            order, color_bar_buffer)
+            with timer("encode"):
+                out.write(color_bar)
+            count("frames_encoded")
+            if on_frame is not None:
+                on_frame(frame_number, color_bar)
+            tracker.update()
+    finally:
+        out.release()
     print(f"Video saved as {output_video_path}")
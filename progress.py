@@ -0,0 +1,91 @@
+import time
+
+# Seconds between two progress reports of the same stage
+DEFAULT_REPORT_INTERVAL = 0.25
+
+
+# Raised between two frames when a run is cancelled
+class Cancelled(Exception):
+    pass
+
+
+# Progress of a processing function, reported as a dict to progress(report):
+#   stage: what is being done ("analysing", "pixelating"...)
+#   done, total: frames done and frames expected (total is 0 when the video does not tell its length)
+#   fps: frames per second since the start of the stage
+#   eta: seconds left in the stage, None when unknown
+# cancel is any object with is_set() (e.g. a threading.Event), checked at every update: once set the run
+# stops with Cancelled. Both are optional and reports are throttled to one every min_interval seconds.
+class ProgressTracker:
+    def __init__(self, progress=None, cancel=None, min_interval=DEFAULT_REPORT_INTERVAL):
+        self.progress = progress
+        self.cancel = cancel
+        self.min_interval = min_interval
+        self.stage = None
+        self.total = 0
+        self.done = 0
+
+    def start(self, stage, total):
+        self.check()
+        self.stage = stage
+        self.total = max(int(total), 0)
+        self.done = 0
+        self.start_time = time.perf_counter()
+        self.last_report = None
+        self._report()
+
+    def update(self, count=1):
+        self.check()
+        self.done += count
+        if self.progress is None:
+            return
+        now = time.perf_counter()
+        if self.done == self.total or now - self.last_report >= self.min_interval:
+            self._report(now)
+
+    def check(self):
+        if self.cancel is not None and self.cancel.is_set():
+            raise Cancelled(f"Cancelled while {self.stage}" if self.stage else "Cancelled")
+
+    def _report(self, now=None):
+        if self.progress is None:
+            return
+        now = time.perf_counter() if now is None else now
+        self.last_report = now
+
+        elapsed = now - self.start_time
+        fps = self.done / elapsed if elapsed > 0 else 0.0
+        eta = None
+        if fps > 0 and self.total >= self.done:
+            eta = (self.total - self.done) / fps
+
+        self.progress({"stage": self.stage, "done": self.done, "total": self.total, "fps": fps, "eta": eta})
+
+
+def format_progress(report):
+    text = f"{report['stage']} {report['done']}"
+    if report["total"]:
+        text += f"/{report['total']} ({100 * report['done'] / report['total']:.0f}%)"
+    text += f", {report['fps']:.1f} fps"
+    if report["eta"] is not None:
+        text += f", ETA {report['eta']:.0f}s"
+    return text
+
+
+# Progress callback printing one line every interval seconds, for the command line.
+# A class rather than a closure so that it can be sent to the worker processes of a batch.
+class ProgressPrinter:
+    def __init__(self, prefix="", interval=5.0):
+        self.prefix = prefix
+        self.interval = interval
+        self.last_print = None
+        self.stage = None
+
+    def __call__(self, report):
+        now = time.perf_counter()
+        finished = report["total"] and report["done"] == report["total"]
+        if report["stage"] == self.stage and now - self.last_print < self.interval and not finished:
+            return
+        self.last_print = now
+        self.stage = report["stage"]
+        print(f"{self.prefix}{format_progress(report)}", flush=True)
@@ -0,0 +1,247 @@
+from collections import OrderedDict
+from contextlib import closing
+from functools import partial
+
+import cv2
+import numpy as np
+from scipy.optimize import linear_sum_assignment
+
+from palette import PaletteFitter, calculate_color_percentages
+from parallel import map_items
+from progress import ProgressTracker
+from instrumentation import timer, count
+
+# Bins per channel of the per-frame color histograms (4^3 cells), finer histograms see camera shake and
+# small moving objects as scene changes
+HISTOGRAM_BINS = 4
+
+# Bhattacharyya distances between color histograms (0 for the same colors, 1 for no color in common):
+#   cut:   between a frame and the previous one, a new scene starts at a hard cut
+#   drift: between a frame and the mean histogram of its scene so far, a new scene starts when the
+#          landscape has changed slowly but too much for one palette
+#   match: between two scenes, a known palette is reused instead of fitting a new one
+DEFAULT_CUT_THRESHOLD = 0.5
+DEFAULT_DRIFT_THRESHOLD = 0.5
+DEFAULT_MATCH_THRESHOLD = 0.2
+
+# Shortest scene, a cut closer than that to the start of the scene is ignored (flashes, fast pans)
+DEFAULT_MIN_SCENE_FRAMES = 15
+
+# Every keyframe_interval-th frame (and the first frame of every scene) is sampled to fit the palettes
+DEFAULT_KEYFRAME_INTERVAL = 30
+
+# Pixels sampled from the keyframes of a scene for its palette
+DEFAULT_SCENE_MAX_SAMPLES = 50000
+
+# Frames over which the palette of a scene blends into the next one, centered on the scene change
+DEFAULT_TRANSITION_FRAMES = 15
+
+# Palettes kept by a ScenePaletteCache
+DEFAULT_MAX_CACHED_PALETTES = 32
+
+
+# Function to compute the normalized color histogram of a frame
+def frame_histogram(frame):
+    histogram = cv2.calcHist([frame], [0, 1, 2], None, [HISTOGRAM_BINS] * 3, [0, 256] * 3)
+    return (histogram / max(histogram.sum(), 1)).ravel()
+
+
+def histogram_distance(histogram, other):
+    return cv2.compareHist(histogram, other, cv2.HISTCMP_BHATTACHARYYA)
+
+
+# Splits a stream of frame histograms into scenes, see the thresholds above
+class SceneDetector:
+    def __init__(self, cut_threshold=DEFAULT_CUT_THRESHOLD, drift_threshold=DEFAULT_DRIFT_THRESHOLD,
+                 min_scene_frames=DEFAULT_MIN_SCENE_FRAMES):
+        self.cut_threshold = cut_threshold
+        self.drift_threshold = drift_threshold
+        self.min_scene_frames = min_scene_frames
+        self.previous = None
+        self.reference = None
+        self.scene_length = 0
+
+    # Returns whether the frame of this histogram starts a new scene (always true for the first frame)
+    def add(self, histogram):
+        new_scene = self.previous is None
+        if not new_scene and self.scene_length >= self.min_scene_frames:
+            new_scene = (histogram_distance(self.previous, histogram) > self.cut_threshold or
+                         histogram_distance(self.reference, histogram) > self.drift_threshold)
+
+        if new_scene:
+            self.reference = histogram.copy()
+            self.scene_length = 0
+        else:
+            # Running mean of the scene
+            self.reference += (histogram - self.reference) / (self.scene_length + 1)
+        self.previous = histogram
+        self.scene_length += 1
+        return new_scene
+
+
+# Palettes of the scenes seen so far, looked up by the color histogram of a scene: a scene that looks like
+# an earlier one (the same stretch of road seen twice, the sky after a tunnel) reuses its palette.
+# The least recently used palettes are dropped beyond max_cached.
+class ScenePaletteCache:
+    def __init__(self, match_threshold=DEFAULT_MATCH_THRESHOLD, max_cached=DEFAULT_MAX_CACHED_PALETTES):
+        self.match_threshold = match_threshold
+        self.max_cached = max_cached
+        self.entries = OrderedDict()
+        self.next_key = 0
+
+    # Palette of the closest cached scene within match_threshold, None if there is none
+    def find(self, histogram, num_colors):
+        best_key, best_distance = None, self.match_threshold
+        for key, (cached_histogram, palette) in self.entries.items():
+            if len(palette) != num_colors:
+                continue
+            distance = histogram_distance(cached_histogram, histogram)
+            if distance <= best_distance:
+                best_key, best_distance = key, distance
+        if best_key is None:
+            return None
+        self.entries.move_to_end(best_key)
+        return self.entries[best_key][1]
+
+    def put(self, histogram, palette):
+        self.entries[self.next_key] = (histogram, palette)
+        self.next_key += 1
+        while len(self.entries) > self.max_cached:
+            self.entries.popitem(last=False)
+
+
+# Function to reorder the colors of a palette so that each one takes the slot of the closest color of the
+# reference palette (Hungarian matching), so that the slots stay the same from one scene to the next
+def align_palette(reference, palette):
+    distances = np.linalg.norm(np.asarray(reference, dtype=np.float64)[:, np.newaxis] -
+                               np.asarray(palette, dtype=np.float64)[np.newaxis], axis=2)
+    reference_slots, palette_slots = linear_sum_assignment(distances)
+    aligned = np.empty_like(palette)
+    aligned[reference_slots] = palette[palette_slots]
+    return aligned
+
+
+# Fits one palette per scene instead of one for the whole video. Frames are added one at a time like with
+# palette.PaletteFitter: their histograms split the video into scenes (see SceneDetector) and the pixels of
+# the keyframes go to a reservoir of max_samples pixels for the current scene. When the scene ends its
+# palette is fitted from that reservoir, or reused from a matching scene of the cache, and the reservoir is
+# dropped: only the palettes stay in memory, so the fit cost and the memory grow with the number of scenes
+# rather than with the number of frames. The palettes are aligned slot by slot, see align_palette.
+class ScenePalettes:
+    def __init__(self, num_colors, max_samples=DEFAULT_SCENE_MAX_SAMPLES, keyframe_interval=DEFAULT_KEYFRAME_INTERVAL,
+                 cut_threshold=DEFAULT_CUT_THRESHOLD, drift_threshold=DEFAULT_DRIFT_THRESHOLD,
+                 min_scene_frames=DEFAULT_MIN_SCENE_FRAMES, transition_frames=DEFAULT_TRANSITION_FRAMES, cache=None,
+                 seed=None):
+        self.num_colors = num_colors
+        self.max_samples = max_samples
+        self.keyframe_interval = max(keyframe_interval, 1)
+        self.transition_frames = transition_frames
+        self.cache = cache if cache is not None else ScenePaletteCache()
+        self.seed = seed
+        self.detector = SceneDetector(cut_threshold, drift_threshold, min_scene_frames)
+
+        self.frame_count = 0
+        self.scene_starts = []
+        self.scene_palettes = []  # Palettes of the finished scenes
+        # Current scene: keyframe pixels, sum and number of the keyframe histograms
+        self.scene_fitter = None
+        self.scene_histogram = None
+        self.scene_keyframes = 0
+        self.palettes = None
+
+    def add(self, frame):
+        with timer("scene_detect"):
+            histogram = frame_histogram(frame)
+            new_scene = self.detector.add(histogram)
+        if new_scene:
+            self._finish_scene()
+            self.scene_starts.append(self.frame_count)
+            self.scene_fitter = PaletteFitter(self.num_colors, method="reservoir", max_samples=self.max_samples,
+                                              seed=self.seed)
+            self.scene_histogram = np.zeros_like(histogram, dtype=np.float64)
+            self.scene_keyframes = 0
+        if new_scene or self.frame_count % self.keyframe_interval == 0:
+            self.scene_fitter.add(frame)
+            self.scene_histogram += histogram
+            self.scene_keyframes += 1
+        self.frame_count += 1
+
+    # Function to fit (or find in the cache) the palette of the current scene and drop its pixels
+    def _finish_scene(self):
+        if self.scene_fitter is None:
+            return
+        histogram = (self.scene_histogram / self.scene_keyframes).astype(np.float32)
+        palette = self.cache.find(histogram, self.num_colors)
+        if palette is None:
+            palette = self.scene_fitter.fit()
+            self.cache.put(histogram, palette)
+            count("scene_palettes_fitted")
+        else:
+            count("scene_palettes_reused")
+
+        if self.scene_palettes:
+            palette = align_palette(self.scene_palettes[-1], palette)
+        self.scene_palettes.append(palette)
+        self.scene_fitter = None
+        self.scene_histogram = None
+
+    def fit(self):
+        if not self.frame_count:
+            raise ValueError("Not enough pixels to fit the palette.")
+
+        self._finish_scene()
+        self.palettes = np.array(self.scene_palettes)
+        return self.palettes
+
+    # Scene of every frame, as indices into palettes
+    def scene_indices(self):
+        scene_lengths = np.diff(self.scene_starts + [self.frame_count])
+        return np.repeat(np.arange(len(self.scene_starts)), scene_lengths)
+
+    def frame_palettes(self):
+        return blend_scene_palettes(self.palettes, self.scene_starts, self.frame_count, self.transition_frames)
+
+
+# Function to get the palette of every frame (float, frame_count x num_colors x 3) from the palettes of the
+# scenes and the first frame of each: the palette of its scene, blended with the palette of the neighbouring
+# scene over transition_frames around every scene change
+def blend_scene_palettes(palettes, scene_starts, frame_count, transition_frames=DEFAULT_TRANSITION_FRAMES):
+    scene_starts = list(scene_starts)
+    scene_ends = scene_starts[1:] + [frame_count]
+    scene_lengths = np.diff(scene_starts + [frame_count])
+    frame_palettes = np.asarray(palettes)[np.repeat(np.arange(len(scene_starts)), scene_lengths)].astype(np.float64)
+    for scene in range(1, len(scene_starts)):
+        change = scene_starts[scene]
+        # Never reach past the middle of either scene
+        half = min(transition_frames // 2, (change - scene_starts[scene - 1]) // 2, (scene_ends[scene] - change) // 2)
+        if half <= 0:
+            continue
+        blend = ((np.arange(2 * half) + 0.5) / (2 * half))[:, np.newaxis, np.newaxis]
+        frame_palettes[change - half:change + half] = (1 - blend) * palettes[scene - 1] + blend * palettes[scene]
+    return frame_palettes
+
+
+# Per-frame step of measure_scene_color_percentages, module-level so that worker processes can run it
+def scene_color_percentages(item, palettes, luts=None):
+    frame, scene = item
+    return calculate_color_percentages(frame, palettes[scene], None if luts is None else luts[scene])
+
+
+# Function to compute the color percentages of already downscaled frames against the palette of their
+# scene, in parallel when workers > 1. luts, when given, holds the lookup table of every scene.
+# frame_numbers, when given, are the numbers of the frames in resized_frames if not every frame was kept.
+def measure_scene_color_percentages(resized_frames, scene_palettes, luts=None, workers=1, tracker=None,
+                                    frame_numbers=None):
+    tracker = tracker or ProgressTracker()
+    color_percentages_list = []
+    tracker.start("measuring colors", len(resized_frames))
+    scene_indices = scene_palettes.scene_indices()
+    if frame_numbers is not None:
+        scene_indices = scene_indices[frame_numbers]
+    items = zip(resized_frames, scene_indices)
+    with closing(map_items(partial(scene_color_percentages, palettes=scene_palettes.palettes, luts=luts),
+                           items, workers)) as percentages:
+        for color_percentages in percentages:
+            color_percentages_list.append(color_percentages)
+            tracker.update()
+    return color_percentages_list
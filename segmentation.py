@@ -1,10 +1,38 @@
 import numpy as np
 import cv2
+import threading
+from functools import partial
+from contextlib import closing
+from parallel import map_frames, resolve_workers, DEFAULT_QUEUE_DEPTH
+from progress import ProgressTracker
+from video_probe import probe_video
+from buffers import local_pool
+from instrumentation import timer, timed, count, observe
+from frame_sampling import FrameSampler, DEFAULT_ANALYSIS_STRIDE, DEFAULT_CHANGE_THRESHOLD
 
-def run_segmentation(model_path, classes_path, colors_path, video_path, output_video_path=None, resize_factor=1, show=False, preview=False):
-    # Load class labels
-    CLASSES = open(classes_path).read().strip().split("\n")
+# Preferable backend and target of the network:
+#   default:  OpenCV's default backend
+#   openvino: OpenVINO inference engine on the CPU when OpenCV was built with it, otherwise default
+#   fp16:     OpenCV's own CPU backend in half precision (OpenCV falls back to FP32 on CPUs without FP16)
+DNN_BACKENDS = ("default", "openvino", "fp16")
 
+# Layers of OpenCV's DNN module that only accept one image per forward pass (ENet uses MaxUnpool)
+UNBATCHED_LAYER_TYPES = {"MaxUnpool"}
+
+# Sessions already loaded in this process, see get_session
+_sessions = {}
+
+# Whether each model accepts batches, see model_supports_batches
+_batch_support = {}
+
+
+# Function to load the class labels
+def load_classes(classes_path):
+    return open(classes_path).read().strip().split("\n")
+
+
+# Function to load the color of every class from a colors file, or random colors without one
+def load_colors(colors_path, CLASSES):
     # If a colors file was supplied, load it
     if colors_path:
         COLORS = open(colors_path).read().strip().split("\n")
@@ -15,77 +43,459 @@ def run_segmentation(model_path, classes_path, colors_path, video_path, output_v
         np.random.seed(42)
         COLORS = np.random.randint(0, 255, size=(len(CLASSES) - 1, 3), dtype="uint8")
         COLORS = np.vstack([[0, 0, 0], COLORS]).astype("uint8")
+    return COLORS
+
+
+# Function to load the network and select its backend, which must happen before the first forward pass
+def load_net(model_path, backend="default"):
+    if backend not in DNN_BACKENDS:
+        raise ValueError(f"Unknown DNN backend: {backend}")
 
-    # Load the deep learning segmentation model
-    print("[INFO] Loading model...")
     net = cv2.dnn.readNet(model_path)
 
+    if backend == "openvino":
+        if cv2.dnn.DNN_TARGET_CPU in cv2.dnn.getAvailableTargets(cv2.dnn.DNN_BACKEND_INFERENCE_ENGINE):
+            net.setPreferableBackend(cv2.dnn.DNN_BACKEND_INFERENCE_ENGINE)
+            net.setPreferableTarget(cv2.dnn.DNN_TARGET_CPU)
+        else:
+            print("[INFO] OpenVINO is not available, using the default backend")
+    elif backend == "fp16":
+        net.setPreferableBackend(cv2.dnn.DNN_BACKEND_OPENCV)
+        net.setPreferableTarget(cv2.dnn.DNN_TARGET_CPU_FP16)
+
+    return net
+
+
+def supports_batches(net):
+    return not UNBATCHED_LAYER_TYPES.intersection(net.getLayerTypes())
+
+
+# Function to check once per model whether batch_size can have any effect, before anything is run
+def model_supports_batches(model_path):
+    if model_path not in _batch_support:
+        _batch_support[model_path] = supports_batches(load_net(model_path))
+    return _batch_support[model_path]
+
+
+# Network input size (width, height)
+NET_INPUT_SIZE = (1024, 512)
+
+
+# Function to build the network input like cv2.dnn.blobFromImages(frames, 1 / 255.0, NET_INPUT_SIZE, 0,
+# swapRB=True) does, into a blob of the pool
+def blob_from_frames(frames, pool):
+    width, height = NET_INPUT_SIZE
+    blob = pool.get("blob", (len(frames), 3, height, width), np.float32)
+    resized = pool.get("blob_frame", (height, width, 3))
+    for i, frame in enumerate(frames):
+        cv2.resize(frame, NET_INPUT_SIZE, dst=resized)
+        # HWC BGR to CHW RGB, scaled to [0, 1]
+        np.multiply(resized.transpose(2, 0, 1)[::-1], 1 / 255.0, out=blob[i], casting="unsafe")
+    return blob
+
+
+# Function to run the network on a list of resized frames: a single forward pass for the whole batch
+# when the network supports it, otherwise one pass per frame on the same blob. With a pool (see
+# buffers.BufferPool) the blob is built in a reused buffer.
+def forward_frames(net, resized_frames, batched=False, pool=None):
+    with timer("blob"):
+        if pool is not None:
+            blob = blob_from_frames(resized_frames, pool)
+        else:
+            blob = cv2.dnn.blobFromImages(resized_frames, 1 / 255.0, NET_INPUT_SIZE, 0, swapRB=True, crop=False)
+
+    if batched and len(resized_frames) > 1:
+        net.setInput(blob)
+        with timer("forward"):
+            return list(net.forward())
+
+    outputs = []
+    for i in range(len(resized_frames)):
+        net.setInput(blob[i:i + 1])
+        with timer("forward"):
+            outputs.append(net.forward()[0])
+    return outputs
+
+
+# Function to find the class ID with the largest score for each pixel as a uint8 class map.
+# A running maximum over the contiguous class planes is cheaper than np.argmax across them, ties go
+# to the lowest class ID as with np.argmax. With a pool the class map is its buffer called name.
+def class_map_from_output(output, pool=None, name="class_map"):
+    if pool is None:
+        best = output[0].copy()
+        classMap = np.zeros(output.shape[1:], dtype=np.uint8)
+        better = np.empty(output.shape[1:], dtype=bool)
+    else:
+        best = pool.get("best_score", output.shape[1:], output.dtype)
+        np.copyto(best, output[0])
+        classMap = pool.get(name, output.shape[1:])
+        classMap.fill(0)
+        better = pool.get("better_score", output.shape[1:], bool)
+    for class_id in range(1, len(output)):
+        np.greater(output[class_id], best, out=better)
+        np.maximum(best, output[class_id], out=best)
+        np.copyto(classMap, class_id, where=better)
+    return classMap
+
+
+# Index of the only class with a color when a single class is shown (vegetation, building, sky), else None
+def single_target_class(COLORS):
+    targets = np.flatnonzero(COLORS.any(axis=1))
+    return int(targets[0]) if len(targets) == 1 else None
+
+
+# Function to mark the pixels where target is the class with the largest score, without a full argmax
+def target_map_from_output(output, target, pool=None):
+    if pool is None:
+        is_target = np.ones(output.shape[1:], dtype=bool)
+        if target > 0:
+            is_target &= output[target] > output[:target].max(axis=0)
+        if target < len(output) - 1:
+            is_target &= output[target] >= output[target + 1:].max(axis=0)
+        return is_target.view(np.uint8)
+
+    is_target = pool.get("target_map", output.shape[1:], bool)
+    is_target.fill(True)
+    other_best = pool.get("other_score", output.shape[1:], output.dtype)
+    compared = pool.get("target_compared", output.shape[1:], bool)
+    if target > 0:
+        np.max(output[:target], axis=0, out=other_best)
+        is_target &= np.greater(output[target], other_best, out=compared)
+    if target < len(output) - 1:
+        np.max(output[target + 1:], axis=0, out=other_best)
+        is_target &= np.greater_equal(output[target], other_best, out=compared)
+    return is_target.view(np.uint8)
+
+
+# Function to color a class map and resize it straight to the output size.
+# With a pool the mask is the pool buffer called name.
+def mask_from_class_map(classMap, COLORS, output_size, pool=None, name="mask"):
+    if pool is None:
+        return cv2.resize(COLORS[classMap], output_size, interpolation=cv2.INTER_NEAREST)
+
+    colored = np.take(COLORS, classMap, axis=0, out=pool.get("colored_classes", classMap.shape + (3,)))
+    width, height = output_size
+    return cv2.resize(colored, output_size, dst=pool.get(name, (height, width, 3)), interpolation=cv2.INTER_NEAREST)
+
+
+# Function to turn the network output of one frame into its color mask at the output size
+@timed("render")
+def mask_from_output(output, COLORS, output_size, pool=None, name="mask"):
+    target = single_target_class(COLORS)
+    if target is None:
+        return mask_from_class_map(class_map_from_output(output, pool), COLORS, output_size, pool, name)
+
+    # Binary mode: every other class is black, so only the target score needs to be compared
+    binary_colors = np.array([[0, 0, 0], COLORS[target]], dtype=np.uint8)
+    return mask_from_class_map(target_map_from_output(output, target, pool), binary_colors, output_size, pool, name)
+
+
+# Function to resize a batch of frames for faster processing, into buffers of the pool when given
+def resize_frames(frames, resize_factor, pool=None):
+    resized_frames = []
+    for i, frame in enumerate(frames):
+        resized_size = (frame.shape[1] // resize_factor, frame.shape[0] // resize_factor)
+        dst = None if pool is None else pool.get(f"segment_resized{i}", (resized_size[1], resized_size[0], 3))
+        with timer("resize"):
+            resized_frames.append(cv2.resize(frame, resized_size, dst=dst))
+    return resized_frames
+
+
+# Function to segment a batch of frames with an already loaded network and map them to the class colors.
+# With a pool (see buffers.BufferPool) the intermediate images and the masks are its buffers, and the
+# masks are only valid until the next batch.
+def segment_frames_with_net(net, frames, COLORS, resize_factor, output_size, batched=False, pool=None):
+    outputs = forward_frames(net, resize_frames(frames, resize_factor, pool), batched, pool)
+
+    return [mask_from_output(output, COLORS, output_size, pool, f"mask{i}") for i, output in enumerate(outputs)]
+
+
+# Function to compute the class maps of a batch of frames (uint8 class IDs at the resolution of the network
+# output), from which the masks of any color table are drawn with mask_from_class_map. With a pool the class
+# maps are its buffers and are only valid until the next batch.
+def class_maps_with_net(net, frames, resize_factor, batched=False, pool=None):
+    outputs = forward_frames(net, resize_frames(frames, resize_factor, pool), batched, pool)
+    return [class_map_from_output(output, pool, f"class_map{i}") for i, output in enumerate(outputs)]
+
+
+# A loaded segmentation model: the network, its class labels and the color tables used so far.
+# Color tables (vegetation, building, sky...) are swapped with set_colors without reloading the network,
+# and the same session serves the GUI preview and the full video runs.
+class SegmentationSession:
+    def __init__(self, model_path, classes_path, backend="default"):
+        self.model_path = model_path
+        self.classes_path = classes_path
+        self.backend = backend
+        self.CLASSES = load_classes(classes_path)
+
+        print("[INFO] Loading model...")
+        self.net = load_net(model_path, backend)
+        self.batched = supports_batches(self.net)
+
+        # A network can only run one forward pass at a time
+        self.lock = threading.Lock()
+        self.color_tables = {}
+        self.COLORS = self.colors(None)
+
+    # Color table of a colors file, loaded once per session
+    def colors(self, colors_path):
+        if colors_path not in self.color_tables:
+            self.color_tables[colors_path] = load_colors(colors_path, self.CLASSES)
+        return self.color_tables[colors_path]
+
+    def set_colors(self, colors_path):
+        self.COLORS = self.colors(colors_path)
+
+    # Masks of a list of frames, at output_size (width, height) or at the size of the frames.
+    # With a pool the masks are its buffers (see segment_frames_with_net).
+    def segment_frames(self, frames, resize_factor=1, output_size=None, COLORS=None, pool=None):
+        if output_size is None:
+            output_size = (frames[0].shape[1], frames[0].shape[0])
+        if COLORS is None:
+            COLORS = self.COLORS
+        with self.lock:
+            return segment_frames_with_net(self.net, frames, COLORS, resize_factor, output_size,
+                                           self.batched and len(frames) > 1, pool)
+
+    def segment_frame(self, frame, resize_factor=1, output_size=None, COLORS=None):
+        return self.segment_frames([frame], resize_factor, output_size, COLORS)[0]
+
+    # Class maps of a list of frames, see class_maps_with_net
+    def class_maps(self, frames, resize_factor=1, pool=None):
+        with self.lock:
+            return class_maps_with_net(self.net, frames, resize_factor, self.batched and len(frames) > 1, pool)
+
+
+# Function to get the session of a model, loading it only the first time in this process
+def get_session(model_path, classes_path, backend="default"):
+    key = (model_path, classes_path, backend)
+    if key not in _sessions:
+        _sessions[key] = SegmentationSession(model_path, classes_path, backend)
+    return _sessions[key]
+
+
+# Function to segment a single already decoded frame, like process_frame and pixelate_frame do
+def segment_frame(frame, model_path, classes_path, colors_path, resize_factor=1, backend="default"):
+    session = get_session(model_path, classes_path, backend)
+    return session.segment_frame(frame, resize_factor, COLORS=session.colors(colors_path))
+
+
+# Function to segment one frame in a worker process of a parallel run, every worker keeps its own session.
+# The mask is a buffer of the calling thread (see buffers.local_pool), valid until the next call.
+def segment_video_frame(frame, model_path, classes_path, colors_path, resize_factor, output_size, backend="default"):
+    session = get_session(model_path, classes_path, backend)
+    return session.segment_frames([frame], resize_factor, output_size, session.colors(colors_path), local_pool())[0]
+
+
+# Function to compute the class map of one frame in a worker process of a parallel run
+def video_frame_class_map(frame, model_path, classes_path, resize_factor, backend="default"):
+    session = get_session(model_path, classes_path, backend)
+    return session.class_maps([frame], resize_factor, local_pool())[0]
+
+
+# Function to read the frames of an open capture batch_size at a time, into reused buffers of the pool
+def read_batches(vs, batch_size, pool):
+    while True:
+        frames = []
+        while len(frames) < batch_size:
+            with timer("decode"):
+                grabbed, frame = pool.read(vs, f"frame{len(frames)}")
+            if not grabbed:
+                break
+            count("frames_decoded")
+            frames.append(frame)
+        if not frames:
+            break
+        observe("batch_size", len(frames))
+        yield frames
+
+
+# Function to segment the frames of an open capture batch_size at a time, yielding the masks in order.
+# Frames and masks are reused buffers of the calling thread, a mask is only valid until the next one.
+def segment_batches(vs, session, COLORS, resize_factor, output_size, batch_size):
+    pool = local_pool()
+    for frames in read_batches(vs, batch_size, pool):
+        yield from session.segment_frames(frames, resize_factor, output_size, COLORS, pool)
+
+
+# Function to compute the class maps of the frames of an open capture batch_size at a time, in order.
+# Class maps are reused buffers of the calling thread, a class map is only valid until the next batch.
+def class_map_batches(vs, session, resize_factor, batch_size):
+    pool = local_pool()
+    for frames in read_batches(vs, batch_size, pool):
+        yield from session.class_maps(frames, resize_factor, pool)
+
+
+# Function to compute the class maps of the frames of an open capture chosen by sampler (a
+# frame_sampling.FrameSampler), yielding the class map of every analysed frame and None for the frames in
+# between, which hold the class map of the last analysed one. A class map is only valid until the next one.
+def sampled_class_maps(vs, session, resize_factor, sampler):
+    pool = local_pool()
+    while True:
+        with timer("decode"):
+            grabbed, frame = pool.read(vs, "sampled_frame")
+        if not grabbed:
+            break
+        count("frames_decoded")
+        if sampler.add(frame):
+            yield session.class_maps([frame], resize_factor, pool)[0]
+        else:
+            yield None
+
+
+# Function to draw the masks of a sequence of class maps, saving every class map to store (an
+# analysis_cache.FrameArrayWriter) when given. None in class_maps holds the class map of the previous frame
+# and keeps the mask drawn last. A mask is only valid until the next one.
+def masks_from_class_maps(class_maps, COLORS, output_size, store=None):
+    pool = local_pool()
+    class_map = mask = None
+    for next_class_map in class_maps:
+        if next_class_map is not None:
+            class_map = next_class_map
+            with timer("render"):
+                mask = mask_from_class_map(class_map, COLORS, output_size, pool)
+        if store is not None:
+            store.append(class_map)
+        yield mask
+
+
+# workers > 1 segments frames in parallel worker processes (each with one OpenCV thread), otherwise
+# batch_size frames go through the network together. backend is one of DNN_BACKENDS and num_threads
+# sets the number of OpenCV threads of this process. progress and cancel are the optional progress callback
+# and cancellation token of progress.ProgressTracker.
+# With a cache (see analysis_cache.AnalysisCache) the class maps of the video are saved, and a later run
+# with the same model and resize factor draws the masks from them, with any color table, without decoding
+# the video or running the network.
+# analysis_stride and change_threshold run the network on some frames only, the frames in between hold the
+# class map of the last analysed one (see frame_sampling.py). Those frames are segmented in this process.
+# geotagger, when given, is a gpx_handler.FrameGeotagger factory like for pipeline.VideoStage: the geotagged
+# frames are taken from the masks as they are written.
+def run_segmentation(model_path, classes_path, colors_path, video_path, output_video_path=None, resize_factor=1, show=False, preview=False,
+                     workers=1, queue_depth=DEFAULT_QUEUE_DEPTH, batch_size=1, backend="default", num_threads=None,
+                     analysis_stride=DEFAULT_ANALYSIS_STRIDE, change_threshold=DEFAULT_CHANGE_THRESHOLD, cache=None,
+                     geotagger=None, progress=None, cancel=None):
+    tracker = ProgressTracker(progress, cancel)
+
     # Initialize video stream
     vs = cv2.VideoCapture(video_path)
 
     # Retrieve the input video's FPS and original dimensions
-    fps = vs.get(cv2.CAP_PROP_FPS)
-    orig_width = int(vs.get(cv2.CAP_PROP_FRAME_WIDTH))
-    orig_height = int(vs.get(cv2.CAP_PROP_FRAME_HEIGHT))
+    video_info = probe_video(video_path, vs)
+    fps = video_info.fps
+    orig_width = video_info.width
+    orig_height = video_info.height
+
+    if num_threads is not None:
+        cv2.setNumThreads(num_threads)
+
+    cached = None
+    cache_writer = None
+    if cache is not None and not preview:
+        cache_key = cache.key("segmentation", video_path, files=(model_path,), resize_factor=resize_factor,
+                              backend=backend, analysis_stride=analysis_stride, change_threshold=change_threshold)
+        cached = cache.get(cache_key)
+        if cached is None:
+            cache_writer = cache.writer(cache_key, {"video_path": video_path})
+
+    # Get the deep learning segmentation model, in parallel runs every worker process loads its own copy
+    workers = 1 if preview else resolve_workers(workers)
+    sampler = FrameSampler(analysis_stride, change_threshold)
+    if cached is not None:
+        print(f"[INFO] Using the cached class maps of {video_path}")
+        COLORS = load_colors(colors_path, load_classes(classes_path))
+        masks = masks_from_class_maps(cached.frames("class_maps"), COLORS, (orig_width, orig_height))
+    elif cache_writer is not None or not (preview or sampler.every_frame):
+        # Full class maps are computed (not only the highlighted class) so that any color table can be drawn
+        # from the cache, and so that they can be held between the analysed frames
+        class_maps_store = None if cache_writer is None else cache_writer.frame_array("class_maps",
+                                                                                      video_info.frame_count)
+        COLORS = load_colors(colors_path, load_classes(classes_path))
+        if not sampler.every_frame:
+            if workers > 1:
+                print("[INFO] Only some frames are analysed, segmenting them in this process")
+            session = get_session(model_path, classes_path, backend)
+            class_maps = sampled_class_maps(vs, session, resize_factor, sampler)
+        elif workers > 1:
+            transform = partial(video_frame_class_map, model_path=model_path, classes_path=classes_path,
+                                resize_factor=resize_factor, backend=backend)
+            class_maps = map_frames(vs, transform, workers, queue_depth)
+        else:
+            session = get_session(model_path, classes_path, backend)
+            class_maps = class_map_batches(vs, session, resize_factor, max(batch_size, 1))
+        masks = masks_from_class_maps(class_maps, COLORS, (orig_width, orig_height), class_maps_store)
+    elif workers > 1:
+        transform = partial(segment_video_frame, model_path=model_path, classes_path=classes_path,
+                            colors_path=colors_path, resize_factor=resize_factor,
+                            output_size=(orig_width, orig_height), backend=backend)
+        masks = map_frames(vs, transform, workers, queue_depth, output_shape=(orig_height, orig_width, 3))
+    else:
+        session = get_session(model_path, classes_path, backend)
+        batch_size = 1 if preview else max(batch_size, 1)
+        masks = segment_batches(vs, session, session.colors(colors_path), resize_factor, (orig_width, orig_height),
+                                batch_size)
 
     # Full video generation: initialize the writer if we're not in preview mode
     writer = None
     if not preview and output_video_path:
         fourcc = cv2.VideoWriter_fourcc(*"mp4v")  # Use "mp4v" codec for MP4 files
         writer = cv2.VideoWriter(output_video_path, fourcc, fps, (orig_width, orig_height), True)
+    frame_geotagger = None
+    if writer is not None and geotagger is not None:
+        frame_geotagger = geotagger(video_path=output_video_path, frame_rate=fps, total_frames=video_info.frame_count)
 
     frame_number = 0
+    stopped = False
 
-    while True:
-        grabbed, frame = vs.read()
-        if not grabbed:
-            break
-
-        # Resize the frame for faster processing
-        resized_frame = cv2.resize(frame, (frame.shape[1] // resize_factor, frame.shape[0] // resize_factor))
-
-        # Prepare the frame for segmentation
-        blob = cv2.dnn.blobFromImage(resized_frame, 1 / 255.0, (1024, 512), 0, swapRB=True, crop=False)
-        net.setInput(blob)
-        output = net.forward()
-
-        # Get the number of classes and the dimensions of the mask
-        (numClasses, height, width) = output.shape[1:4]
+    try:
+        tracker.start("segmenting", 1 if preview else video_info.frame_count)
+        with closing(masks):
+            for mask_final in masks:
+                # If in preview mode, return the processed single frame
+                if preview:
+                    return mask_final  # Return the frame for previewing
 
-        # Find the class ID with the largest probability for each pixel
-        classMap = np.argmax(output[0], axis=0)
+                # Otherwise, write the full video
+                if writer is not None:
+                    with timer("encode"):
+                        writer.write(mask_final)
+                    count("frames_encoded")
+                    if frame_geotagger is not None:
+                        frame_geotagger.add(frame_number, mask_final)
 
-        # Map the class IDs to colors
-        mask = COLORS[classMap]
+                # Optionally display the output frame in real-time
+                if show:
+                    cv2.imshow("Frame", mask_final)
+                    key = cv2.waitKey(1) & 0xFF
+                    if key == ord("q"):
+                        stopped = True
+                        break
 
-        # Resize the mask back to the original frame size
-        mask_resized = cv2.resize(mask, (resized_frame.shape[1], resized_frame.shape[0]), interpolation=cv2.INTER_NEAREST)
-        mask_final = cv2.resize(mask_resized, (orig_width, orig_height), interpolation=cv2.INTER_NEAREST)
+                frame_number += 1
+                tracker.update()
 
-        # If in preview mode, return the processed single frame
-        if preview:
-            vs.release()
-            return mask_final  # Return the frame for previewing
-
-        # Otherwise, write the full video
+        # Only the class maps of the whole video are kept
+        if cache_writer is not None and not stopped:
+            cache_writer.commit()
+        if frame_geotagger is not None:
+            if stopped:
+                frame_geotagger.abort()
+            else:
+                frame_geotagger.close()
+            frame_geotagger = None
+    except BaseException:
+        if frame_geotagger is not None:
+            frame_geotagger.abort()
+        raise
+    finally:
+        # Cleanup
+        if not preview:
+            print("[INFO] Cleaning up...")
+        if cache_writer is not None:
+            cache_writer.close()
+        vs.release()
         if writer is not None:
-            writer.write(mask_final)
-
-        # Optionally display the output frame in real-time
+            writer.release()
         if show:
-            cv2.imshow("Frame", mask_final)
-            key = cv2.waitKey(1) & 0xFF
-            if key == ord("q"):
-                break
-
-        frame_number += 1
-
-    # Cleanup
-    print("[INFO] Cleaning up...")
-    vs.release()
-    if writer is not None:
-        writer.release()
-    if show:
-        cv2.destroyAllWindows()
+            cv2.destroyAllWindows()
 
     return None
@@ -0,0 +1,140 @@
+import argparse
+import os
+import sys
+
+from jobs import MODES, CLASS_COLORS, MODEL_PATH, Job, run_jobs, find_videos, load_batch_manifest
+from palette import FIT_METHODS
+from segmentation import DNN_BACKENDS, model_supports_batches
+from image_writer import IMAGE_FORMATS
+from manifest import MANIFEST_FORMATS
+import instrumentation
+
+# Headless entry point, for render servers without a display:
+#   python -m upc run --mode cromaticon --input inputs/video/terreno.mp4 --resize 5
+#   python -m upc run --mode cromaticon --mode pixelate --mode segmentation --input inputs/video/terreno.mp4
+#   python -m upc batch --mode pixelate --mode segmentation --input videos/ --jobs 4
+#   python -m upc batch --input batch.json --jobs 2
+#   python -m upc run --mode pixelate --input inputs/video/terreno.mp4 --timings timings.json
+# Outputs go to the same outputs/ folders as the GUI, jobs whose outputs are up to date are skipped.
+# Several modes on the same video are rendered in a single decode of it (see pipeline.py), always with run
+# and with --shared-decode for batch.
+
+
+# Job options shared by run and batch. Unset options keep the job defaults (or the batch manifest values).
+def add_job_arguments(parser):
+    parser.add_argument("--resize", dest="resize_factor", type=int, help="resize factor (default 5)")
+    parser.add_argument("--colors", dest="num_colors", type=int, help="Cromaticon: number of dominant colors")
+    parser.add_argument("--smooth", dest="smooth_factor", type=int, help="Cromaticon: smooth factor")
+    parser.add_argument("--fit-method", dest="fit_method", choices=FIT_METHODS, help="Cromaticon: palette fit")
+    parser.add_argument("--max-samples", dest="max_samples", type=int,
+                        help="Cromaticon: pixels sampled to fit the palette")
+    parser.add_argument("--streaming", action="store_const", const=True,
+                        help="Cromaticon: decode the video once, keeping a small subsample of every frame in memory")
+    parser.add_argument("--lut", dest="use_lut", action="store_const", const=True,
+                        help="Cromaticon: assign colors through a lookup table")
+    parser.add_argument("--scenes", action="store_const", const=True,
+                        help="Cromaticon: one palette per scene instead of one for the whole video")
+    parser.add_argument("--stride", dest="analysis_stride", type=int,
+                        help="Cromaticon, segmentation: analyse every N-th frame and interpolate the others")
+    parser.add_argument("--change-threshold", dest="change_threshold", type=float,
+                        help="with --stride, also analyse frames that differ this much (0-1) from the last analysed")
+    parser.add_argument("--sectors", dest="num_sectors", type=int, help="Piastrellificio: number of sectors")
+    parser.add_argument("--class", dest="target_class", choices=sorted(CLASS_COLORS),
+                        help="segmentation: highlighted class")
+    parser.add_argument("--batch-size", dest="batch_size", type=int,
+                        help="segmentation: frames per forward pass, no effect on the bundled ENet model (its "
+                             "MaxUnpool layers take one frame at a time)")
+    parser.add_argument("--backend", choices=DNN_BACKENDS, help="segmentation: DNN backend")
+    parser.add_argument("--threads", dest="num_threads", type=int,
+                        help="segmentation: OpenCV threads of the process (cv2.setNumThreads)")
+    parser.add_argument("--gpx", dest="gpx_path", help="GPX track, extracts geotagged frames after processing")
+    parser.add_argument("--author")
+    parser.add_argument("--device")
+    parser.add_argument("--category")
+    parser.add_argument("--interval", type=float, help="seconds between geotagged frames")
+    parser.add_argument("--max-gap", dest="max_gap", type=float,
+                        help="hold the position across GPX gaps longer than this many seconds instead of "
+                             "interpolating (default: interpolate across every gap)")
+    parser.add_argument("--image-format", dest="image_format", choices=sorted(IMAGE_FORMATS))
+    parser.add_argument("--quality", type=int)
+    parser.add_argument("--thumbnail-width", dest="thumbnail_width", type=int,
+                        help="downscale wider geotagged frames to this width")
+    parser.add_argument("--manifest-format", dest="manifest_format", choices=MANIFEST_FORMATS)
+    parser.add_argument("--resume", action="store_const", const=True,
+                        help="keep the geotagged frames of an interrupted run")
+    parser.add_argument("--workers", type=int, help="worker processes per job (0 = one per CPU)")
+    parser.add_argument("--cache", action="store_const", const=True,
+                        help="Cromaticon, segmentation: reuse the analysis of earlier runs (outputs/analysis_cache)")
+    parser.add_argument("--force", action="store_true", help="run jobs even if their outputs are up to date")
+
+
+def job_options(args):
+    names = ("resize_factor", "num_colors", "smooth_factor", "fit_method", "max_samples", "streaming", "use_lut",
+             "scenes", "analysis_stride", "change_threshold", "num_sectors", "target_class", "batch_size", "backend",
+             "num_threads", "gpx_path", "author", "device", "category", "interval", "max_gap", "image_format", "quality",
+             "thumbnail_width", "manifest_format", "resume", "workers", "cache")
+    return {name: getattr(args, name) for name in names if getattr(args, name) is not None}
+
+
+def create_parser():
+    parser = argparse.ArgumentParser(prog="upc", description="4KHD Ultra Paesaggio Continuo")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    run_parser = commands.add_parser("run", help="process one video in one or more modes")
+    run_parser.add_argument("--mode", dest="modes", action="append", required=True, choices=MODES,
+                            help="mode to run, can be repeated")
+    run_parser.add_argument("--input", required=True, help="video file")
+    run_parser.add_argument("--timings", nargs="?", const="", metavar="JSON",
+                            help="print where the time went (see instrumentation.py), and save it to JSON if given")
+    run_parser.add_argument("--profile", metavar="PROF", help="run under cProfile and save the statistics")
+    add_job_arguments(run_parser)
+
+    batch_parser = commands.add_parser("batch", help="process a directory of videos or a JSON batch manifest")
+    batch_parser.add_argument("--mode", dest="modes", action="append", choices=MODES,
+                              help="mode to run on every video, can be repeated")
+    batch_parser.add_argument("--input", required=True, help="directory of videos or JSON batch manifest")
+    batch_parser.add_argument("--jobs", type=int, default=1, help="jobs run at the same time")
+    batch_parser.add_argument("--shared-decode", action="store_true",
+                              help="run all the modes of a video in a single decode of it")
+    add_job_arguments(batch_parser)
+
+    return parser
+
+
+def main(argv=None):
+    args = create_parser().parse_args(argv)
+    options = job_options(args)
+    if options.get("batch_size", 1) > 1 and os.path.exists(MODEL_PATH) and not model_supports_batches(MODEL_PATH):
+        print(f"[WARNING] --batch-size has no effect, {MODEL_PATH} only runs one frame per forward pass",
+              file=sys.stderr)
+
+    if args.command == "run":
+        jobs = [Job(args.input, mode, **options) for mode in dict.fromkeys(args.modes)]
+        max_jobs = 1
+        shared_decode = True
+    else:
+        if os.path.isdir(args.input):
+            if not args.modes:
+                raise SystemExit("upc batch: --mode is required with a directory of videos")
+            jobs = [Job(video_path, mode, **options) for video_path in find_videos(args.input) for mode in args.modes]
+        else:
+            jobs = load_batch_manifest(args.input, args.modes or (), options)
+        max_jobs = args.jobs
+        shared_decode = args.shared_decode
+
+    if args.command == "run" and (args.timings is not None or args.profile):
+        with instrumentation.recording(args.profile) as recorder:
+            failures = run_jobs(jobs, max_jobs, args.force, shared_decode)
+        summary = recorder.summary()
+        print(instrumentation.format_summary(summary))
+        if args.timings:
+            instrumentation.write_summary(args.timings, summary)
+    else:
+        failures = run_jobs(jobs, max_jobs, args.force, shared_decode)
+    for job, error in failures:
+        print(f"{job.describe()} failed: {error}", file=sys.stderr)
+    return 1 if failures else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
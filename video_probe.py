@@ -0,0 +1,140 @@
+import os
+import threading
+from collections import OrderedDict
+
+import cv2
+
+from buffers import local_pool
+from instrumentation import timer, count
+
+# Evenly spaced preview positions of a video, the middle one is the frame the GUI always previewed
+DEFAULT_PREVIEW_POSITIONS = 9
+
+# Number of probed videos kept, with their decoded preview frames
+MAX_CACHED_VIDEOS = 4
+
+# How skipped frames are passed over:
+#   grab: cv2.VideoCapture.grab() without retrieve(), exact and skips the color conversion of unused frames
+#   seek: jump to every extracted frame with CAP_PROP_POS_FRAMES, decoding only from the keyframe before it
+EXTRACTION_MODES = ("grab", "seek")
+
+_cache = OrderedDict()
+_cache_lock = threading.Lock()
+
+
+# Metadata of a video and its preview frames. The metadata is read once, each preview frame is decoded the
+# first time it is asked for and kept, so moving between preview positions does not decode the file again.
+class VideoInfo:
+    def __init__(self, path, mtime, fps, width, height, frame_count, preview_positions=DEFAULT_PREVIEW_POSITIONS):
+        self.path = path
+        self.mtime = mtime
+        self.fps = fps
+        self.width = width
+        self.height = height
+        self.frame_count = frame_count
+        self.preview_positions = preview_positions
+        self.previews = {}
+        self.lock = threading.Lock()
+
+    @property
+    def middle_position(self):
+        return self.preview_positions // 2
+
+    # Frame number of a preview position
+    def preview_frame_number(self, position):
+        return (position + 1) * self.frame_count // (self.preview_positions + 1)
+
+    # Decoded frame at a preview position, None if it cannot be read
+    def preview_frame(self, position=None):
+        if position is None:
+            position = self.middle_position
+        frame_number = self.preview_frame_number(position)
+
+        with self.lock:
+            if frame_number not in self.previews:
+                cap = cv2.VideoCapture(self.path)
+                cap.set(cv2.CAP_PROP_POS_FRAMES, frame_number)
+                ret, frame = cap.read()
+                cap.release()
+                self.previews[frame_number] = frame if ret else None
+            return self.previews[frame_number]
+
+    # Decode every preview position from a single capture, in frame order, e.g. on a background thread right
+    # after the video is selected. Positions already decoded are skipped, and the lock is only held to store
+    # each frame so the GUI can still ask for a preview meanwhile.
+    def preload_previews(self):
+        with self.lock:
+            frame_numbers = sorted({self.preview_frame_number(position)
+                                    for position in range(self.preview_positions)} - set(self.previews))
+        if not frame_numbers:
+            return
+
+        cap = cv2.VideoCapture(self.path)
+        try:
+            for frame_number in frame_numbers:
+                cap.set(cv2.CAP_PROP_POS_FRAMES, frame_number)
+                ret, frame = cap.read()
+                with self.lock:
+                    self.previews.setdefault(frame_number, frame if ret else None)
+        finally:
+            cap.release()
+
+
+# Function to get the metadata of a video, cached by path and modification time.
+# An already open capture of the same file can be passed to read the metadata without opening it again.
+def probe_video(path, cap=None):
+    key = (os.path.abspath(path), os.path.getmtime(path))
+
+    with _cache_lock:
+        if key in _cache:
+            _cache.move_to_end(key)
+            return _cache[key]
+
+    if cap is None:
+        probe_cap = cv2.VideoCapture(path)
+    else:
+        probe_cap = cap
+    info = VideoInfo(path, key[1],
+                     fps=probe_cap.get(cv2.CAP_PROP_FPS),
+                     width=int(probe_cap.get(cv2.CAP_PROP_FRAME_WIDTH)),
+                     height=int(probe_cap.get(cv2.CAP_PROP_FRAME_HEIGHT)),
+                     frame_count=int(probe_cap.get(cv2.CAP_PROP_FRAME_COUNT)))
+    if cap is None:
+        probe_cap.release()
+
+    with _cache_lock:
+        # Another thread may have probed the same video meanwhile, keep a single entry (and its previews)
+        info = _cache.setdefault(key, info)
+        _cache.move_to_end(key)
+        while len(_cache) > MAX_CACHED_VIDEOS:
+            _cache.popitem(last=False)
+    return info
+
+
+# Function to yield (frame_number, frame) for the requested frames only, see EXTRACTION_MODES.
+# Frames are decoded into the same buffer, each one is only valid until the next.
+def read_frames(video_capture, frame_numbers, extraction="grab"):
+    if extraction not in EXTRACTION_MODES:
+        raise ValueError(f"Unknown extraction mode: {extraction}")
+
+    pool = local_pool()
+    position = 0  # Number of the next frame the capture returns
+    for frame_number in frame_numbers:
+        with timer("seek"):
+            if extraction == "seek":
+                if frame_number != position:
+                    video_capture.set(cv2.CAP_PROP_POS_FRAMES, frame_number)
+            else:
+                while position < frame_number:
+                    if not video_capture.grab():
+                        return
+                    position += 1
+                    count("frames_skipped")
+
+        with timer("decode"):
+            success, frame = pool.read(video_capture, "extracted_frame")
+        if not success:
+            return
+        count("frames_decoded")
+        position = frame_number + 1
+        yield frame_number, frame